@@ -1,49 +1,716 @@
 # app.py
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, request, jsonify, g, has_app_context, has_request_context, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager, nullcontext
+import base64
+import argparse
+import bisect
+import hashlib
+import secrets
+import shutil
+import csv
+import gzip
+import io
+import json
+from multiprocessing import get_context
+from collections import Counter, OrderedDict
+from functools import lru_cache, wraps
 import os
+import queue
+import re
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from urllib.parse import urlencode
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.test import EnvironBuilder
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 try:
-    from pymongo import MongoClient
+    from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring
     from bson import ObjectId
+    from pymongo.errors import BulkWriteError, DuplicateKeyError
     HAVE_PYMONGO = True
 except Exception:
     HAVE_PYMONGO = False
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+try:
+    import brotli
+    HAVE_BROTLI = True
+except ImportError:
+    HAVE_BROTLI = False
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, 'hospital.db')
+DB_PATH = os.environ.get('DB_PATH') or os.path.join(BASE_DIR, 'hospital.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_CACHE_KB = int(os.environ.get('DB_CACHE_KB', '16384'))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', '256'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+SEARCH_LIMIT = int(os.environ.get('SEARCH_LIMIT', '20'))
+SEARCH_RANK_WINDOW = int(os.environ.get('SEARCH_RANK_WINDOW', '2000'))
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '500'))
+WORK_START = os.environ.get('WORK_START', '09:00')
+WORK_END = os.environ.get('WORK_END', '17:00')
+SLOT_MINUTES = int(os.environ.get('SLOT_MINUTES', '60'))
+MAX_AVAILABILITY_DAYS = int(os.environ.get('MAX_AVAILABILITY_DAYS', '62'))
+MAX_ANALYTICS_DAYS = int(os.environ.get('MAX_ANALYTICS_DAYS', '731'))
+ANALYTICS_LIMIT = int(os.environ.get('ANALYTICS_LIMIT', '50'))
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', '1000'))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '20'))
+ASSET_MAX_AGE = int(os.environ.get('ASSET_MAX_AGE', str(365 * 24 * 3600)))
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '5000'))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', '1000'))
+SEED_BATCH_SIZE = int(os.environ.get('SEED_BATCH_SIZE', '50000'))
+SEED_MAX_ROWS = int(os.environ.get('SEED_MAX_ROWS', '10000000'))
+SEED_MAX_DAYS = int(os.environ.get('SEED_MAX_DAYS', '3660'))
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', str(32 * 1024 * 1024)))
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', '1024'))
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', '2'))
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', '64'))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', '10'))
+SESSION_TTL = int(os.environ.get('SESSION_TTL', str(12 * 3600)))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '100000'))
+# How long a worker trusts its cached copy of a session before re-checking the
+# user and the shared revocation list; bounds how stale other workers can be.
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', '60'))
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '1000'))
+# Pause between batches so requests queued on the SQLite write lock get a turn.
+JOB_BATCH_PAUSE = float(os.environ.get('JOB_BATCH_PAUSE', '0.01'))
+# Cascade deletes touching more appointments than this run as a background job.
+JOB_INLINE_LIMIT = int(os.environ.get('JOB_INLINE_LIMIT', '1000'))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', '7'))
+JOB_SPOOL_DIR = os.environ.get('JOB_SPOOL_DIR') or tempfile.gettempdir()
+CHANGE_LOG_SIZE = int(os.environ.get('CHANGE_LOG_SIZE', '100000'))
+CHANGE_POLL_SECONDS = float(os.environ.get('CHANGE_POLL_SECONDS', '0.5'))
+CHANGE_HEARTBEAT_SECONDS = float(os.environ.get('CHANGE_HEARTBEAT_SECONDS', '15'))
+CHANGE_STREAM_SECONDS = float(os.environ.get('CHANGE_STREAM_SECONDS', '300'))
+# Every open change stream holds a server thread, so by default a worker lets
+# streams take at most half of its WEB_THREADS; the rest get 503 and poll instead.
+CHANGE_MAX_STREAMS = int(os.environ.get('CHANGE_MAX_STREAMS') or max(1, int(os.environ.get('WEB_THREADS', '4')) // 2))
+
+app = Flask(__name__, static_folder=None)
+# Without SECRET_KEY the key is random per process: tokens only survive across
+# workers when the app is preloaded before forking (see wsgi.py).
+app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_bytes(32)
+CORS(app, expose_headers=['X-Next-Cursor', 'Link'])
+# ---------- Metrics ----------
+# Process-local Prometheus metrics: request latency/size per route, time and rows
+# per query (SQLite cursors and pymongo command events), pool waits, password
+# hashing and JSON encoding. Under gunicorn every worker keeps its own registry.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+
+    def describe(self, name, kind, text, buckets=None):
+        self._meta[name] = (kind, text, buckets)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self._values[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        buckets = self._meta[name][2]
+        i = bisect.bisect_left(buckets, value)
+        key = (name, labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = [0] * (len(buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        with self._lock:
+            values = {k: (list(v) if isinstance(v, list) else v) for k, v in self._values.items()}
+        lines = []
+        for name, (kind, text, buckets) in self._meta.items():
+            series = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {v}")
+                    continue
+                running = 0
+                for le, n in zip(buckets + ("+Inf",), v):
+                    running += n
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', le),))} {running}")
+                lines.append(f"{name}_sum{self._labels(labels)} {v[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {running}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("hms_http_requests_total", "counter", "HTTP requests by route and status.")
+metrics.describe("hms_http_request_seconds", "histogram", "Time to produce a response (headers only for streamed bodies).", LATENCY_BUCKETS)
+metrics.describe("hms_http_response_bytes", "histogram", "Response body size for non-streamed responses.", SIZE_BUCKETS)
+metrics.describe("hms_db_query_seconds", "histogram", "Database statement/command time.", LATENCY_BUCKETS)
+metrics.describe("hms_db_rows_total", "counter", "Rows fetched (SQLite) or documents returned (Mongo).")
+metrics.describe("hms_db_slow_queries_total", "counter", f"Statements slower than SLOW_QUERY_MS ({SLOW_QUERY_MS} ms).")
+metrics.describe("hms_db_pool_wait_seconds", "histogram", "Time spent checking a connection out of the pool.", LATENCY_BUCKETS)
+metrics.describe("hms_password_hash_seconds", "histogram", "Password hashing/verification time including queueing.", LATENCY_BUCKETS)
+metrics.describe("hms_db_pool_connections", "gauge", "SQLite pool connections by state.")
+metrics.describe("hms_response_cache", "gauge", "Response cache counters.")
+metrics.describe("hms_sessions_cached", "gauge", "Sessions held in this worker's cache.")
+metrics.describe("hms_name_index", "gauge", "Appointment name index size, bytes, hits and misses, by kind.")
+metrics.describe("hms_jobs_total", "counter", "Background jobs finished, by kind and final status.")
+metrics.describe("hms_change_streams", "gauge", "Change-feed event streams open in this worker.")
+
+def record_phase(name, seconds):
+    """Add to this request's Server-Timing phase; a no-op outside a request (e.g. streamed bodies)."""
+    if has_app_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+(\w+)", re.I)
+
+@lru_cache(maxsize=1024)
+def sql_label(sql):
+    """(operation, table) for a SQL string, e.g. ("SELECT", "patient"); used as metric labels."""
+    words = sql.split(None, 1)
+    match = _SQL_TABLE.search(sql)
+    return (words[0].upper() if words else ""), (match.group(1) if match else "")
+
+def record_query(backend, op, table, seconds, statement=None):
+    labels = (("backend", backend), ("op", op), ("table", table))
+    metrics.observe("hms_db_query_seconds", labels, seconds)
+    record_phase("db", seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        metrics.inc("hms_db_slow_queries_total", labels)
+        where = request.path if has_request_context() else "-"
+        app.logger.warning("slow query: %.1f ms %s %s (%s): %s", seconds * 1000, op, table, where, (statement or "").strip()[:500])
+
+class PooledCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        # Inside an atomic batch the transaction is already open; see PooledConnection.
+        if self.connection.held and sql == "BEGIN IMMEDIATE":
+            return self
+        return super().execute(sql, params)
+
+class PooledConnection(sqlite3.Connection):
+    """Pool connection that an atomic /api/batch can hold in one transaction.
+
+    While held, the routes' own BEGIN IMMEDIATE and commit() are no-ops, so every
+    write in the batch lands in the batch's transaction; a rollback() still rolls
+    back and marks the batch aborted.
+    """
+    held = False
+    aborted = False
+
+    def cursor(self, factory=PooledCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        if not self.held:
+            super().commit()
+
+    def rollback(self):
+        if self.held:
+            self.aborted = True
+        super().rollback()
+
+class TimedCursor(PooledCursor):
+    def execute(self, sql, params=()):
+        self._label = sql_label(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_query("sqlite", *self._label, time.perf_counter() - start, sql)
+
+    def executemany(self, sql, seq):
+        self._label = sql_label(sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            record_query("sqlite", *self._label, time.perf_counter() - start, sql)
+
+    def _fetched(self, rows, start):
+        # SQLite steps lazily, so fetch time is part of the statement's cost too.
+        seconds = time.perf_counter() - start
+        op, table = getattr(self, '_label', ("", ""))
+        metrics.inc("hms_db_rows_total", (("backend", "sqlite"), ("op", op), ("table", table)), rows)
+        record_phase("db", seconds)
+        return seconds
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._fetched(len(rows), start) * 1000 >= SLOW_QUERY_MS:
+            app.logger.warning("slow fetch: %d rows %s %s", len(rows), *getattr(self, '_label', ("", "")))
+        return rows
+
+class TimedConnection(PooledConnection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_query("sqlite", "COMMIT", "", time.perf_counter() - start)
+
+if HAVE_PYMONGO:
+    class MongoCommandTimer(monitoring.CommandListener):
+        """pymongo command listener; events fire on the thread that ran the command."""
+
+        def __init__(self):
+            self._collections = {}
+
+        def started(self, event):
+            cmd = event.command
+            target = cmd.get("collection") if event.command_name == "getMore" else cmd.get(event.command_name)
+            self._collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else ""
+
+        def succeeded(self, event):
+            table = self._collections.pop((event.connection_id, event.request_id), "")
+            record_query("mongo", event.command_name, table, event.duration_micros / 1e6)
+            cursor = event.reply.get("cursor")
+            if isinstance(cursor, dict):
+                rows = len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+                metrics.inc("hms_db_rows_total", (("backend", "mongo"), ("op", event.command_name), ("table", table)), rows)
+
+        def failed(self, event):
+            table = self._collections.pop((event.connection_id, event.request_id), "")
+            record_query("mongo", event.command_name, table, event.duration_micros / 1e6)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            record_phase("json", time.perf_counter() - start)
+
+if METRICS_ENABLED:
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timer():
+        g.started = time.perf_counter()
+        g.timings = {}
+
+    @app.after_request
+    def record_request(resp):
+        started = g.pop('started', None)
+        if started is None:
+            return resp
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.inc("hms_http_requests_total", (("method", request.method), ("route", route), ("status", str(resp.status_code))))
+        metrics.observe("hms_http_request_seconds", (("method", request.method), ("route", route)), elapsed)
+        if not resp.is_streamed and resp.content_length is not None:
+            metrics.observe("hms_http_response_bytes", (("route", route),), resp.content_length)
+        if SERVER_TIMING:
+            phases = [f"{k};dur={v * 1000:.2f}" for k, v in g.timings.items()]
+            resp.headers['Server-Timing'] = ", ".join(phases + [f"total;dur={elapsed * 1000:.2f}"])
+        return resp
 
-app = Flask(__name__, static_folder=BASE_DIR, static_url_path='')
-CORS(app)
 MONGODB_URI = os.environ.get('MONGODB_URI')
 use_mongo = False
+mongo_client = None
+
+def connect_mongo(create_indexes=True):
+    """(Re)open the Mongo client; called at import and again in each forked worker."""
+    global mongo_client, db
+    listeners = [MongoCommandTimer()] if METRICS_ENABLED else []
+    mongo_client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=2000, maxPoolSize=DB_POOL_SIZE, waitQueueTimeoutMS=int(DB_POOL_TIMEOUT * 1000), event_listeners=listeners)
+    db = mongo_client['hospital']
+    if not create_indexes:
+        return
+    mongo_client.admin.command('ping')
+    db.users.create_index('email', unique=True)
+    db.appointments.create_index('datetime')
+    db.users.create_index('is_admin')
+    db.doctors.create_index('specialty')
+    for name in ('patients', 'doctors', 'users'):
+        getattr(db, name).create_index('_search')
+        getattr(db, name).create_index([('_name', 1), ('_id', 1)])
+    db.revoked_sessions.create_index('sid', unique=True)
+    db.jobs.create_index('status')
+    db.doctor_hours.create_index('version')
+    db.revoked_sessions.create_index('expires_at', expireAfterSeconds=0)
+
 if HAVE_PYMONGO and MONGODB_URI:
     try:
-        mongo_client = MongoClient(MONGODB_URI, serverSelectionTimeoutMS=2000)
-        mongo_client.admin.command('ping')
-        db = mongo_client['hospital']
-        db.users.create_index('email', unique=True)
-        db.appointments.create_index('datetime')
-        try:
-            db.appointments.create_index([('doctor_id', 1), ('datetime', 1)], unique=True)
-        except Exception:
-            pass
+        connect_mongo()
         use_mongo = True
     except Exception:
         use_mongo = False
 
+# ---------- Connection pool ----------
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections opened once in WAL mode and reused across requests.
+
+    Connections keep their prepared-statement cache between checkouts, so hot queries
+    are compiled once per connection rather than once per request.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+
+    def _connect(self):
+        factory = TimedConnection if METRICS_ENABLED else PooledConnection
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE, factory=factory)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    self._waits += 1
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(f"no database connection available after {self.timeout}s")
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            with self._lock:
+                self._created -= 1
+                self._in_use -= 1
+            return
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """Close every idle connection; ones still checked out go back to the pool as usual."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "timeout": self.timeout,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._created - self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+            }
+
+pool = ConnectionPool(DB_PATH)
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Return this request's pooled connection; it goes back to the pool on teardown."""
+    conn = g.get('db_conn')
+    if conn is None:
+        start = time.perf_counter()
+        conn = g.db_conn = pool.acquire()
+        waited = time.perf_counter() - start
+        metrics.observe("hms_db_pool_wait_seconds", (), waited)
+        record_phase("pool", waited)
     return conn
 
-def init_db():
-    if use_mongo:
+def held_conn():
+    """The caller's connection inside a request or job; outside one (CLI, bench.py) a pooled one for the block.
+
+    Writers that can run either way use this rather than pool.connection(), which
+    would take a second connection next to the one the request already holds.
+    """
+    return nullcontext(get_conn()) if has_app_context() else pool.connection()
+
+@app.teardown_appcontext
+def release_conn(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        pool.release(conn)
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return jsonify({"error": str(e)}), 503
+
+# ---------- Counters ----------
+# Row counts, per-day appointment totals and the per-doctor hourly rollup used by
+# the utilization analytics are maintained incrementally by every write, so
+# neither /api/stats nor /api/analytics ever has to scan the appointment table.
+COUNTED_TABLES = {"patients": "patient", "doctors": "doctor", "appointments": "appointment", "users": "user"}
+
+def touch_tables(cur, *names):
+    """Bump the version of each named table (see COUNTED_TABLES) so cached reads go stale."""
+    now = datetime.now(timezone.utc).isoformat()
+    cur.executemany("UPDATE table_version SET version = version + 1, updated_at = ? WHERE name = ?", [(now, n) for n in names])
+
+def day_number(day):
+    """'YYYY-MM-DD' as a proleptic Gregorian ordinal, the day key of the doctor_hour rollup."""
+    return date.fromisoformat(day).toordinal()
+
+def bump_counters(cur, hours=(), **deltas):
+    """Apply count deltas (and ((doctor_id, 'YYYY-MM-DD HH'), delta) pairs) inside the caller's SQLite transaction.
+
+    Every table whose count changes also gets its version bumped; rollup rows are
+    stamped with the new appointments version so the analytics cache can pick up
+    just the rows that moved.
+    """
+    hours = [(k, n) for k, n in hours if n]
+    changed = [k for k, v in deltas.items() if v]
+    cur.executemany("UPDATE counter SET value = value + ? WHERE name = ?", [(deltas[k], k) for k in changed])
+    days = Counter()
+    for (_, hour), n in hours:
+        days[hour[:10]] += n
+    cur.executemany(
+        "INSERT INTO appointment_day(day, total) VALUES(?, ?) ON CONFLICT(day) DO UPDATE SET total = total + excluded.total",
+        [(day, n) for day, n in days.items() if n])
+    touch_tables(cur, *changed)
+    if hours:
+        version = cur.execute("SELECT version FROM table_version WHERE name = 'appointments'").fetchone()[0]
+        cur.executemany(
+            """INSERT INTO doctor_hour(doctor_id, day, hour, total, version) VALUES(?, ?, ?, ?, ?)
+               ON CONFLICT(doctor_id, day, hour) DO UPDATE SET total = total + excluded.total, version = excluded.version""",
+            [(did, day_number(hour[:10]), int(hour[11:13]), n, version) for (did, hour), n in hours])
+
+def appointment_hours(cur, where="", params=()):
+    """Per doctor-hour ((doctor_id, 'YYYY-MM-DD HH'), -count) deltas for the appointments a DELETE with this WHERE clause will remove."""
+    sql = "SELECT doctor_id, substr(datetime, 1, 13) AS hour, COUNT(*) AS n FROM appointment"
+    if where:
+        sql += " WHERE " + where
+    return [((r["doctor_id"], r["hour"]), -r["n"]) for r in cur.execute(sql + " GROUP BY 1, 2", params).fetchall()]
+
+def hour_deltas(rows, sign=1):
+    """Fold appointment dicts/documents into ((doctor_id, 'YYYY-MM-DD HH'), delta) pairs."""
+    counts = Counter((r["doctor_id"], r["datetime"][:13]) for r in rows)
+    return [(k, sign * n) for k, n in counts.items()]
+
+def touch_mongo_tables(*names):
+    if names:
+        now = datetime.now(timezone.utc).isoformat()
+        db.counters.update_one({"_id": "versions"}, {"$inc": {n: 1 for n in names}, "$set": {f"{n}_at": now for n in names}}, upsert=True)
+
+def bump_mongo_counters(hours=(), **deltas):
+    inc = {k: v for k, v in deltas.items() if v}
+    if inc:
+        db.counters.update_one({"_id": "stats"}, {"$inc": inc}, upsert=True)
+    days = Counter()
+    for (_, hour), n in hours:
+        days[hour[:10]] += n
+    for day, n in days.items():
+        if n:
+            db.appointment_days.update_one({"_id": day}, {"$inc": {"total": n}}, upsert=True)
+    touch_mongo_tables(*inc)
+    hours = [(k, n) for k, n in hours if n]
+    if hours:
+        version = (db.counters.find_one({"_id": "versions"}, {"appointments": 1}) or {}).get("appointments", 0)
+        db.doctor_hours.bulk_write([
+            UpdateOne({"_id": f"{did}|{hour}"}, {"$inc": {"total": n}, "$max": {"version": version},
+                                                 "$setOnInsert": {"doctor_id": did, "day": day_number(hour[:10]), "hour": int(hour[11:13])}},
+                      upsert=True)
+            for (did, hour), n in hours], ordered=False)
+
+def mongo_appointment_days(match):
+    rows = db.appointments.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"$substr": ["$datetime", 0, 10]}, "n": {"$sum": 1}}},
+    ])
+    return [(r["_id"], -r["n"]) for r in rows]
+
+def mongo_appointment_hours(match):
+    rows = db.appointments.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"d": "$doctor_id", "h": {"$substr": ["$datetime", 0, 13]}}, "n": {"$sum": 1}}},
+    ])
+    return [((r["_id"]["d"], r["_id"]["h"]), -r["n"]) for r in rows]
+
+def init_mongo_slot_indexes():
+    """Build the unique (owner, datetime) indexes that stop double bookings, dropping old ones first.
+
+    Same as _drop_double_bookings on SQLite: the earliest appointment of each slot
+    is kept and the others are logged and deleted. The scan only runs while an
+    index is missing, and a failing build stops the app rather than serving
+    without the protection.
+    """
+    built = {tuple(i["key"]) for i in db.appointments.index_information().values()}
+    for owner in ('doctor_id', 'patient_id'):
+        key = ((owner, 1), ('datetime', 1))
+        if key in built:
+            continue
+        extra = []
+        for group in db.appointments.aggregate([
+                {"$group": {"_id": {"owner": f"${owner}", "datetime": "$datetime"}, "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}}], allowDiskUse=True):
+            extra += sorted(group["ids"])[1:]
+        dropped = list(db.appointments.find({"_id": {"$in": extra}})) if extra else []
+        for a in dropped:
+            app.logger.warning("dropping double booking: appointment %s (patient %s, doctor %s, %s)",
+                               a["_id"], a["patient_id"], a["doctor_id"], a["datetime"])
+        if dropped:
+            db.appointments.delete_many({"_id": {"$in": extra}})
+            # Without a stats document yet, init_mongo_counters counts from scratch anyway.
+            if db.counters.find_one({"_id": "stats"}):
+                bump_mongo_counters(hours=hour_deltas(dropped, -1), appointments=-len(dropped))
+        db.appointments.create_index(list(key), unique=True)
+
+def init_mongo_counters():
+    if not db.counters.find_one({"_id": "stats"}):
+        db.counters.insert_one({"_id": "stats", "patients": db.patients.count_documents({}), "doctors": db.doctors.count_documents({}),
+                                "appointments": db.appointments.count_documents({}), "users": db.users.count_documents({})})
+        db.appointment_days.delete_many({})
+        for day, n in mongo_appointment_days({}):
+            db.appointment_days.insert_one({"_id": day, "total": -n})
+    # The rollup came later than the counters, so it is backfilled on its own, once.
+    if not db.counters.find_one({"_id": "doctor_hours"}):
+        db.doctor_hours.delete_many({})
+        docs = [{"_id": f"{did}|{hour}", "doctor_id": did, "day": day_number(hour[:10]), "hour": int(hour[11:13]), "total": -n, "version": 0}
+                for (did, hour), n in mongo_appointment_hours({})]
+        for i in range(0, len(docs), 10000):
+            db.doctor_hours.insert_many(docs[i:i + 10000])
+        db.counters.insert_one({"_id": "doctor_hours"})
+
+# ---------- Change log ----------
+# Creates, deletes and user role changes append an event to an append-only log,
+# written in the same transaction as the change itself and numbered by a version
+# that only grows. Bulk writes (clear, seeding, imports, long cascade deletes)
+# log a single "reset" per kind instead of one event per row, which tells
+# clients to refetch that list. Only the newest CHANGE_LOG_SIZE events are kept.
+def log_changes(cur, kind, op, items):
+    """Append one event per (id, data) pair inside the caller's SQLite transaction."""
+    now = datetime.now(timezone.utc).isoformat()
+    cur.executemany("INSERT INTO change_log(kind, op, entity_id, data, created_at) VALUES(?, ?, ?, ?, ?)",
+                    [(kind, op, i, None if d is None else json.dumps(d), now) for i, d in items])
+    last = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+    # Trim once every thousand versions rather than on every write.
+    if last // 1000 != (last - len(items)) // 1000:
+        cur.execute("DELETE FROM change_log WHERE version <= ?", (last - CHANGE_LOG_SIZE,))
+
+def log_mongo_changes(kind, op, items):
+    items = list(items)
+    if not items:
         return
-    conn = get_conn()
-    cur = conn.cursor()
+    last = db.counters.find_one_and_update({"_id": "changes"}, {"$inc": {"version": len(items)}}, upsert=True,
+                                           return_document=ReturnDocument.AFTER)["version"]
+    now = datetime.now(timezone.utc).isoformat()
+    first = last - len(items) + 1
+    db.changes.insert_many([{"_id": first + n, "kind": kind, "op": op, "entity_id": i, "data": d, "at": now} for n, (i, d) in enumerate(items)])
+    if last // 1000 != (last - len(items)) // 1000:
+        db.changes.delete_many({"_id": {"$lte": last - CHANGE_LOG_SIZE}})
+
+@contextmanager
+def bulk_changes(*kinds):
+    """Log one reset per kind once a bulk write ends, whether it finished, failed or was cancelled."""
+    try:
+        yield
+    finally:
+        repos().changes.reset(kinds)
+        drop_name_indexes(kinds)
+
+# ---------- Schema migrations ----------
+# Each step runs once, in order, inside its own transaction; PRAGMA user_version
+# records how many have been applied so existing hospital.db files upgrade in place.
+def _migrate_base_tables(cur):
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS patient (
@@ -92,227 +759,2047 @@ def init_db():
         )
         """
     )
-    conn.commit()
-    conn.close()
 
-# ---------- Helpers ----------
-def appointment_to_dict(row):
-    return {
-        "id": row["id"],
-        "patient_id": row["patient_id"],
-        "patient_name": row["patient_name"],
-        "doctor_id": row["doctor_id"],
-        "doctor_name": row["doctor_name"],
-        "datetime": row["datetime"],
-        "created_at": row["created_at"]
-    }
+def _migrate_user_is_admin(cur):
+    cols = [r[1] for r in cur.execute("PRAGMA table_info(user)").fetchall()]
+    if 'is_admin' not in cols:
+        cur.execute("ALTER TABLE user ADD COLUMN is_admin INTEGER DEFAULT 0")
+
+def _drop_double_bookings(cur, owner):
+    """Delete all but the earliest appointment per (owner, datetime), so a UNIQUE index can be built.
+
+    Bookings used to check the slot and insert in separate statements, so older
+    databases can hold double bookings. Each dropped row is logged.
+    """
+    dropped = cur.execute(f"""SELECT id, patient_id, doctor_id, datetime FROM appointment
+                              WHERE id NOT IN (SELECT MIN(id) FROM appointment GROUP BY {owner}, datetime)""").fetchall()
+    for aid, pid, did, dt in dropped:
+        app.logger.warning("dropping double booking: appointment %s (patient %s, doctor %s, %s)", aid, pid, did, dt)
+    cur.executemany("DELETE FROM appointment WHERE id = ?", [(r[0],) for r in dropped])
+    return dropped
+
+def _migrate_hot_query_indexes(cur):
+    _drop_double_bookings(cur, "doctor_id")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_appointment_doctor_datetime ON appointment(doctor_id, datetime)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_appointment_patient_datetime ON appointment(patient_id, datetime)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_appointment_datetime ON appointment(datetime)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_admin ON user(is_admin) WHERE is_admin = 1")
+
+def _migrate_counters(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    cur.execute("CREATE TABLE IF NOT EXISTS appointment_day (day TEXT PRIMARY KEY, total INTEGER NOT NULL DEFAULT 0)")
+    for name, table in COUNTED_TABLES.items():
+        cur.execute(f"INSERT OR REPLACE INTO counter(name, value) SELECT ?, COUNT(*) FROM {table}", (name,))
+    cur.execute("DELETE FROM appointment_day")
+    cur.execute("INSERT INTO appointment_day(day, total) SELECT substr(datetime, 1, 10), COUNT(*) FROM appointment GROUP BY 1")
+
+def _migrate_doctor_specialty_index(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_doctor_specialty ON doctor(specialty)")
+
+def _migrate_unique_patient_slot(cur):
+    dropped = _drop_double_bookings(cur, "patient_id")
+    # The counters exist by now (_migrate_counters), so they have to follow the deletes.
+    cur.execute("UPDATE counter SET value = value - ? WHERE name = 'appointments'", (len(dropped),))
+    cur.executemany("UPDATE appointment_day SET total = total - 1 WHERE day = ?", [(r[3][:10],) for r in dropped])
+    cur.execute("DROP INDEX IF EXISTS idx_appointment_patient_datetime")
+    cur.execute("CREATE UNIQUE INDEX idx_appointment_patient_datetime ON appointment(patient_id, datetime)")
+
+def _migrate_table_versions(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS table_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0, updated_at TEXT)")
+    now = datetime.now(timezone.utc).isoformat()
+    cur.executemany("INSERT OR IGNORE INTO table_version(name, version, updated_at) VALUES(?, 0, ?)", [(n, now) for n in COUNTED_TABLES])
+
+def _migrate_revoked_sessions(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS revoked_session (sid TEXT PRIMARY KEY, expires_at TEXT NOT NULL)")
+
+def _migrate_search_index(cur):
+    for table, fields in SEARCH_FIELDS.values():
+        cols = ", ".join(fields)
+        new = ", ".join(f"new.{f}" for f in fields)
+        old = ", ".join(f"old.{f}" for f in fields)
+        cur.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({cols}, content='{table}', content_rowid='id',
+                       tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN INSERT INTO {table}_fts(rowid, {cols}) VALUES(new.id, {new}); END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN INSERT INTO {table}_fts({table}_fts, rowid, {cols}) VALUES('delete', old.id, {old}); END")
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF {cols} ON {table} BEGIN
+                       INSERT INTO {table}_fts({table}_fts, rowid, {cols}) VALUES('delete', old.id, {old});
+                       INSERT INTO {table}_fts(rowid, {cols}) VALUES(new.id, {new}); END""")
+        cur.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES('rebuild')")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_name_nocase ON {table}(name COLLATE NOCASE)")
+
+def _migrate_jobs(cur):
+    cur.execute("""CREATE TABLE IF NOT EXISTS job (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        params TEXT NOT NULL DEFAULT '{}',
+        processed INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        result TEXT,
+        error TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created_by TEXT,
+        created_at TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_status ON job(status)")
+
+def _migrate_search_bulk_load(cur):
+    # A row here (only ever visible inside the writer's own transaction) turns the
+    # per-row insert trigger off for that table; see deferred_search_index().
+    cur.execute("CREATE TABLE IF NOT EXISTS search_bulk_load (name TEXT PRIMARY KEY)")
+    for table, fields in SEARCH_FIELDS.values():
+        cols = ", ".join(fields)
+        new = ", ".join(f"new.{f}" for f in fields)
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_fts_ai")
+        cur.execute(f"""CREATE TRIGGER {table}_fts_ai AFTER INSERT ON {table}
+                       WHEN NOT EXISTS (SELECT 1 FROM search_bulk_load WHERE name = '{table}')
+                       BEGIN INSERT INTO {table}_fts(rowid, {cols}) VALUES(new.id, {new}); END""")
+
+def _migrate_change_log(cur):
+    # AUTOINCREMENT so a version is never handed out twice, even after trimming.
+    cur.execute("""CREATE TABLE IF NOT EXISTS change_log (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        op TEXT NOT NULL,
+        entity_id,
+        data TEXT,
+        created_at TEXT NOT NULL
+    )""")
+
+def _migrate_doctor_hour(cur):
+    # day is a date ordinal (see day_number); 1721424.5 is the Julian day of ordinal 0.
+    # Rows are kept at total 0 after cancellations so caches that replay by version see them.
+    cur.execute("""CREATE TABLE IF NOT EXISTS doctor_hour (
+        doctor_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        hour INTEGER NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (doctor_id, day, hour)
+    ) WITHOUT ROWID""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_doctor_hour_version ON doctor_hour(version)")
+    cur.execute("DELETE FROM doctor_hour")
+    cur.execute("""INSERT INTO doctor_hour(doctor_id, day, hour, total, version)
+                   SELECT doctor_id, CAST(julianday(substr(datetime, 1, 10)) - 1721424.5 AS INTEGER),
+                          CAST(substr(datetime, 12, 2) AS INTEGER), COUNT(*), 0
+                   FROM appointment GROUP BY doctor_id, substr(datetime, 1, 13)""")
+
+MIGRATIONS = [
+    _migrate_base_tables,
+    _migrate_user_is_admin,
+    _migrate_hot_query_indexes,
+    _migrate_counters,
+    _migrate_doctor_specialty_index,
+    _migrate_unique_patient_slot,
+    _migrate_table_versions,
+    _migrate_revoked_sessions,
+    _migrate_search_index,
+    _migrate_jobs,
+    _migrate_search_bulk_load,
+    _migrate_change_log,
+    _migrate_doctor_hour,
+]
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            step(cur)
+            cur.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    if use_mongo:
+        init_mongo_slot_indexes()
+        init_mongo_counters()
+        init_mongo_search()
+        return
+    migrate(get_conn())
+
+HOT_QUERIES = {
+    "doctor conflict": ("SELECT 1 FROM appointment WHERE doctor_id = ? AND datetime = ?", (1, "2000-01-01 10:00")),
+    "patient conflict": ("SELECT 1 FROM appointment WHERE patient_id = ? AND datetime = ?", (1, "2000-01-01 10:00")),
+    "cascade by patient": ("DELETE FROM appointment WHERE patient_id = ?", (1,)),
+    "cascade by doctor": ("DELETE FROM appointment WHERE doctor_id = ?", (1,)),
+    "appointments by datetime": ("SELECT a.id, a.patient_id, a.doctor_id, a.datetime, a.created_at FROM appointment a ORDER BY a.datetime, a.id LIMIT ?", (50,)),
+    "admin lookup": ("SELECT id FROM user WHERE is_admin = 1 LIMIT 1", ()),
+    "user by email": ("SELECT id FROM user WHERE email = ?", ("a@example.com",)),
+    "rollup since version": ("SELECT doctor_id, day, hour, total FROM doctor_hour WHERE version > ?", (1,)),
+}
+
+def explain_hot_queries(conn):
+    """Print EXPLAIN QUERY PLAN for each hot query and flag any that still scan a table."""
+    ok = True
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        scans = [p for p in plan if p.startswith("SCAN") and "USING" not in p]
+        ok = ok and not scans
+        print(f"[{'SCAN' if scans else 'ok'}] {name}")
+        for p in plan:
+            print(f"    {p}")
+    return ok
+
+# ---------- Helpers ----------
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+def encode_cursor(*parts):
+    raw = "\x1f".join(str(p) for p in parts)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, count):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except Exception:
+        raise ApiError("invalid cursor")
+    parts = raw.split("\x1f")
+    if len(parts) != count:
+        raise ApiError("invalid cursor")
+    return parts
+
+def page_args():
+    """Read ?limit= and ?after= for keyset pagination; no limit means the whole (filtered) list."""
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ApiError("invalid limit")
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, request.args.get('after') or None
+
+def datetime_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).strftime(fmt)
+        except ValueError:
+            pass
+    raise ApiError(f"invalid {name}")
+
+def int_arg(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(f"invalid {name}")
+
+def object_id_arg(value, name):
+    try:
+        return ObjectId(value)
+    except Exception:
+        raise ApiError(f"invalid {name}")
+
+def paged_response(items, limit, cursor_of):
+    """jsonify one page; when more rows exist the next cursor goes out in X-Next-Cursor and Link."""
+    next_cursor = None
+    if limit is not None and len(items) > limit:
+        items = items[:limit]
+        next_cursor = cursor_of(items[-1])
+    resp = jsonify(items)
+    if next_cursor:
+        resp.headers['X-Next-Cursor'] = next_cursor
+        args = request.args.to_dict()
+        args['after'] = next_cursor
+        resp.headers['Link'] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+    return resp
+
+def appointment_cursor(a):
+    return encode_cursor(a["datetime"], a["id"])
+
+def stream_format():
+    """'ndjson' or 'json' when the client asked for a streamed list, else None."""
+    accept = request.accept_mimetypes
+    if accept and accept.best == 'application/x-ndjson':
+        return 'ndjson'
+    stream = (request.args.get('stream') or '').lower()
+    if stream == 'ndjson':
+        return 'ndjson'
+    if stream in ('1', 'true', 'json'):
+        return 'json'
+    return None
+
+def stream_response(items, fmt):
+    """Serialize items one at a time so memory stays flat and the first byte goes out immediately."""
+    dumps = app.json.dumps
+    def generate():
+        if fmt == 'ndjson':
+            for item in items:
+                yield dumps(item) + "\n"
+            return
+        yield "["
+        first = True
+        for item in items:
+            yield dumps(item) if first else "," + dumps(item)
+            first = False
+        yield "]\n"
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(generate(), mimetype=mimetype)
+
+def stream_rows(sql, params, to_dict):
+    # Streams outlive the request context, so they check out their own connection.
+    with pool.connection() as conn:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            for r in rows:
+                yield to_dict(r)
+
+def patient_to_dict(row):
+    return { "id": row["id"], "name": row["name"], "age": row["age"], "contact": row["contact"], "address": row["address"], "created_at": row["created_at"] }
+
+def patient_doc_to_dict(d):
+    return { "id": str(d.get("_id")), "name": d.get("name",""), "age": d.get("age",0), "contact": d.get("contact",""), "address": d.get("address",""), "created_at": d.get("created_at","") }
+
+def doctor_to_dict(row):
+    return { "id": row["id"], "name": row["name"], "specialty": row["specialty"], "contact": row["contact"] }
+
+def doctor_doc_to_dict(d):
+    return { "id": str(d.get("_id")), "name": d.get("name",""), "specialty": d.get("specialty",""), "contact": d.get("contact","") }
+
+def user_to_dict(row):
+    return { "id": row["id"], "name": row["name"], "email": row["email"], "is_admin": row["is_admin"], "created_at": row["created_at"] }
+
+def user_doc_to_dict(r):
+    return { "id": str(r.get("_id")), "name": r.get("name",""), "email": r.get("email",""), "is_admin": r.get("is_admin",0), "created_at": r.get("created_at","") }
+
+def job_to_dict(row):
+    return { "id": row["id"], "kind": row["kind"], "status": row["status"], "processed": row["processed"], "total": row["total"],
+             "result": json.loads(row["result"]) if row["result"] else None, "error": row["error"], "cancel_requested": bool(row["cancel_requested"]),
+             "created_by": row["created_by"], "created_at": row["created_at"], "started_at": row["started_at"], "finished_at": row["finished_at"] }
+
+def job_doc_to_dict(d):
+    return { "id": d.get("_id"), "kind": d.get("kind"), "status": d.get("status"), "processed": d.get("processed", 0), "total": d.get("total"),
+             "result": d.get("result"), "error": d.get("error"), "cancel_requested": bool(d.get("cancel_requested")),
+             "created_by": d.get("created_by"), "created_at": d.get("created_at"), "started_at": d.get("started_at"), "finished_at": d.get("finished_at") }
+
+def change_to_dict(row):
+    return { "version": row["version"], "kind": row["kind"], "op": row["op"], "id": row["entity_id"],
+             "data": json.loads(row["data"]) if row["data"] else None, "at": row["created_at"] }
+
+def change_doc_to_dict(d):
+    return { "version": d["_id"], "kind": d.get("kind"), "op": d.get("op"), "id": d.get("entity_id"), "data": d.get("data"), "at": d.get("at") }
+
+def appointment_doc_to_dict(a, patients=None, doctors=None):
+    """With patients/doctors (id -> name) given, the names come from those instead of the document."""
+    pid, did = a.get("patient_id"), a.get("doctor_id")
+    return { "id": str(a.get("_id")), "patient_id": pid, "patient_name": a.get("patient_name","") if patients is None else patients.get(pid, ""),
+             "doctor_id": did, "doctor_name": a.get("doctor_name","") if doctors is None else doctors.get(did, ""), "datetime": a.get("datetime",""), "created_at": a.get("created_at","") }
+
+def appointment_to_dict(row, patients=None, doctors=None):
+    return {
+        "id": row["id"],
+        "patient_id": row["patient_id"],
+        "patient_name": row["patient_name"] if patients is None else patients.get(row["patient_id"], ""),
+        "doctor_id": row["doctor_id"],
+        "doctor_name": row["doctor_name"] if doctors is None else doctors.get(row["doctor_id"], ""),
+        "datetime": row["datetime"],
+        "created_at": row["created_at"]
+    }
+
+# ---------- Search ----------
+# Typeahead search: every query token is a prefix match, all tokens must match.
+# Results whose name starts with the query come first (rank 0, then rank 1).
+# SQLite uses external-content FTS5 tables kept in sync by triggers and orders
+# each rank by bm25 with name weighted highest. Mongo text indexes can't match
+# prefixes, so each document carries a lowercase token array (_search,
+# multikey-indexed) and a normalized name (_name) that orders each rank.
+SEARCH_FIELDS = {
+    "patients": ("patient", ("name", "contact", "address")),
+    "doctors": ("doctor", ("name", "specialty", "contact")),
+    "users": ("user", ("name", "email")),
+}
+SEARCH_MAX_TOKENS = 8
+
+def search_normalize(text):
+    """Casefold and strip diacritics, matching FTS5's unicode61 remove_diacritics tokenizer."""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    return "".join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+
+def search_tokens(text):
+    return re.findall(r"\w+", search_normalize(text))
+
+def search_args():
+    q = (request.args.get('q') or '').strip()
+    tokens = search_tokens(q)[:SEARCH_MAX_TOKENS]
+    if not tokens:
+        raise ApiError("q required")
+    limit, after = page_args()
+    return q, tokens, limit or SEARCH_LIMIT, after
+
+def with_search_fields(kind, doc):
+    """Add the Mongo search keys (_search tokens and _name) for a patients/doctors/users document."""
+    _, fields = SEARCH_FIELDS[kind]
+    doc["_search"] = sorted({t for f in fields for t in search_tokens(doc.get(f))})
+    doc["_name"] = search_normalize(doc.get("name"))
+    return doc
+
+@contextmanager
+def deferred_search_index(cur, table):
+    """Index rows inserted inside the block with one INSERT ... SELECT instead of a trigger call per row.
+
+    Must run inside the caller's write transaction: the marker row that disables the
+    trigger is removed again before commit, so no other connection ever sees it.
+    """
+    fields = next((f for t, f in SEARCH_FIELDS.values() if t == table), None)
+    if fields is None:
+        yield
+        return
+    cols = ", ".join(fields)
+    start = cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    cur.execute("INSERT INTO search_bulk_load(name) VALUES(?)", (table,))
+    yield
+    cur.execute("DELETE FROM search_bulk_load WHERE name = ?", (table,))
+    cur.execute(f"INSERT INTO {table}_fts(rowid, {cols}) SELECT id, {cols} FROM {table} WHERE id > ?", (start,))
+
+def init_mongo_search(batch_size=1000):
+    """Backfill search keys on documents written before search existed."""
+    for kind, (_, fields) in SEARCH_FIELDS.items():
+        coll = getattr(db, kind)
+        ops = []
+        for d in coll.find({"_search": {"$exists": False}}, {f: 1 for f in fields}):
+            keys = with_search_fields(kind, {f: d.get(f) for f in fields})
+            ops.append(UpdateOne({"_id": d["_id"]}, {"$set": {"_search": keys["_search"], "_name": keys["_name"]}}))
+            if len(ops) >= batch_size:
+                coll.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            coll.bulk_write(ops, ordered=False)
+
+# ---------- Password hashing ----------
+class PasswordHasher:
+    """Runs PBKDF2 hashing/verification in a bounded process pool so logins don't starve request threads."""
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # Gunicorn workers are threaded by the time the first login arrives; forking
+                # a multithreaded process can copy locks held by other threads, so spawn instead.
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"))
+            return self._executor
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ApiError("server busy, try again", 503)
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # A hash keeps running after its request gives up waiting, so it keeps its slot until it's done.
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise ApiError("server busy, try again", 503)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("hms_password_hash_seconds", (("op", fn.__name__),), elapsed)
+            record_phase("hash", elapsed)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+hasher = PasswordHasher()
+
+# ---------- Sessions ----------
+# A login returns a signed token naming a session id; the id maps to the user in
+# an in-process TTL cache, so authenticated requests cost a signature check and
+# a dict lookup. A cache miss (restart, another worker) reloads the user by id.
+class SessionStore:
+    def __init__(self, ttl=SESSION_CACHE_TTL, max_entries=SESSION_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                del self._entries[sid]
+                return None
+            return entry
+
+    def put(self, sid, user):
+        with self._lock:
+            self._entries[sid] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def revoke(self, sid):
+        # Keep a tombstone so a cache miss can't resurrect the session from the user table.
+        self.put(sid, None)
+
+    def forget_user(self, uid):
+        with self._lock:
+            for sid in [k for k, (u, _) in self._entries.items() if u and str(u["id"]) == str(uid)]:
+                del self._entries[sid]
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._entries), "ttl": self.ttl, "max_entries": self.max_entries}
+
+sessions = SessionStore()
+session_signer = URLSafeTimedSerializer(app.secret_key, salt='hms-session')
+
+def issue_session(user):
+    sid = secrets.token_urlsafe(16)
+    sessions.put(sid, user)
+    return session_signer.dumps({"sid": sid, "uid": user["id"]})
+
+def _load_user(uid):
+    users = repos().users
+    try:
+        return users.get(users.parse_id(uid))
+    except ApiError:
+        return None
+
+def session_token():
+    auth = request.headers.get('Authorization', '')
+    return auth[7:].strip() if auth[:7].lower() == 'bearer ' else None
+
+def current_user():
+    token = session_token()
+    if not token:
+        return None
+    try:
+        data = session_signer.loads(token, max_age=SESSION_TTL)
+    except BadSignature:
+        return None
+    entry = sessions.get(data["sid"])
+    if entry is not None:
+        return entry[0]
+    if repos().users.session_revoked(data["sid"]):
+        sessions.revoke(data["sid"])
+        return None
+    user = _load_user(data["uid"])
+    if user:
+        sessions.put(data["sid"], user)
+    return user
+
+def require_auth(admin=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user = current_user()
+            if not user:
+                return jsonify({"error": "authentication required"}), 401
+            if admin and not user.get("is_admin"):
+                return jsonify({"error": "admin only"}), 403
+            g.user = user
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ---------- Response cache ----------
+class ResponseCache:
+    """Size-bounded LRU of serialized GET responses keyed on (route, query, table versions)."""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES, max_entries=RESPONSE_CACHE_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, headers):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (body, headers)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries), "bytes": self._bytes,
+                "max_entries": self.max_entries, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+response_cache = ResponseCache()
+CACHED_HEADERS = ('Content-Type', 'X-Next-Cursor', 'Link')
+
+def table_versions(names):
+    """Current (version, updated_at) per table, read before the data so a cached body is never older than its key."""
+    if use_mongo:
+        doc = db.counters.find_one({"_id": "versions"}) or {}
+        return {n: (doc.get(n, 0), doc.get(f"{n}_at")) for n in names}
+    rows = get_conn().execute(f"SELECT name, version, updated_at FROM table_version WHERE name IN ({','.join('?' * len(names))})", names).fetchall()
+    return {r["name"]: (r["version"], r["updated_at"]) for r in rows}
+
+def versioned(*tables):
+    """Serve a GET list route with ETag/Last-Modified validators and the in-process response cache."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if stream_format():
+                return view(*args, **kwargs)
+            versions = table_versions(list(tables))
+            key = (request.path, request.query_string, tuple(versions.get(t, (0, None)) for t in tables))
+            etag = hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()
+            stamps = [datetime.fromisoformat(at) for _, at in versions.values() if at]
+            modified = max(stamps).replace(microsecond=0) if stamps else None
+            if request.if_none_match.contains(etag) or (
+                    not request.if_none_match and modified and request.if_modified_since and modified <= request.if_modified_since):
+                resp = Response(status=304)
+            else:
+                cached = response_cache.get(key)
+                if cached is not None:
+                    resp = Response(cached[0], headers=cached[1])
+                else:
+                    resp = app.make_response(view(*args, **kwargs))
+                    if resp.status_code == 200 and not resp.is_streamed:
+                        response_cache.put(key, resp.get_data(), [(h, resp.headers[h]) for h in CACHED_HEADERS if h in resp.headers])
+                    elif resp.status_code != 200:
+                        return resp
+            resp.set_etag(etag)
+            if modified:
+                resp.last_modified = modified
+            resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+        return wrapper
+    return decorator
+
+# ---------- Name index ----------
+# Appointment listings read only the appointment rows and fill in the patient and
+# doctor names from an in-process id -> name index per kind. Names never change
+# and ids are never reused, so an entry is right for as long as its row exists and
+# the index only has to learn about new rows. It loads on first use into sorted
+# NumPy ids, name offsets and lengths plus one UTF-8 blob (about 20 bytes per entry
+# on top of the name itself). Creates and deletes in this process go into a small
+# dict that is folded into the arrays every MERGE_AT changes, ids it doesn't know
+# (rows added by other workers) are fetched from the database and remembered, and
+# bulk writes drop the index so it reloads. Without numpy the index is a dict.
+class NameIndex:
+    MERGE_AT = 4096
+
+    def __init__(self, source):
+        self.source = source
+        self._lock = threading.Lock()
+        self._base = None
+        self._recent = {}
+        self._gone = set()
+        self.loaded = False
+        self.hits = self.misses = 0
+
+    def _encode(self, ids, names):
+        encoded = [n.encode() for n in names]
+        return self.source.name_keys(ids), np.fromiter(map(len, encoded), dtype=np.int32, count=len(encoded)), b"".join(encoded)
+
+    def _pack(self, pieces, base=None):
+        """Sorted (keys, starts, lengths, blob) of the encoded pieces, appended to base if given."""
+        blob = base[3] if base else b""
+        keys = np.concatenate([self.source.name_keys([])] + [k for k, _, _ in pieces])
+        lens = np.concatenate([np.zeros(0, dtype=np.int32)] + [n for _, n, _ in pieces])
+        starts = len(blob) + np.cumsum(lens, dtype=np.int64) - lens
+        blob = b"".join([blob] + [b for _, _, b in pieces])
+        if base:
+            keys, starts, lens = (np.concatenate(pair) for pair in zip(base[:3], (keys, starts, lens)))
+        if len(keys) > 1 and not (keys[:-1] < keys[1:]).all():
+            order = np.argsort(keys, kind="stable")
+            keys, starts, lens = keys[order], starts[order], lens[order]
+        return keys, starts, lens, blob
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return
+            if HAVE_NUMPY:
+                self._base = self._pack([self._encode(ids, names) for ids, names in self.source.name_chunks()])
+            else:
+                self._recent = {i: n for ids, names in self.source.name_chunks() for i, n in zip(ids, names)}
+            self.loaded = True
+
+    def _merge(self):
+        keys, starts, lens, blob = self._base
+        keep = ~np.isin(keys, self.source.name_keys(list(self._gone.union(self._recent))))
+        keys, starts, lens = keys[keep], starts[keep], lens[keep]
+        if len(blob) > 2 * int(lens.sum()) + (1 << 20):
+            # Mostly deleted names by now: copy the live ones into a fresh blob.
+            blob = b"".join(blob[a:a + n] for a, n in zip(starts.tolist(), lens.tolist()))
+            starts = np.cumsum(lens, dtype=np.int64) - lens
+        self._base = self._pack([self._encode(list(self._recent), list(self._recent.values()))], (keys, starts, lens, blob))
+        self._recent, self._gone = {}, set()
+
+    def _patch(self, names=None, gone=()):
+        if names:
+            self._recent.update(names)
+            self._gone.difference_update(names)
+        if gone:
+            for i in gone:
+                self._recent.pop(i, None)
+            if HAVE_NUMPY:
+                self._gone.update(gone)
+        if HAVE_NUMPY and len(self._recent) + len(self._gone) >= self.MERGE_AT:
+            self._merge()
+
+    def add(self, i, name):
+        with self._lock:
+            if self.loaded:
+                self._patch(names={i: name})
+
+    def discard(self, i):
+        with self._lock:
+            if self.loaded:
+                self._patch(gone=(i,))
+
+    def lookup(self, ids):
+        """Names for a set of ids; ids missing from the index are read from the database."""
+        if not self.loaded:
+            self.load()
+        found, rest = {}, []
+        with self._lock:
+            base, recent, gone = self._base, self._recent, self._gone
+            if not recent and not gone:
+                rest = [i for i in ids if i is not None]
+            else:
+                for i in ids:
+                    name = recent.get(i)
+                    if name is not None:
+                        found[i] = name
+                    elif i is not None and i not in gone:
+                        rest.append(i)
+        if rest and base is not None and len(base[0]):
+            keys, starts, lens, blob = base
+            want = self.source.name_keys(rest)
+            pos = np.minimum(np.searchsorted(keys, want), len(keys) - 1)
+            hit = keys[pos] == want
+            missing = []
+            if not hit.all():
+                missing = [i for i, h in zip(rest, hit.tolist()) if not h]
+                rest, pos = [i for i, h in zip(rest, hit.tolist()) if h], pos[hit]
+            found.update(zip(rest, [blob[a:a + n].decode() for a, n in zip(starts[pos].tolist(), lens[pos].tolist())]))
+            rest = missing
+        fetched = self.source.names(rest) if rest else {}
+        # Request threads share the index, so the counters only change under the lock.
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(rest)
+            if fetched and self.loaded:
+                self._patch(names=fetched)
+        found.update(fetched)
+        return found
+
+    def stats(self):
+        with self._lock:
+            base = self._base
+            packed = sum(a.nbytes for a in base[:3]) + len(base[3]) if base is not None else 0
+            overlay = sys.getsizeof(self._recent) + sum(sys.getsizeof(i) + sys.getsizeof(n) for i, n in self._recent.items())
+            return {"loaded": int(self.loaded), "entries": (len(base[0]) if base is not None else 0) + len(self._recent),
+                    "bytes": packed + overlay, "hits": self.hits, "misses": self.misses}
+
+name_indexes = {}
+
+def name_index(kind):
+    r = repos()
+    index = name_indexes.get((r, kind))
+    if index is None:
+        index = name_indexes.setdefault((r, kind), NameIndex(getattr(r, kind)))
+    return index
+
+def drop_name_indexes(kinds):
+    for key in list(name_indexes):
+        if key[1] in kinds:
+            name_indexes.pop(key, None)
+
+def with_names(records, to_dict):
+    """Appointment dicts for raw rows or documents, with the names taken from the name indexes."""
+    records = list(records)
+    patients = name_index("patients").lookup({r["patient_id"] for r in records})
+    doctors = name_index("doctors").lookup({r["doctor_id"] for r in records})
+    return [to_dict(r, patients, doctors) for r in records]
+
+def stream_with_names(records, to_dict):
+    batch = []
+    for r in records:
+        batch.append(r)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield from with_names(batch, to_dict)
+            batch = []
+    if batch:
+        yield from with_names(batch, to_dict)
+
+# ---------- Repositories ----------
+# Every entity has a SQLite and a Mongo repository with the same methods; routes
+# go through repos() and never branch on the backend themselves. A find() takes
+# the page limit to fetch (the route asks for one extra row to detect a next
+# page) and returns a list, or a lazy iterator when stream=True.
+class SqliteRepo:
+    @staticmethod
+    def parse_id(value, name="id"):
+        return int_arg(value, name)
+
+    @staticmethod
+    def _select(sql, where, params, order, limit, stream, to_dict):
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY " + order
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        if stream:
+            return stream_rows(sql, params, to_dict)
+        return [to_dict(r) for r in get_conn().execute(sql, params).fetchall()]
+
+    @staticmethod
+    def _purge(table, fk, counter, size):
+        """Delete up to size rows of table, and their appointments, in one short transaction."""
+        conn = get_conn()
+        cur = conn.cursor()
+        # The write lock is taken before the counts are read, so no booking can land between them and the DELETE.
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [r[0] for r in cur.execute(f"SELECT id FROM {table} ORDER BY id LIMIT ?", (size,)).fetchall()]
+            if not ids:
+                conn.commit()
+                return 0
+            marks = ','.join('?' * len(ids))
+            hours = appointment_hours(cur, f"{fk} IN ({marks})", ids)
+            removed = cur.execute(f"DELETE FROM appointment WHERE {fk} IN ({marks})", ids).rowcount
+            deleted = cur.execute(f"DELETE FROM {table} WHERE id IN ({marks})", ids).rowcount
+            bump_counters(cur, hours=hours, appointments=-removed, **{counter: -deleted})
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        return deleted
+
+    @staticmethod
+    def _search(kind, columns, to_dict, q, tokens, after, limit):
+        # Tier 0: name starts with the query, walked in (name, id) order off the NOCASE name index.
+        # Tier 1: every other FTS match ranked by bm25, which has to score and sort all of them,
+        # so when a query matches more than SEARCH_RANK_WINDOW rows they come back as tier 2
+        # instead, in rowid order straight off the index. The cursor is (tier, key, id).
+        table, fields = SEARCH_FIELDS[kind]
+        weights = ", ".join("10.0" if f == "name" else "1.0" for f in fields)
+        starts = "t.name >= ? COLLATE NOCASE AND t.name < ? COLLATE NOCASE"
+        bounds = [q, q + "\U0010ffff"]
+        match = " ".join(f'"{t}"*' for t in tokens)
+        tier, last = 0, None
+        if after:
+            tier, key, last_id = decode_cursor(after, 3)
+            try:
+                tier = int(tier)
+                last = (key if tier == 0 else float(key), int_arg(last_id, "cursor"))
+            except ValueError:
+                raise ApiError("invalid cursor")
+        items = []
+        while tier <= 2 and (limit is None or len(items) < limit):
+            want = None if limit is None else limit - len(items)
+            if tier == 0:
+                where, params = [starts], list(bounds)
+                if last:
+                    where.append("(t.name > ? COLLATE NOCASE OR (t.name = ? COLLATE NOCASE AND t.id > ?))")
+                    params.extend([last[0], last[0], last[1]])
+                sql, order = f"SELECT {columns}, NULL AS score FROM {table} t", "t.name COLLATE NOCASE, t.id"
+            elif tier == 1 and last is None and get_conn().execute(
+                    f"SELECT count(*) FROM (SELECT 1 FROM {table}_fts WHERE {table}_fts MATCH ? LIMIT ?)",
+                    (match, SEARCH_RANK_WINDOW + 1)).fetchone()[0] > SEARCH_RANK_WINDOW:
+                tier = 2
+                continue
+            else:
+                where, params = [f"{table}_fts MATCH ?", f"NOT ({starts})"], [match] + bounds
+                if tier == 1:
+                    sql, order = f"SELECT {columns}, bm25({table}_fts, {weights}) AS score", "score, t.id"
+                    if last:
+                        where.append("(score, t.id) > (?, ?)")
+                        params.extend(last)
+                else:
+                    sql, order = f"SELECT {columns}, NULL AS score", f"{table}_fts.rowid"
+                    if last:
+                        where.append(f"{table}_fts.rowid > ?")
+                        params.append(last[1])
+                sql += f" FROM {table}_fts JOIN {table} t ON t.id = {table}_fts.rowid"
+            rows = SqliteRepo._select(sql, where, params, order, want, False, lambda r: r)
+            items.extend(dict(to_dict(r), rank=tier, score=r["score"]) for r in rows)
+            tier, last = (3 if tier else 1), None
+        return items
+
+    @staticmethod
+    def search_cursor(item):
+        return encode_cursor(item["rank"], item["name"] if item["rank"] == 0 else item["score"] or 0, item["id"])
+
+    # Name index sources (see NameIndex). Streamed listings resolve names after the
+    # request has ended, and an atomic batch's uncommitted rows must not be cached,
+    # so both read through a connection of their own.
+    @staticmethod
+    def name_keys(ids):
+        return np.asarray(ids, dtype=np.int64)
+
+    @staticmethod
+    @contextmanager
+    def _name_reader():
+        conn = g.get('db_conn') if has_app_context() else None
+        if conn is not None and not conn.held:
+            yield conn
+        else:
+            with pool.connection() as conn:
+                yield conn
+
+    @staticmethod
+    def _name_chunks(table, size):
+        with SqliteRepo._name_reader() as conn:
+            cur = conn.execute(f"SELECT id, name FROM {table} ORDER BY id")
+            while True:
+                rows = cur.fetchmany(size)
+                if not rows:
+                    break
+                yield [r[0] for r in rows], [r[1] for r in rows]
+
+    @staticmethod
+    def _names(table, ids):
+        ids = list(ids)
+        found = {}
+        with SqliteRepo._name_reader() as conn:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                found.update(conn.execute(f"SELECT id, name FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+        return found
+
+class MongoRepo:
+    @staticmethod
+    def parse_id(value, name="id"):
+        object_id_arg(value, name)
+        return str(value)
+
+    @staticmethod
+    def _find(coll, q, projection, sort, limit, stream, to_dict):
+        cur = coll.find(q, projection).sort(sort)
+        if limit is not None:
+            cur = cur.limit(limit)
+        if stream:
+            return map(to_dict, cur.batch_size(STREAM_BATCH_SIZE))
+        return [to_dict(d) for d in cur]
+
+    @staticmethod
+    def _purge(coll, fk, counter, size):
+        ids = [d["_id"] for d in coll.find({}, {"_id": 1}).sort("_id").limit(size)]
+        if not ids:
+            return 0
+        match = {fk: {"$in": [str(i) for i in ids]}}
+        hours = mongo_appointment_hours(match)
+        removed = db.appointments.delete_many(match).deleted_count
+        deleted = coll.delete_many({"_id": {"$in": ids}}).deleted_count
+        bump_mongo_counters(hours=hours, appointments=-removed, **{counter: -deleted})
+        return deleted
+
+    @staticmethod
+    def _search(coll, projection, to_dict, q, tokens, after, limit):
+        # Tier 0: name starts with the whole query; tier 1: every other match. Each tier is
+        # walked in (_name, _id) order, so the cursor is (tier, _name, _id).
+        starts = re.compile("^" + re.escape(search_normalize(q)))
+        match = [{"_search": {"$regex": "^" + re.escape(t)}} for t in tokens]
+        first_tier, last = 0, None
+        if after:
+            tier, last_name, last_id = decode_cursor(after, 3)
+            first_tier, last = int_arg(tier, "cursor"), (last_name, object_id_arg(last_id, "cursor"))
+        items = []
+        for tier in range(first_tier, 2):
+            cond = match + [{"_name": starts} if tier == 0 else {"_name": {"$not": starts}}]
+            if last and tier == first_tier:
+                cond.append({"$or": [{"_name": {"$gt": last[0]}}, {"_name": last[0], "_id": {"$gt": last[1]}}]})
+            cur = coll.find({"$and": cond}, projection).sort([("_name", 1), ("_id", 1)])
+            if limit is not None:
+                cur = cur.limit(limit - len(items))
+            items.extend(dict(to_dict(d), rank=tier) for d in cur)
+            if limit is not None and len(items) >= limit:
+                break
+        return items
+
+    @staticmethod
+    def search_cursor(item):
+        return encode_cursor(item["rank"], search_normalize(item["name"]), item["id"])
+
+    @staticmethod
+    def name_keys(ids):
+        return np.array([bytes.fromhex(i) for i in ids], dtype="S12")
+
+    @staticmethod
+    def _name_chunks(coll, size):
+        ids, names = [], []
+        for d in coll.find({}, {"name": 1}).sort("_id").batch_size(size):
+            ids.append(str(d["_id"]))
+            names.append(d.get("name", ""))
+            if len(ids) >= size:
+                yield ids, names
+                ids, names = [], []
+        if ids:
+            yield ids, names
+
+    @staticmethod
+    def _names(coll, ids):
+        return {str(d["_id"]): d.get("name", "") for d in coll.find({"_id": {"$in": [ObjectId(i) for i in ids]}}, {"name": 1})}
+
+class SqlitePatientRepo(SqliteRepo):
+    def find(self, after=None, limit=None, stream=False):
+        where, params = [], []
+        if after:
+            where.append("id > ?")
+            params.append(int_arg(after, "cursor"))
+        return self._select("SELECT id, name, age, contact, address, created_at FROM patient", where, params, "id", limit, stream, patient_to_dict)
+
+    def search(self, q, tokens, after=None, limit=None):
+        return self._search("patients", "t.id, t.name, t.age, t.contact, t.address, t.created_at", patient_to_dict, q, tokens, after, limit)
+
+    def create(self, name, age, contact, address):
+        conn = get_conn()
+        cur = conn.cursor()
+        now = datetime.utcnow().isoformat()
+        cur.execute("INSERT INTO patient(name, age, contact, address, created_at) VALUES(?,?,?,?,?)", (name, age, contact, address, now))
+        new_id = cur.lastrowid
+        bump_counters(cur, patients=1)
+        log_changes(cur, "patients", "create", [(new_id, {"id": new_id, "name": name, "age": age, "contact": contact, "address": address, "created_at": now})])
+        conn.commit()
+        if not conn.held:
+            name_index("patients").add(new_id, name)
+        return new_id
+
+    def delete(self, pid):
+        conn = get_conn()
+        cur = conn.cursor()
+        # Lock first (see _purge): a booking committed after the count would be deleted but never subtracted.
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            hours = appointment_hours(cur, "patient_id = ?", (pid,))
+            removed = cur.execute("DELETE FROM appointment WHERE patient_id = ?", (pid,)).rowcount
+            deleted = cur.execute("DELETE FROM patient WHERE id = ?", (pid,)).rowcount
+            bump_counters(cur, hours=hours, patients=-deleted, appointments=-removed)
+            # Clients drop the patient's appointments along with it; they get no events of their own.
+            log_changes(cur, "patients", "delete", [(pid, None)] if deleted else [])
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        if not conn.held:
+            name_index("patients").discard(pid)
+        return deleted
+
+    def name_chunks(self, size=100000):
+        return self._name_chunks("patient", size)
+
+    def names(self, ids):
+        return self._names("patient", ids)
+
+    def delete_batch(self, size):
+        return self._purge("patient", "patient_id", "patients", size)
+
+class MongoPatientRepo(MongoRepo):
+    def find(self, after=None, limit=None, stream=False):
+        q = {}
+        if after:
+            q["_id"] = {"$gt": object_id_arg(after, "cursor")}
+        return self._find(db.patients, q, {"name":1,"age":1,"contact":1,"address":1,"created_at":1}, "_id", limit, stream, patient_doc_to_dict)
+
+    def search(self, q, tokens, after=None, limit=None):
+        return self._search(db.patients, {"name":1,"age":1,"contact":1,"address":1,"created_at":1}, patient_doc_to_dict, q, tokens, after, limit)
+
+    def create(self, name, age, contact, address):
+        doc = {"name": name, "age": age, "contact": contact, "address": address, "created_at": datetime.utcnow().isoformat()}
+        new_id = str(db.patients.insert_one(with_search_fields("patients", doc)).inserted_id)
+        bump_mongo_counters(patients=1)
+        log_mongo_changes("patients", "create", [(new_id, patient_doc_to_dict(doc))])
+        name_index("patients").add(new_id, name)
+        return new_id
+
+    def delete(self, pid):
+        hours = mongo_appointment_hours({"patient_id": pid})
+        removed = db.appointments.delete_many({"patient_id": pid}).deleted_count
+        deleted = db.patients.delete_one({"_id": ObjectId(pid)}).deleted_count
+        bump_mongo_counters(hours=hours, patients=-deleted, appointments=-removed)
+        log_mongo_changes("patients", "delete", [(pid, None)] if deleted else [])
+        name_index("patients").discard(pid)
+        return deleted
+
+    def name_chunks(self, size=100000):
+        return self._name_chunks(db.patients, size)
+
+    def names(self, ids):
+        return self._names(db.patients, ids)
+
+    def delete_batch(self, size):
+        return self._purge(db.patients, "patient_id", "patients", size)
+
+class SqliteDoctorRepo(SqliteRepo):
+    def find(self, after=None, specialty=None, ids=None, limit=None, stream=False):
+        where, params = [], []
+        if after:
+            where.append("id > ?")
+            params.append(int_arg(after, "cursor"))
+        if specialty:
+            where.append("specialty = ?")
+            params.append(specialty)
+        if ids:
+            where.append(f"id IN ({','.join('?' * len(ids))})")
+            params.extend(ids)
+        return self._select("SELECT id, name, specialty, contact FROM doctor", where, params, "id", limit, stream, doctor_to_dict)
+
+    def search(self, q, tokens, after=None, limit=None):
+        return self._search("doctors", "t.id, t.name, t.specialty, t.contact", doctor_to_dict, q, tokens, after, limit)
+
+    def exists(self, did):
+        return get_conn().execute("SELECT 1 FROM doctor WHERE id = ?", (did,)).fetchone() is not None
+
+    def create(self, name, specialty, contact):
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute("INSERT INTO doctor(name, specialty, contact, created_at) VALUES(?,?,?,?)", (name, specialty, contact, datetime.utcnow().isoformat()))
+        new_id = cur.lastrowid
+        bump_counters(cur, doctors=1)
+        log_changes(cur, "doctors", "create", [(new_id, {"id": new_id, "name": name, "specialty": specialty, "contact": contact})])
+        conn.commit()
+        if not conn.held:
+            name_index("doctors").add(new_id, name)
+        return new_id
+
+    def delete(self, did):
+        conn = get_conn()
+        cur = conn.cursor()
+        # Lock first (see _purge): a booking committed after the count would be deleted but never subtracted.
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            hours = appointment_hours(cur, "doctor_id = ?", (did,))
+            removed = cur.execute("DELETE FROM appointment WHERE doctor_id = ?", (did,)).rowcount
+            deleted = cur.execute("DELETE FROM doctor WHERE id = ?", (did,)).rowcount
+            bump_counters(cur, hours=hours, doctors=-deleted, appointments=-removed)
+            log_changes(cur, "doctors", "delete", [(did, None)] if deleted else [])
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        if not conn.held:
+            name_index("doctors").discard(did)
+        return deleted
+
+    def name_chunks(self, size=100000):
+        return self._name_chunks("doctor", size)
+
+    def names(self, ids):
+        return self._names("doctor", ids)
+
+    def delete_batch(self, size):
+        return self._purge("doctor", "doctor_id", "doctors", size)
+
+class MongoDoctorRepo(MongoRepo):
+    def find(self, after=None, specialty=None, ids=None, limit=None, stream=False):
+        q = {}
+        if after:
+            q["_id"] = {"$gt": object_id_arg(after, "cursor")}
+        if specialty:
+            q["specialty"] = specialty
+        if ids:
+            q.setdefault("_id", {})["$in"] = [ObjectId(x) for x in ids]
+        return self._find(db.doctors, q, {"name":1,"specialty":1,"contact":1,"created_at":1}, "_id", limit, stream, doctor_doc_to_dict)
+
+    def search(self, q, tokens, after=None, limit=None):
+        return self._search(db.doctors, {"name":1,"specialty":1,"contact":1}, doctor_doc_to_dict, q, tokens, after, limit)
+
+    def exists(self, did):
+        return db.doctors.find_one({"_id": ObjectId(did)}, {"_id": 1}) is not None
+
+    def create(self, name, specialty, contact):
+        doc = {"name": name, "specialty": specialty, "contact": contact, "created_at": datetime.utcnow().isoformat()}
+        new_id = str(db.doctors.insert_one(with_search_fields("doctors", doc)).inserted_id)
+        bump_mongo_counters(doctors=1)
+        log_mongo_changes("doctors", "create", [(new_id, doctor_doc_to_dict(doc))])
+        name_index("doctors").add(new_id, name)
+        return new_id
+
+    def delete(self, did):
+        hours = mongo_appointment_hours({"doctor_id": did})
+        removed = db.appointments.delete_many({"doctor_id": did}).deleted_count
+        deleted = db.doctors.delete_one({"_id": ObjectId(did)}).deleted_count
+        bump_mongo_counters(hours=hours, doctors=-deleted, appointments=-removed)
+        log_mongo_changes("doctors", "delete", [(did, None)] if deleted else [])
+        name_index("doctors").discard(did)
+        return deleted
+
+    def name_chunks(self, size=100000):
+        return self._name_chunks(db.doctors, size)
+
+    def names(self, ids):
+        return self._names(db.doctors, ids)
+
+    def delete_batch(self, size):
+        return self._purge(db.doctors, "doctor_id", "doctors", size)
+
+# Double-booking is prevented by the unique (doctor_id, datetime) and
+# (patient_id, datetime) indexes rather than by SELECT-then-INSERT, so the
+# check and the write cannot race.
+DOCTOR_CONFLICT = ("Doctor already booked at this time", 409)
+PATIENT_CONFLICT = ("Patient already has an appointment at this time", 409)
+
+def mongo_conflict(details, did, dt_str):
+    key = (details or {}).get('keyPattern')
+    if key:
+        return DOCTOR_CONFLICT if 'doctor_id' in key else PATIENT_CONFLICT
+    return DOCTOR_CONFLICT if db.appointments.find_one({"doctor_id": did, "datetime": dt_str}, {"_id": 1}) else PATIENT_CONFLICT
+
+class SqliteAppointmentRepo(SqliteRepo):
+    # Listings skip the joins and take the names from the name indexes.
+    LIST_SQL = "SELECT a.id, a.patient_id, a.doctor_id, a.datetime, a.created_at FROM appointment a"
+    NAMED_SQL = """
+        SELECT a.id, a.patient_id, a.doctor_id, a.datetime, a.created_at,
+               p.name AS patient_name, d.name AS doctor_name
+        FROM appointment a
+        JOIN patient p ON p.id = a.patient_id
+        JOIN doctor d ON d.id = a.doctor_id
+        """
+
+    def find(self, patient_id=None, doctor_id=None, dt_from=None, dt_to=None, after=None, limit=None, stream=False):
+        where, params = [], []
+        if patient_id:
+            where.append("a.patient_id = ?")
+            params.append(int_arg(patient_id, "patient_id"))
+        if doctor_id:
+            where.append("a.doctor_id = ?")
+            params.append(int_arg(doctor_id, "doctor_id"))
+        if dt_from:
+            where.append("a.datetime >= ?")
+            params.append(dt_from)
+        if dt_to:
+            where.append("a.datetime < ?")
+            params.append(dt_to)
+        if after:
+            last_dt, last_id = decode_cursor(after, 2)
+            where.append("(a.datetime, a.id) > (?, ?)")
+            params.extend([last_dt, int_arg(last_id, "cursor")])
+        rows = self._select(self.LIST_SQL, where, params, "a.datetime, a.id", limit, stream, lambda r: r)
+        return stream_with_names(rows, appointment_to_dict) if stream else with_names(rows, appointment_to_dict)
+
+    def booked_slots(self, doctor_ids, lo, hi):
+        conn = get_conn()
+        rows = []
+        # One (doctor_id, datetime) index range per doctor keeps each probe a covering seek.
+        for did in doctor_ids:
+            rows.extend(conn.execute("SELECT doctor_id, datetime FROM appointment WHERE doctor_id = ? AND datetime >= ? AND datetime < ?", (did, lo, hi)).fetchall())
+        return [(r[0], r[1]) for r in rows]
+
+    @staticmethod
+    def _book(cur, pid, did, dt_str):
+        """Insert one appointment inside the caller's transaction, raising ApiError(404/409) on failure."""
+        created_at = datetime.utcnow().isoformat()
+        try:
+            cur.execute(
+                """
+                INSERT INTO appointment(patient_id, doctor_id, datetime, created_at)
+                SELECT ?, ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM patient WHERE id = ?) AND EXISTS (SELECT 1 FROM doctor WHERE id = ?)
+                """, (pid, did, dt_str, created_at, pid, did))
+        except sqlite3.IntegrityError as e:
+            raise ApiError(*(DOCTOR_CONFLICT if "appointment.doctor_id" in str(e) else PATIENT_CONFLICT))
+        if cur.rowcount == 0:
+            if not cur.execute("SELECT 1 FROM patient WHERE id = ?", (pid,)).fetchone():
+                raise ApiError("Patient not found", 404)
+            raise ApiError("Doctor not found", 404)
+        new_id = cur.lastrowid
+        bump_counters(cur, hours=[((did, dt_str[:13]), 1)], appointments=1)
+        row = cur.execute(SqliteAppointmentRepo.NAMED_SQL + " WHERE a.id = ?", (new_id,)).fetchone()
+        log_changes(cur, "appointments", "create", [(new_id, appointment_to_dict(row))])
+        return new_id
+
+    def book(self, pid, did, dt_str):
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            new_id = self._book(cur, pid, did, dt_str)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        return new_id
+
+    def book_many(self, parsed, results, atomic):
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        created = []
+        try:
+            for i, (pid, did, dt_str) in parsed:
+                try:
+                    results[i] = {"index": i, "status": 201, "id": self._book(cur, pid, did, dt_str)}
+                    created.append(i)
+                except ApiError as e:
+                    results[i] = {"index": i, "status": e.status, "error": str(e)}
+                    if atomic:
+                        break
+            if atomic and len(created) < len(parsed):
+                conn.rollback()
+                return []
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return created
+
+    def delete(self, aid):
+        conn = get_conn()
+        cur = conn.cursor()
+        row = cur.execute("DELETE FROM appointment WHERE id = ? RETURNING doctor_id, datetime", (aid,)).fetchone()
+        if row:
+            bump_counters(cur, hours=hour_deltas([row], -1), appointments=-1)
+            log_changes(cur, "appointments", "delete", [(aid, None)])
+        conn.commit()
+        return 1 if row else 0
+
+    @staticmethod
+    def _owner(patient_id, doctor_id):
+        if patient_id is not None:
+            return " WHERE patient_id = ?", [patient_id]
+        if doctor_id is not None:
+            return " WHERE doctor_id = ?", [doctor_id]
+        return "", []
+
+    def count(self, patient_id=None, doctor_id=None):
+        where, params = self._owner(patient_id, doctor_id)
+        return get_conn().execute("SELECT COUNT(*) FROM appointment" + where, params).fetchone()[0]
+
+    def delete_batch(self, size, patient_id=None, doctor_id=None):
+        """Delete up to size appointments (all, or one patient's or doctor's) in one short transaction."""
+        where, params = self._owner(patient_id, doctor_id)
+        conn = get_conn()
+        cur = conn.cursor()
+        rows = cur.execute(f"DELETE FROM appointment WHERE id IN (SELECT id FROM appointment{where} LIMIT ?) RETURNING doctor_id, datetime", params + [size]).fetchall()
+        bump_counters(cur, hours=hour_deltas(rows, -1), appointments=-len(rows))
+        conn.commit()
+        return len(rows)
+
+class MongoAppointmentRepo(MongoRepo):
+    @staticmethod
+    def _query(patient_id=None, doctor_id=None, dt_from=None, dt_to=None, after=None):
+        q = {}
+        if patient_id:
+            q["patient_id"] = patient_id
+        if doctor_id:
+            q["doctor_id"] = doctor_id
+        if dt_from or dt_to:
+            q["datetime"] = {}
+            if dt_from:
+                q["datetime"]["$gte"] = dt_from
+            if dt_to:
+                q["datetime"]["$lt"] = dt_to
+        if after:
+            last_dt, last_id = decode_cursor(after, 2)
+            q["$or"] = [{"datetime": {"$gt": last_dt}}, {"datetime": last_dt, "_id": {"$gt": object_id_arg(last_id, "cursor")}}]
+        return q
+
+    def find(self, patient_id=None, doctor_id=None, dt_from=None, dt_to=None, after=None, limit=None, stream=False):
+        q = self._query(patient_id, doctor_id, dt_from, dt_to, after)
+        cur = db.appointments.find(q, {"patient_id":1,"doctor_id":1,"datetime":1,"created_at":1}).sort([("datetime", 1), ("_id", 1)])
+        if limit is not None:
+            cur = cur.limit(limit)
+        if stream:
+            return stream_with_names(cur.batch_size(STREAM_BATCH_SIZE), appointment_doc_to_dict)
+        return with_names(cur, appointment_doc_to_dict)
+
+    def booked_slots(self, doctor_ids, lo, hi):
+        cur = db.appointments.find({"doctor_id": {"$in": doctor_ids}, "datetime": {"$gte": lo, "$lt": hi}}, {"_id": 0, "doctor_id": 1, "datetime": 1})
+        return [(a["doctor_id"], a["datetime"]) for a in cur]
+
+    def book(self, pid, did, dt_str):
+        patient = db.patients.find_one({"_id": ObjectId(pid)}, {"name": 1})
+        if not patient:
+            raise ApiError("Patient not found", 404)
+        doctor = db.doctors.find_one({"_id": ObjectId(did)}, {"name": 1})
+        if not doctor:
+            raise ApiError("Doctor not found", 404)
+        doc = {"patient_id": pid, "doctor_id": did, "datetime": dt_str, "created_at": datetime.utcnow().isoformat()}
+        try:
+            db.appointments.insert_one(doc)
+        except DuplicateKeyError as e:
+            raise ApiError(*mongo_conflict(e.details, did, dt_str))
+        bump_mongo_counters(hours=[((did, dt_str[:13]), 1)], appointments=1)
+        log_mongo_changes("appointments", "create", [(str(doc["_id"]), appointment_doc_to_dict(dict(doc, patient_name=patient.get("name", ""), doctor_name=doctor.get("name", ""))))])
+        return str(doc["_id"])
+
+    def book_many(self, parsed, results, atomic):
+        pids = {ObjectId(p) for _, (p, _d, _t) in parsed}
+        dids = {ObjectId(d) for _, (_p, d, _t) in parsed}
+        found_p = {str(d["_id"]): d.get("name", "") for d in db.patients.find({"_id": {"$in": list(pids)}}, {"name": 1})}
+        found_d = {str(d["_id"]): d.get("name", "") for d in db.doctors.find({"_id": {"$in": list(dids)}}, {"name": 1})}
+        docs, slots = [], []
+        for i, (pid, did, dt_str) in parsed:
+            if pid not in found_p:
+                results[i] = {"index": i, "status": 404, "error": "Patient not found"}
+            elif did not in found_d:
+                results[i] = {"index": i, "status": 404, "error": "Doctor not found"}
+            else:
+                docs.append({"patient_id": pid, "doctor_id": did, "datetime": dt_str, "created_at": datetime.utcnow().isoformat()})
+                slots.append(i)
+        if not docs or (atomic and len(docs) < len(parsed)):
+            return []
+        failed = {}
+        try:
+            db.appointments.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get('writeErrors', []):
+                doc = docs[err['index']]
+                failed[err['index']] = mongo_conflict(err, doc["doctor_id"], doc["datetime"])
+        for j, i in enumerate(slots):
+            if j in failed:
+                error, status = failed[j]
+                results[i] = {"index": i, "status": status, "error": error}
+            else:
+                results[i] = {"index": i, "status": 201, "id": str(docs[j]["_id"])}
+        created = [docs[j] for j in range(len(docs)) if j not in failed]
+        if atomic and failed:
+            # No multi-document transactions without a replica set: undo the inserts instead.
+            db.appointments.delete_many({"_id": {"$in": [d["_id"] for d in created]}})
+            return []
+        bump_mongo_counters(hours=hour_deltas(created), appointments=len(created))
+        log_mongo_changes("appointments", "create", [(str(d["_id"]), appointment_doc_to_dict(
+            dict(d, patient_name=found_p[d["patient_id"]], doctor_name=found_d[d["doctor_id"]]))) for d in created])
+        return created
+
+    def delete(self, aid):
+        doc = db.appointments.find_one_and_delete({"_id": ObjectId(aid)}, {"doctor_id": 1, "datetime": 1})
+        if doc:
+            bump_mongo_counters(hours=hour_deltas([doc], -1), appointments=-1)
+            log_mongo_changes("appointments", "delete", [(aid, None)])
+        return 1 if doc else 0
+
+    @staticmethod
+    def _owner(patient_id, doctor_id):
+        if patient_id is not None:
+            return {"patient_id": patient_id}
+        if doctor_id is not None:
+            return {"doctor_id": doctor_id}
+        return {}
+
+    def count(self, patient_id=None, doctor_id=None):
+        return db.appointments.count_documents(self._owner(patient_id, doctor_id))
+
+    def delete_batch(self, size, patient_id=None, doctor_id=None):
+        docs = list(db.appointments.find(self._owner(patient_id, doctor_id), {"doctor_id": 1, "datetime": 1}).limit(size))
+        if not docs:
+            return 0
+        removed = db.appointments.delete_many({"_id": {"$in": [d["_id"] for d in docs]}}).deleted_count
+        bump_mongo_counters(hours=hour_deltas(docs, -1), appointments=-removed)
+        return removed
+
+class SqliteUserRepo(SqliteRepo):
+    def find(self, after=None, is_admin=None, limit=None, stream=False):
+        where, params = [], []
+        if after:
+            where.append("id > ?")
+            params.append(int_arg(after, "cursor"))
+        if is_admin is not None:
+            where.append("is_admin = ?")
+            params.append(is_admin)
+        return self._select("SELECT id, name, email, is_admin, created_at FROM user", where, params, "id", limit, stream, user_to_dict)
+
+    def search(self, q, tokens, after=None, limit=None):
+        return self._search("users", "t.id, t.name, t.email, t.is_admin, t.created_at", user_to_dict, q, tokens, after, limit)
+
+    def get(self, uid):
+        r = get_conn().execute("SELECT id, name, email, is_admin FROM user WHERE id = ?", (uid,)).fetchone()
+        return {"id": r["id"], "name": r["name"], "email": r["email"], "is_admin": int(r["is_admin"])} if r else None
+
+    def by_email(self, email):
+        """The user with this email including password_hash, or None."""
+        r = get_conn().execute("SELECT id, name, email, password_hash, is_admin FROM user WHERE email = ?", (email,)).fetchone()
+        return {"id": r["id"], "name": r["name"], "email": r["email"], "is_admin": int(r["is_admin"]), "password_hash": r["password_hash"]} if r else None
+
+    def email_exists(self, email):
+        return get_conn().execute("SELECT 1 FROM user WHERE email = ?", (email,)).fetchone() is not None
+
+    def admin_id(self):
+        row = get_conn().execute("SELECT id FROM user WHERE is_admin = 1 LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def create(self, name, email, password_hash, is_admin):
+        conn = get_conn()
+        cur = conn.cursor()
+        now = datetime.utcnow().isoformat()
+        try:
+            cur.execute("INSERT INTO user(name, email, password_hash, created_at, is_admin) VALUES(?,?,?,?,?)", (name, email, password_hash, now, is_admin))
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise ApiError("email already registered", 409)
+        new_id = cur.lastrowid
+        bump_counters(cur, users=1)
+        log_changes(cur, "users", "create", [(new_id, {"id": new_id, "name": name, "email": email, "is_admin": is_admin, "created_at": now})])
+        conn.commit()
+        return new_id
+
+    def set_admin(self, uid, is_admin):
+        conn = get_conn()
+        cur = conn.cursor()
+        row = cur.execute("UPDATE user SET is_admin = ? WHERE id = ? RETURNING id, name, email, is_admin, created_at", (is_admin, uid)).fetchone()
+        touch_tables(cur, "users")
+        log_changes(cur, "users", "update", [(uid, user_to_dict(row))] if row else [])
+        conn.commit()
+
+    def revoke_session(self, sid):
+        conn = get_conn()
+        now = datetime.now(timezone.utc)
+        conn.execute("DELETE FROM revoked_session WHERE expires_at < ?", (now.isoformat(),))
+        conn.execute("INSERT OR REPLACE INTO revoked_session(sid, expires_at) VALUES(?, ?)", (sid, (now + timedelta(seconds=SESSION_TTL)).isoformat()))
+        conn.commit()
+
+    def session_revoked(self, sid):
+        return get_conn().execute("SELECT 1 FROM revoked_session WHERE sid = ?", (sid,)).fetchone() is not None
+
+class MongoUserRepo(MongoRepo):
+    def find(self, after=None, is_admin=None, limit=None, stream=False):
+        q = {}
+        if after:
+            q["_id"] = {"$gt": object_id_arg(after, "cursor")}
+        if is_admin is not None:
+            q["is_admin"] = is_admin
+        return self._find(db.users, q, {"name":1,"email":1,"is_admin":1,"created_at":1}, "_id", limit, stream, user_doc_to_dict)
+
+    def search(self, q, tokens, after=None, limit=None):
+        return self._search(db.users, {"name":1,"email":1,"is_admin":1,"created_at":1}, user_doc_to_dict, q, tokens, after, limit)
+
+    def get(self, uid):
+        r = db.users.find_one({"_id": ObjectId(uid)}, {"name": 1, "email": 1, "is_admin": 1})
+        return {"id": str(r["_id"]), "name": r.get("name"), "email": r.get("email"), "is_admin": int(r.get("is_admin", 0))} if r else None
+
+    def by_email(self, email):
+        r = db.users.find_one({"email": email}, {"name": 1, "email": 1, "is_admin": 1, "password_hash": 1})
+        return {"id": str(r["_id"]), "name": r.get("name"), "email": r.get("email"), "is_admin": int(r.get("is_admin", 0)), "password_hash": r.get("password_hash", "")} if r else None
+
+    def email_exists(self, email):
+        return db.users.find_one({"email": email}, {"_id": 1}) is not None
+
+    def admin_id(self):
+        r = db.users.find_one({"is_admin": 1}, {"_id": 1})
+        return str(r["_id"]) if r else None
+
+    def create(self, name, email, password_hash, is_admin):
+        doc = {"name": name, "email": email, "password_hash": password_hash, "created_at": datetime.utcnow().isoformat(), "is_admin": is_admin}
+        try:
+            new_id = str(db.users.insert_one(with_search_fields("users", doc)).inserted_id)
+        except DuplicateKeyError:
+            raise ApiError("email already registered", 409)
+        bump_mongo_counters(users=1)
+        log_mongo_changes("users", "create", [(new_id, user_doc_to_dict(doc))])
+        return new_id
+
+    def set_admin(self, uid, is_admin):
+        doc = db.users.find_one_and_update({"_id": ObjectId(uid)}, {"$set": {"is_admin": is_admin}},
+                                           {"name": 1, "email": 1, "is_admin": 1, "created_at": 1}, return_document=ReturnDocument.AFTER)
+        touch_mongo_tables("users")
+        log_mongo_changes("users", "update", [(uid, user_doc_to_dict(doc))] if doc else [])
+
+    def revoke_session(self, sid):
+        # The TTL index on expires_at drops the entry once the token could no longer verify anyway.
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=SESSION_TTL)
+        db.revoked_sessions.update_one({"sid": sid}, {"$set": {"expires_at": expires_at}}, upsert=True)
+
+    def session_revoked(self, sid):
+        return db.revoked_sessions.find_one({"sid": sid}, {"_id": 1}) is not None
+
+JOB_COLUMNS = "id, kind, status, processed, total, result, error, cancel_requested, created_by, created_at, started_at, finished_at"
+
+class SqliteJobRepo(SqliteRepo):
+    def get(self, job_id):
+        row = get_conn().execute(f"SELECT {JOB_COLUMNS} FROM job WHERE id = ?", (job_id,)).fetchone()
+        return job_to_dict(row) if row else None
+
+    def create(self, kind, params, created_by=None):
+        job_id = secrets.token_hex(16)
+        conn = get_conn()
+        conn.execute("INSERT INTO job(id, kind, status, params, created_by, created_at) VALUES(?,?,?,?,?,?)",
+                     (job_id, kind, "queued", json.dumps(params), None if created_by is None else str(created_by), datetime.utcnow().isoformat()))
+        conn.commit()
+        return job_id
+
+    def start(self, job_id):
+        """Mark a queued job running; False if it was cancelled before a worker picked it up."""
+        conn = get_conn()
+        started = conn.execute("UPDATE job SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'",
+                               (datetime.utcnow().isoformat(), job_id)).rowcount
+        conn.commit()
+        return started == 1
+
+    def progress(self, job_id, step):
+        """Record a progress step; returns True once cancellation has been requested."""
+        conn = get_conn()
+        row = conn.execute("UPDATE job SET processed = ?, total = ?, result = ? WHERE id = ? RETURNING cancel_requested",
+                           (step.get("processed", 0), step.get("total"), json.dumps(step), job_id)).fetchone()
+        conn.commit()
+        return bool(row and row[0])
+
+    def finish(self, job_id, status, result=None, error=None):
+        conn = get_conn()
+        conn.execute("UPDATE job SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                     (status, json.dumps(result) if result is not None else None, error, datetime.utcnow().isoformat(), job_id))
+        conn.commit()
+
+    def cancel(self, job_id):
+        conn = get_conn()
+        conn.execute("""UPDATE job SET cancel_requested = 1,
+                               status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END,
+                               finished_at = CASE status WHEN 'queued' THEN ? ELSE finished_at END
+                        WHERE id = ? AND status IN ('queued', 'running')""", (datetime.utcnow().isoformat(), job_id))
+        conn.commit()
+        return self.get(job_id)
+
+    def abandon(self, error, ids=None):
+        """Fail unfinished jobs (all of them, or just ids) and drop finished ones older than JOB_RETENTION_DAYS."""
+        conn = get_conn()
+        now = datetime.utcnow()
+        where, params = "status IN ('queued', 'running')", [error, now.isoformat()]
+        if ids is not None:
+            ids = list(ids)
+            where += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        conn.execute(f"UPDATE job SET status = 'failed', error = ?, finished_at = ? WHERE {where}", params)
+        conn.execute("DELETE FROM job WHERE finished_at < ? AND status NOT IN ('queued', 'running')",
+                     ((now - timedelta(days=JOB_RETENTION_DAYS)).isoformat(),))
+        conn.commit()
+
+class MongoJobRepo(MongoRepo):
+    def get(self, job_id):
+        doc = db.jobs.find_one({"_id": job_id}, {"params": 0})
+        return job_doc_to_dict(doc) if doc else None
+
+    def create(self, kind, params, created_by=None):
+        job_id = secrets.token_hex(16)
+        db.jobs.insert_one({"_id": job_id, "kind": kind, "status": "queued", "params": params, "processed": 0, "total": None,
+                            "cancel_requested": False, "created_by": None if created_by is None else str(created_by),
+                            "created_at": datetime.utcnow().isoformat()})
+        return job_id
+
+    def start(self, job_id):
+        res = db.jobs.update_one({"_id": job_id, "status": "queued"}, {"$set": {"status": "running", "started_at": datetime.utcnow().isoformat()}})
+        return res.modified_count == 1
+
+    def progress(self, job_id, step):
+        doc = db.jobs.find_one_and_update({"_id": job_id}, {"$set": {"processed": step.get("processed", 0), "total": step.get("total"), "result": step}},
+                                          {"cancel_requested": 1})
+        return bool(doc and doc.get("cancel_requested"))
+
+    def finish(self, job_id, status, result=None, error=None):
+        db.jobs.update_one({"_id": job_id}, {"$set": {"status": status, "result": result, "error": error, "finished_at": datetime.utcnow().isoformat()}})
+
+    def cancel(self, job_id):
+        now = datetime.utcnow().isoformat()
+        db.jobs.update_one({"_id": job_id, "status": "queued"}, {"$set": {"status": "cancelled", "cancel_requested": True, "finished_at": now}})
+        db.jobs.update_one({"_id": job_id, "status": "running"}, {"$set": {"cancel_requested": True}})
+        return self.get(job_id)
+
+    def abandon(self, error, ids=None):
+        now = datetime.utcnow()
+        q = {"status": {"$in": ["queued", "running"]}}
+        if ids is not None:
+            q["_id"] = {"$in": list(ids)}
+        db.jobs.update_many(q, {"$set": {"status": "failed", "error": error, "finished_at": now.isoformat()}})
+        db.jobs.delete_many({"status": {"$nin": ["queued", "running"]}, "finished_at": {"$lt": (now - timedelta(days=JOB_RETENTION_DAYS)).isoformat()}})
+
+class SqliteChangeRepo(SqliteRepo):
+    def latest(self):
+        row = get_conn().execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+        return row[0] if row else 0
+
+    def since(self, version, kinds, limit):
+        """Events of these kinds after version, oldest first; reset=True when some of them were already trimmed."""
+        conn = get_conn()
+        latest = self.latest()
+        oldest = conn.execute("SELECT MIN(version) FROM change_log").fetchone()[0]
+        if version > latest or (oldest is not None and version < oldest - 1):
+            return {"version": latest, "changes": [], "more": False, "reset": True}
+        rows = conn.execute(f"""SELECT version, kind, op, entity_id, data, created_at FROM change_log
+                                WHERE version > ? AND version <= ? AND kind IN ({','.join('?' * len(kinds))})
+                                ORDER BY version LIMIT ?""", [version, latest, *kinds, limit]).fetchall()
+        more = len(rows) == limit
+        return {"version": rows[-1]["version"] if more else latest, "changes": [change_to_dict(r) for r in rows], "more": more, "reset": False}
+
+    def reset(self, kinds):
+        # Bulk writes also run outside any request (bench.py, `app.py seed`).
+        with held_conn() as conn:
+            cur = conn.cursor()
+            for kind in kinds:
+                log_changes(cur, kind, "reset", [(None, None)])
+            conn.commit()
+
+class MongoChangeRepo(MongoRepo):
+    # Versions are handed out before the event is inserted, so a concurrent writer can
+    # leave a hole that fills in a moment later. Readers stop at a hole until the
+    # events after it are this old, then treat it as a write that never finished.
+    gap_grace = timedelta(seconds=5)
+
+    def latest(self):
+        return (db.counters.find_one({"_id": "changes"}) or {}).get("version", 0)
+
+    def since(self, version, kinds, limit):
+        latest = self.latest()
+        first = db.changes.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+        if version > latest or (first is not None and version < first["_id"] - 1):
+            return {"version": latest, "changes": [], "more": False, "reset": True}
+        cutoff = (datetime.now(timezone.utc) - self.gap_grace).isoformat()
+        changes, last, seen = [], version, 0
+        for d in db.changes.find({"_id": {"$gt": version}}).sort("_id", 1).limit(limit):
+            if d["_id"] != last + 1 and d["at"] > cutoff:
+                break
+            last, seen = d["_id"], seen + 1
+            if d["kind"] in kinds:
+                changes.append(change_doc_to_dict(d))
+        return {"version": last, "changes": changes, "more": seen == limit, "reset": False}
+
+    def reset(self, kinds):
+        for kind in kinds:
+            log_mongo_changes(kind, "reset", [(None, None)])
+
+class SqliteAnalyticsRepo(SqliteRepo):
+    # Rollup rows are stamped inside the writer's transaction and SQLite commits
+    # one writer at a time, so nothing below a version seen once can show up later.
+    lag = 0
+
+    def rollup_since(self, version, size=100000):
+        """Yield the doctor_hour rows written after version as (doctor_ids, days, hours, totals) columns, size rows at a time."""
+        cur = get_conn().cursor()
+        cur.row_factory = None
+        cur.execute("SELECT doctor_id, day, hour, total FROM doctor_hour WHERE version > ?", (version,))
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                return
+            yield np.array(rows, dtype=np.int64).T
+
+class MongoAnalyticsRepo(MongoRepo):
+    # The appointments version is bumped before the rollup is written, so re-read
+    # this many versions back to pick up writers that were still in flight.
+    lag = 1000
+
+    def rollup_since(self, version, size=100000):
+        cols = ([], [], [], [])
+        for d in db.doctor_hours.find({"version": {"$gt": version}}, {"_id": 0, "doctor_id": 1, "day": 1, "hour": 1, "total": 1}).batch_size(10000):
+            for col, key in zip(cols, ("doctor_id", "day", "hour", "total")):
+                col.append(d[key])
+            if len(cols[0]) == size:
+                yield cols
+                cols = ([], [], [], [])
+        if cols[0]:
+            yield cols
+
+class SqliteRepos:
+    patients = SqlitePatientRepo()
+    doctors = SqliteDoctorRepo()
+    appointments = SqliteAppointmentRepo()
+    users = SqliteUserRepo()
+    jobs = SqliteJobRepo()
+    changes = SqliteChangeRepo()
+    analytics = SqliteAnalyticsRepo()
+
+    @staticmethod
+    def counts():
+        return {r["name"]: r["value"] for r in get_conn().execute("SELECT name, value FROM counter").fetchall()}
+
+class MongoRepos:
+    patients = MongoPatientRepo()
+    doctors = MongoDoctorRepo()
+    appointments = MongoAppointmentRepo()
+    users = MongoUserRepo()
+    jobs = MongoJobRepo()
+    changes = MongoChangeRepo()
+    analytics = MongoAnalyticsRepo()
+
+    @staticmethod
+    def counts():
+        return db.counters.find_one({"_id": "stats"}, {"_id": 0}) or {}
+
+def repos():
+    return MongoRepos if use_mongo else SqliteRepos
+
+def fetch_limit(limit, stream):
+    """Rows to ask a repository for: one extra on paged reads so paged_response can spot the next page."""
+    return limit if limit is None or stream else limit + 1
+
+# ---------- Availability ----------
+def _minutes(hhmm, name):
+    try:
+        h, m = hhmm.split(':')
+        value = int(h) * 60 + int(m)
+    except (AttributeError, ValueError):
+        raise ApiError(f"invalid {name}")
+    if not 0 <= value <= 24 * 60:
+        raise ApiError(f"invalid {name}")
+    return value
+
+def availability_args():
+    """Parse from/to (dates, to exclusive), slot (minutes) and start/end working hours."""
+    try:
+        first = datetime.strptime(request.args.get('from') or datetime.now().strftime("%Y-%m-%d"), "%Y-%m-%d").date()
+        last = datetime.strptime(request.args['to'], "%Y-%m-%d").date() if request.args.get('to') else first + timedelta(days=7)
+    except ValueError:
+        raise ApiError("invalid from/to date")
+    days = (last - first).days
+    if days < 1 or days > MAX_AVAILABILITY_DAYS:
+        raise ApiError(f"date range must be 1-{MAX_AVAILABILITY_DAYS} days")
+    slot = int_arg(request.args.get('slot', SLOT_MINUTES), "slot")
+    start = _minutes(request.args.get('start', WORK_START), "start")
+    end = _minutes(request.args.get('end', WORK_END), "end")
+    if slot < 5 or end <= start:
+        raise ApiError("invalid working hours or slot")
+    dates = [(first + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+    return dates, slot_times(start, end, slot), start, slot
+
+def slot_times(start, end, slot):
+    """HH:MM start times of the slot-minute slots between start and end (minutes after midnight)."""
+    return [f"{m // 60:02d}:{m % 60:02d}" for m in range(start, end - slot + 1, slot)]
+
+def booked_bitmaps(rows, dates, start, slot, nslots):
+    """Fold (doctor_id, datetime) rows into one int bitmap per doctor-day; bit i set = slot i is taken."""
+    day_index = {d: i for i, d in enumerate(dates)}
+    maps = {}
+    for did, dt in rows:
+        day = day_index.get(dt[:10])
+        if day is None:
+            continue
+        try:
+            idx = (int(dt[11:13]) * 60 + int(dt[14:16]) - start) // slot
+        except ValueError:
+            continue
+        if 0 <= idx < nslots:
+            maps[(did, day)] = maps.get((did, day), 0) | (1 << idx)
+    return maps
+
+def booked_rows(doctor_ids, dates):
+    lo, hi = dates[0], (datetime.strptime(dates[-1], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    return repos().appointments.booked_slots(doctor_ids, lo, hi)
+
+@app.route('/api/doctors/<did>/availability', methods=['GET'])
+def doctor_availability(did):
+    dates, times, start, slot = availability_args()
+    doctors = repos().doctors
+    did = doctors.parse_id(did)
+    if not doctors.exists(did):
+        return jsonify({"error":"Doctor not found"}), 404
+    maps = booked_bitmaps(booked_rows([did], dates), dates, start, slot, len(times))
+    days = []
+    for i, d in enumerate(dates):
+        bits = maps.get((did, i), 0)
+        days.append({"date": d, "booked": [t for j, t in enumerate(times) if bits >> j & 1], "free": [t for j, t in enumerate(times) if not bits >> j & 1]})
+    return jsonify({"doctor_id": did, "slot": slot, "times": times, "days": days})
+
+@app.route('/api/availability', methods=['GET'])
+def availability():
+    """Free doctors per slot across several doctors, e.g. ?specialty=Cardiology&from=...&to=..."""
+    dates, times, start, slot = availability_args()
+    specialty = request.args.get('specialty')
+    doctors = repos().doctors
+    ids = [doctors.parse_id(x, "doctor_id") for x in (request.args.get('doctor_id') or '').split(',') if x]
+    doctors = doctors.find(specialty=specialty, ids=ids)
+    doctor_ids = [d["id"] for d in doctors]
+    maps = booked_bitmaps(booked_rows(doctor_ids, dates), dates, start, slot, len(times)) if doctor_ids else {}
+    days = []
+    for i, d in enumerate(dates):
+        free = {}
+        for j, t in enumerate(times):
+            ids_free = [did for did in doctor_ids if not maps.get((did, i), 0) >> j & 1]
+            if ids_free:
+                free[t] = ids_free
+        days.append({"date": d, "free": free})
+    return jsonify({"slot": slot, "times": times, "doctors": doctors, "days": days})
 
 # ---------- API Routes ----------
 @app.route('/api/patients', methods=['GET'])
+@versioned("patients")
 def get_patients():
-    if use_mongo:
-        docs = list(db.patients.find({}, {"name":1,"age":1,"contact":1,"address":1,"created_at":1}))
-        return jsonify([{ "id": str(d.get("_id")), "name": d.get("name",""), "age": d.get("age",0), "contact": d.get("contact",""), "address": d.get("address",""), "created_at": d.get("created_at","") } for d in docs])
-    conn = get_conn()
-    rows = conn.execute("SELECT id, name, age, contact, address, created_at FROM patient ORDER BY id").fetchall()
-    conn.close()
-    return jsonify([{ "id": r["id"], "name": r["name"], "age": r["age"], "contact": r["contact"], "address": r["address"], "created_at": r["created_at"] } for r in rows])
+    limit, after = page_args()
+    stream = stream_format()
+    items = repos().patients.find(after=after, limit=fetch_limit(limit, stream), stream=bool(stream))
+    if stream:
+        return stream_response(items, stream)
+    return paged_response(items, limit, lambda p: str(p["id"]))
+
+@app.route('/api/patients/search', methods=['GET'])
+@versioned("patients")
+def search_patients():
+    """Ranked prefix search on name, contact and address: ?q=ahm&limit=20&after=<cursor>."""
+    q, tokens, limit, after = search_args()
+    patients = repos().patients
+    return paged_response(patients.search(q, tokens, after=after, limit=limit + 1), limit, patients.search_cursor)
 
 @app.route('/api/patients', methods=['POST'])
 def create_patient():
     data = request.get_json()
     if not data or not data.get('name'):
         return jsonify({"error": "Name required"}), 400
-    name = data['name']
-    age = data.get('age') or 0
-    contact = data.get('contact') or ''
-    address = data.get('address') or ''
-    created_at = datetime.utcnow().isoformat()
-    if use_mongo:
-        res = db.patients.insert_one({"name": name, "age": age, "contact": contact, "address": address, "created_at": created_at})
-        return jsonify({"id": str(res.inserted_id)}), 201
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO patient(name, age, contact, address, created_at) VALUES(?,?,?,?,?)", (name, age, contact, address, created_at))
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return jsonify({"id": new_id}),
+    new_id = repos().patients.create(data['name'], data.get('age') or 0, data.get('contact') or '', data.get('address') or '')
+    return jsonify({"id": new_id}), 201
 
 @app.route('/api/patients/<pid>', methods=['DELETE'])
 def delete_patient(pid):
-    if use_mongo:
-        try:
-            oid = ObjectId(pid)
-        except Exception:
-            return jsonify({"error":"invalid id"}), 400
-        db.appointments.delete_many({"patient_id": pid})
-        db.patients.delete_one({"_id": oid})
-        return jsonify({"deleted": pid})
-    try:
-        pid_int = int(pid)
-    except Exception:
-        return jsonify({"error":"invalid id"}), 400
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM appointment WHERE patient_id = ?", (pid_int,))
-    cur.execute("DELETE FROM patient WHERE id = ?", (pid_int,))
-    conn.commit()
-    conn.close()
-    return jsonify({"deleted": pid_int})
+    r = repos()
+    pid = r.patients.parse_id(pid)
+    if r.appointments.count(patient_id=pid) > JOB_INLINE_LIMIT:
+        return job_response(job_runner.submit("delete_patient", {"patient_id": pid}))
+    r.patients.delete(pid)
+    return jsonify({"deleted": pid})
 
 @app.route('/api/doctors', methods=['GET'])
+@versioned("doctors")
 def get_doctors():
-    if use_mongo:
-        docs = list(db.doctors.find({}, {"name":1,"specialty":1,"contact":1,"created_at":1}))
-        return jsonify([{ "id": str(d.get("_id")), "name": d.get("name",""), "specialty": d.get("specialty",""), "contact": d.get("contact","") } for d in docs])
-    conn = get_conn()
-    rows = conn.execute("SELECT id, name, specialty, contact FROM doctor ORDER BY id").fetchall()
-    conn.close()
-    return jsonify([{ "id": r["id"], "name": r["name"], "specialty": r["specialty"], "contact": r["contact"] } for r in rows])
+    limit, after = page_args()
+    stream = stream_format()
+    items = repos().doctors.find(after=after, specialty=request.args.get('specialty'), limit=fetch_limit(limit, stream), stream=bool(stream))
+    if stream:
+        return stream_response(items, stream)
+    return paged_response(items, limit, lambda d: str(d["id"]))
+
+@app.route('/api/doctors/search', methods=['GET'])
+@versioned("doctors")
+def search_doctors():
+    """Ranked prefix search on name, specialty and contact."""
+    q, tokens, limit, after = search_args()
+    doctors = repos().doctors
+    return paged_response(doctors.search(q, tokens, after=after, limit=limit + 1), limit, doctors.search_cursor)
 
 @app.route('/api/doctors', methods=['POST'])
 def create_doctor():
     data = request.get_json()
     if not data or not data.get('name'):
         return jsonify({"error": "Name required"}), 400
-    name = data['name']
-    specialty = data.get('specialty','')
-    contact = data.get('contact','')
-    created_at = datetime.utcnow().isoformat()
-    if use_mongo:
-        res = db.doctors.insert_one({"name": name, "specialty": specialty, "contact": contact, "created_at": created_at})
-        return jsonify({"id": str(res.inserted_id)}), 201
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO doctor(name, specialty, contact, created_at) VALUES(?,?,?,?)", (name, specialty, contact, created_at))
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
+    new_id = repos().doctors.create(data['name'], data.get('specialty',''), data.get('contact',''))
     return jsonify({"id": new_id}), 201
 
 @app.route('/api/doctors/<did>', methods=['DELETE'])
 def delete_doctor(did):
-    if use_mongo:
-        try:
-            oid = ObjectId(did)
-        except Exception:
-            return jsonify({"error":"invalid id"}), 400
-        db.appointments.delete_many({"doctor_id": did})
-        db.doctors.delete_one({"_id": oid})
-        return jsonify({"deleted": did})
-    try:
-        did_int = int(did)
-    except Exception:
-        return jsonify({"error":"invalid id"}), 400
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM appointment WHERE doctor_id = ?", (did_int,))
-    cur.execute("DELETE FROM doctor WHERE id = ?", (did_int,))
-    conn.commit()
-    conn.close()
-    return jsonify({"deleted": did_int})
+    r = repos()
+    did = r.doctors.parse_id(did)
+    if r.appointments.count(doctor_id=did) > JOB_INLINE_LIMIT:
+        return job_response(job_runner.submit("delete_doctor", {"doctor_id": did}))
+    r.doctors.delete(did)
+    return jsonify({"deleted": did})
 
 @app.route('/api/appointments', methods=['GET'])
+@versioned("appointments", "patients", "doctors")
 def get_appointments():
-    if use_mongo:
-        appts = list(db.appointments.find({}, {"patient_id":1,"doctor_id":1,"datetime":1,"created_at":1}).sort("datetime", 1))
-        pids = list({a.get("patient_id") for a in appts if a.get("patient_id")})
-        dids = list({a.get("doctor_id") for a in appts if a.get("doctor_id")})
-        pmap = {}
-        dmap = {}
-        if pids:
-            pdocs = list(db.patients.find({"_id": {"$in": [ObjectId(x) for x in pids]}}))
-            pmap = {str(d.get("_id")): d.get("name","") for d in pdocs}
-        if dids:
-            ddocs = list(db.doctors.find({"_id": {"$in": [ObjectId(x) for x in dids]}}))
-            dmap = {str(d.get("_id")): d.get("name","") for d in ddocs}
-        return jsonify([{ "id": str(a.get("_id")), "patient_id": a.get("patient_id"), "patient_name": pmap.get(a.get("patient_id"),""), "doctor_id": a.get("doctor_id"), "doctor_name": dmap.get(a.get("doctor_id"),""), "datetime": a.get("datetime",""), "created_at": a.get("created_at","") } for a in appts])
-    conn = get_conn()
-    rows = conn.execute(
-        """
-        SELECT a.id, a.patient_id, a.doctor_id, a.datetime, a.created_at,
-               p.name AS patient_name, d.name AS doctor_name
-        FROM appointment a
-        JOIN patient p ON p.id = a.patient_id
-        JOIN doctor d ON d.id = a.doctor_id
-        ORDER BY a.datetime
-        """
-    ).fetchall()
-    conn.close()
-    return jsonify([appointment_to_dict(r) for r in rows])
+    limit, after = page_args()
+    stream = stream_format()
+    items = repos().appointments.find(
+        patient_id=request.args.get('patient_id'), doctor_id=request.args.get('doctor_id'),
+        dt_from=datetime_arg('from'), dt_to=datetime_arg('to'),
+        after=after, limit=fetch_limit(limit, stream), stream=bool(stream))
+    if stream:
+        return stream_response(items, stream)
+    return paged_response(items, limit, appointment_cursor)
+
+# ---------- Booking ----------
+def parse_booking(data):
+    try:
+        # strptime also takes "2030-01-01 9:00"; store the zero-padded form the indexes and rollups slice by position.
+        dt_str = datetime.strptime((data or {}).get('datetime'), "%Y-%m-%d %H:%M").strftime("%Y-%m-%d %H:%M")
+    except Exception:
+        raise ApiError("Invalid datetime format")
+    parse_id = repos().appointments.parse_id
+    try:
+        return parse_id(data.get('patient_id')), parse_id(data.get('doctor_id')), dt_str
+    except ApiError:
+        raise ApiError("Invalid patient_id or doctor_id")
 
 @app.route('/api/appointments', methods=['POST'])
 def create_appointment():
+    pid, did, dt_str = parse_booking(request.get_json())
+    return jsonify({"id": repos().appointments.book(pid, did, dt_str)}), 201
+
+@app.route('/api/appointments/bulk', methods=['POST'])
+def bulk_create_appointments():
+    """Book many appointments in one transaction with a result per item.
+
+    Accepts a list, or {"appointments": [...], "atomic": true} to book all or nothing.
+    """
     data = request.get_json()
-    dt_str = data.get('datetime')
-    try:
-        datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
-    except Exception:
-        return jsonify({"error": "Invalid datetime format"}), 400
-    if use_mongo:
-        pid = data.get('patient_id')
-        did = data.get('doctor_id')
+    items = data if isinstance(data, list) else (data or {}).get('appointments')
+    atomic = isinstance(data, dict) and bool(data.get('atomic'))
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "appointments list required"}), 400
+    if len(items) > MAX_BULK_SIZE:
+        return jsonify({"error": f"at most {MAX_BULK_SIZE} appointments per request"}), 400
+    results = [None] * len(items)
+    parsed = []
+    for i, item in enumerate(items):
         try:
-            po = ObjectId(pid)
-            do = ObjectId(did)
-        except Exception:
-            return jsonify({"error":"Invalid patient_id or doctor_id"}), 400
-        if not db.patients.find_one({"_id": po}):
-            return jsonify({"error":"Patient not found"}), 404
-        if not db.doctors.find_one({"_id": do}):
-            return jsonify({"error":"Doctor not found"}), 404
-        if db.appointments.find_one({"doctor_id": did, "datetime": dt_str}):
-            return jsonify({"error":"Doctor already booked at this time"}), 409
-        if db.appointments.find_one({"patient_id": pid, "datetime": dt_str}):
-            return jsonify({"error":"Patient already has an appointment at this time"}), 409
-        created_at = datetime.utcnow().isoformat()
-        res = db.appointments.insert_one({"patient_id": pid, "doctor_id": did, "datetime": dt_str, "created_at": created_at})
-        return jsonify({"id": str(res.inserted_id)}), 201
-    try:
-        pid = int(data.get('patient_id'))
-        did = int(data.get('doctor_id'))
-    except Exception:
-        return jsonify({"error": "Invalid patient_id or doctor_id"}), 400
-    conn = get_conn()
-    cur = conn.cursor()
-    if not cur.execute("SELECT 1 FROM patient WHERE id = ?", (pid,)).fetchone():
-        conn.close()
-        return jsonify({"error": "Patient not found"}), 404
-    if not cur.execute("SELECT 1 FROM doctor WHERE id = ?", (did,)).fetchone():
-        conn.close()
-        return jsonify({"error": "Doctor not found"}), 404
-    if cur.execute("SELECT 1 FROM appointment WHERE doctor_id = ? AND datetime = ?", (did, dt_str)).fetchone():
-        conn.close()
-        return jsonify({"error":"Doctor already booked at this time"}), 409
-    if cur.execute("SELECT 1 FROM appointment WHERE patient_id = ? AND datetime = ?", (pid, dt_str)).fetchone():
-        conn.close()
-        return jsonify({"error":"Patient already has an appointment at this time"}), 409
-    created_at = datetime.utcnow().isoformat()
-    cur.execute("INSERT INTO appointment(patient_id, doctor_id, datetime, created_at) VALUES(?,?,?,?)", (pid, did, dt_str, created_at))
-    conn.commit()
-    new_id = cur.lastrowid
-    conn.close()
-    return jsonify({"id": new_id}), 201
+            parsed.append((i, parse_booking(item if isinstance(item, dict) else {})))
+        except ApiError as e:
+            results[i] = {"index": i, "status": e.status, "error": str(e)}
+    created = []
+    if parsed and not (atomic and len(parsed) < len(items)):
+        created = repos().appointments.book_many(parsed, results, atomic)
+    for i, r in enumerate(results):
+        if r is None or (atomic and not created and r["status"] == 201):
+            results[i] = {"index": i, "status": 424, "error": "not booked: another item in the batch failed"}
+    return jsonify({"created": len(created), "failed": len(items) - len(created), "results": results}), 201 if len(created) == len(items) else 200
 
 @app.route('/api/appointments/<aid>', methods=['DELETE'])
 def delete_appointment(aid):
-    if use_mongo:
-        try:
-            oid = ObjectId(aid)
-        except Exception:
-            return jsonify({"error":"invalid id"}), 400
-        db.appointments.delete_one({"_id": oid})
-        return jsonify({"deleted": aid})
-    try:
-        aid_int = int(aid)
-    except Exception:
-        return jsonify({"error":"invalid id"}), 400
-    conn = get_conn()
-    conn.execute("DELETE FROM appointment WHERE id = ?", (aid_int,))
-    conn.commit()
-    conn.close()
-    return jsonify({"deleted": aid_int})
+    appointments = repos().appointments
+    aid = appointments.parse_id(aid)
+    appointments.delete(aid)
+    return jsonify({"deleted": aid})
 
 @app.route('/api/auth/signup', methods=['POST'])
 def auth_signup():
@@ -323,35 +2810,15 @@ def auth_signup():
     role = ((data or {}).get('role') or 'user').lower()
     if not name or not email or not password:
         return jsonify({"error":"name, email, password required"}), 400
-    ph = generate_password_hash(password)
-    created_at = datetime.utcnow().isoformat()
-    if use_mongo:
-        if db.users.find_one({"email": email}):
-            return jsonify({"error":"email already registered"}), 409
-        is_admin = 1 if role == 'admin' else 0
-        if is_admin:
-            existing = db.users.find_one({"is_admin": 1})
-            if existing:
-                return jsonify({"error":"admin already exists"}), 409
-        res = db.users.insert_one({"name": name, "email": email, "password_hash": ph, "created_at": created_at, "is_admin": is_admin})
-        return jsonify({"id": str(res.inserted_id), "name": name, "email": email, "is_admin": is_admin}), 201
-    conn = get_conn()
-    cur = conn.cursor()
-    exists = cur.execute("SELECT 1 FROM user WHERE email = ?", (email,)).fetchone()
-    if exists:
-        conn.close()
-        return jsonify({"error":"email already registered"}), 409
     is_admin = 1 if role == 'admin' else 0
-    if is_admin:
-        row = cur.execute("SELECT id FROM user WHERE is_admin = 1 LIMIT 1").fetchone()
-        if row:
-            conn.close()
-            return jsonify({"error":"admin already exists"}), 409
-    cur.execute("INSERT INTO user(name, email, password_hash, created_at, is_admin) VALUES(?,?,?,?,?)", (name, email, ph, created_at, is_admin))
-    conn.commit()
-    uid = cur.lastrowid
-    conn.close()
-    return jsonify({"id": uid, "name": name, "email": email, "is_admin": is_admin}), 201
+    users = repos().users
+    if users.email_exists(email):
+        return jsonify({"error":"email already registered"}), 409
+    if is_admin and users.admin_id() is not None:
+        return jsonify({"error":"admin already exists"}), 409
+    new_id = users.create(name, email, hasher.hash(password), is_admin)
+    user = {"id": new_id, "name": name, "email": email, "is_admin": is_admin}
+    return jsonify(dict(user, token=issue_session(user))), 201
 
 @app.route('/api/auth/login', methods=['POST'])
 def auth_login():
@@ -360,20 +2827,31 @@ def auth_login():
     password = (data or {}).get('password')
     if not email or not password:
         return jsonify({"error":"email and password required"}), 400
-    if use_mongo:
-        row = db.users.find_one({"email": email})
-        if not row or not check_password_hash(row.get('password_hash',''), password):
-            return jsonify({"error":"invalid credentials"}), 401
-        return jsonify({"id": str(row.get('_id')), "name": row.get('name'), "email": row.get('email'), "is_admin": int(row.get('is_admin',0)), "ok": True})
-    conn = get_conn()
-    row = conn.execute("SELECT id, name, email, password_hash, is_admin FROM user WHERE email = ?", (email,)).fetchone()
-    conn.close()
-    if not row or not check_password_hash(row['password_hash'], password):
+    user = repos().users.by_email(email)
+    if not user or not hasher.verify(user.pop('password_hash'), password):
         return jsonify({"error":"invalid credentials"}), 401
-    return jsonify({"id": row['id'], "name": row['name'], "email": row['email'], "is_admin": int(row['is_admin']), "ok": True})
+    return jsonify(dict(user, ok=True, token=issue_session(user)))
 
-@app.route('/api/seed', methods=['POST'])
-def seed():
+@app.route('/api/auth/me', methods=['GET'])
+@require_auth()
+def auth_me():
+    return jsonify(g.user)
+
+@app.route('/api/auth/logout', methods=['POST'])
+def auth_logout():
+    token = session_token()
+    if token:
+        try:
+            sid = session_signer.loads(token, max_age=SESSION_TTL)["sid"]
+            sessions.revoke(sid)
+            repos().users.revoke_session(sid)
+        except BadSignature:
+            pass
+    return jsonify({"ok": True})
+
+def seed_sample_data():
+    """Insert the demo patients, doctors and appointments into whichever tables are empty."""
+    seeded = {"patients": 0, "doctors": 0, "appointments": 0}
     if use_mongo:
         pc = db.patients.count_documents({})
         dc = db.doctors.count_documents({})
@@ -387,7 +2865,9 @@ def seed():
                 {"name":"Ayesha Siddiqui","age":34,"contact":"0303-4444444","address":"Multan","created_at":now},
                 {"name":"Usman Farooq","age":52,"contact":"0304-5555555","address":"Peshawar","created_at":now}
             ]
-            db.patients.insert_many(pts)
+            db.patients.insert_many([with_search_fields("patients", p) for p in pts])
+            bump_mongo_counters(patients=len(pts))
+            seeded["patients"] = len(pts)
         if dc == 0:
             now = datetime.utcnow().isoformat()
             docs = [
@@ -396,7 +2876,9 @@ def seed():
                 {"name":"Dr. Ahmed","specialty":"Orthopedics","contact":"042-5556677","created_at":now},
                 {"name":"Dr. Maryam","specialty":"Pediatrics","contact":"042-9988776","created_at":now}
             ]
-            db.doctors.insert_many(docs)
+            db.doctors.insert_many([with_search_fields("doctors", d) for d in docs])
+            bump_mongo_counters(doctors=len(docs))
+            seeded["doctors"] = len(docs)
         if ac == 0:
             ps = list(db.patients.find({}, {"_id":1}))
             ds = list(db.doctors.find({}, {"_id":1}))
@@ -407,7 +2889,9 @@ def seed():
                     dt = f"{today} {10 + i*2:02d}:00"
                     rows.append({"patient_id": str(ps[i]["_id"]), "doctor_id": str(ds[i]["_id"]), "datetime": dt, "created_at": datetime.utcnow().isoformat()})
                 db.appointments.insert_many(rows)
-        return jsonify({"seeded": True})
+                bump_mongo_counters(hours=hour_deltas(rows), appointments=len(rows))
+                seeded["appointments"] = len(rows)
+        return seeded
     conn = get_conn()
     cur = conn.cursor()
     pc = cur.execute("SELECT COUNT(*) AS c FROM patient").fetchone()[0]
@@ -423,6 +2907,8 @@ def seed():
             ("Usman Farooq", 52, "0304-5555555", "Peshawar", now),
         ]
         cur.executemany("INSERT INTO patient(name, age, contact, address, created_at) VALUES(?,?,?,?,?)", pts)
+        bump_counters(cur, patients=len(pts))
+        seeded["patients"] = len(pts)
     if dc == 0:
         now = datetime.utcnow().isoformat()
         docs = [
@@ -432,6 +2918,8 @@ def seed():
             ("Dr. Maryam", "Pediatrics", "042-9988776", now),
         ]
         cur.executemany("INSERT INTO doctor(name, specialty, contact, created_at) VALUES(?,?,?,?)", docs)
+        bump_counters(cur, doctors=len(docs))
+        seeded["doctors"] = len(docs)
     conn.commit()
     if ac == 0:
         ps = cur.execute("SELECT id FROM patient ORDER BY id").fetchall()
@@ -443,96 +2931,1229 @@ def seed():
                 dt = f"{today} {10 + i*2:02d}:00"
                 rows.append((ps[i][0], ds[i][0], dt, datetime.utcnow().isoformat()))
             cur.executemany("INSERT INTO appointment(patient_id, doctor_id, datetime, created_at) VALUES(?,?,?,?)", rows)
+            bump_counters(cur, hours=[((did, dt[:13]), 1) for _, did, dt, _ in rows], appointments=len(rows))
+            conn.commit()
+            seeded["appointments"] = len(rows)
+    return seeded
+
+@app.route('/api/seed', methods=['POST'])
+def seed():
+    """Load the demo rows, or with a JSON body of generator parameters (admin only) a synthetic hospital."""
+    data = request.get_json(silent=True)
+    if not data:
+        return job_response(job_runner.submit("seed"))
+    user = current_user()
+    if not user:
+        return jsonify({"error": "authentication required"}), 401
+    if not user.get("is_admin"):
+        return jsonify({"error": "admin only"}), 403
+    return job_response(job_runner.submit("generate", seed_params(data), created_by=user["id"]))
+
+# ---------- Synthetic data ----------
+# Generates a hospital of any size for staging and capacity tests. Names, ages and
+# contacts are drawn as NumPy arrays; each day's appointments are a sample of
+# distinct (doctor, slot) cells, and the patients in any one slot are consecutive
+# from a random offset, so neither unique booking index can be violated. Rows go
+# out SEED_BATCH_SIZE at a time, one executemany (insert_many) per transaction.
+FIRST_NAMES = ("Ali", "Sara", "Bilal", "Ayesha", "Usman", "Hamza", "Fatima", "Ahmed", "Maryam", "Zainab",
+               "Omar", "Hira", "Imran", "Sana", "Kamran", "Noor", "Faisal", "Amna", "Tariq", "Mehwish",
+               "Hassan", "Rabia", "Adeel", "Iqra", "Saad", "Khadija", "Waqas", "Mahnoor", "Junaid", "Laiba")
+LAST_NAMES = ("Khan", "Ahmed", "Hussain", "Siddiqui", "Farooq", "Malik", "Qureshi", "Butt", "Chaudhry", "Sheikh",
+              "Raza", "Iqbal", "Javed", "Akhtar", "Mirza", "Abbasi", "Rana", "Shah", "Baig", "Anwar")
+CITIES = ("Lahore", "Karachi", "Islamabad", "Rawalpindi", "Faisalabad", "Multan", "Peshawar", "Quetta", "Sialkot", "Hyderabad")
+SPECIALTIES = ("Cardiology", "Neurology", "Orthopedics", "Pediatrics", "Dermatology", "General Medicine",
+               "Gynecology", "ENT", "Ophthalmology", "Psychiatry")
+
+def seed_params(data):
+    """Validate generator parameters: patients, doctors, appointments or density, from, days, specialties, seed."""
+    if not HAVE_NUMPY:
+        raise ApiError("generating data needs numpy (pip install numpy)", 501)
+    if not isinstance(data, dict):
+        raise ApiError("expected a JSON object")
+    def count(name, default=0):
+        value = data.get(name, default)
+        if value is None:
+            return None
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= SEED_MAX_ROWS:
+            raise ApiError(f"{name} must be an integer between 0 and {SEED_MAX_ROWS}")
+        return value
+    patients, doctors, appointments = count("patients"), count("doctors"), count("appointments", None)
+    density = data.get("density", 0.25)
+    if isinstance(density, bool) or not isinstance(density, (int, float)) or not 0 <= density <= 1:
+        raise ApiError("density must be between 0 and 1")
+    try:
+        first = datetime.strptime(data.get("from") or datetime.now().strftime("%Y-%m-%d"), "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ApiError("invalid from date")
+    days = data.get("days", 30)
+    if isinstance(days, bool) or not isinstance(days, int) or not 1 <= days <= SEED_MAX_DAYS:
+        raise ApiError(f"days must be 1-{SEED_MAX_DAYS}")
+    mix = data.get("specialties") or SPECIALTIES
+    if isinstance(mix, (list, tuple)):
+        mix = {name: 1 for name in mix}
+    if not isinstance(mix, dict) or not all(isinstance(k, str) and k for k in mix) \
+            or not all(isinstance(w, (int, float)) and not isinstance(w, bool) and 0 <= w < float('inf') for w in mix.values()) or sum(mix.values()) <= 0:
+        raise ApiError("specialties must be a list of names or an object of name: weight")
+    seed = data.get("seed")
+    if seed is None:
+        seed = secrets.randbits(32)
+    elif isinstance(seed, bool) or not isinstance(seed, int) or seed < 0:
+        raise ApiError("seed must be a non-negative integer")
+    slots = len(slot_times(_minutes(WORK_START, "WORK_START"), _minutes(WORK_END, "WORK_END"), SLOT_MINUTES))
+    cells = doctors * days * slots
+    if appointments is None:
+        appointments = round(cells * density)
+    if appointments > cells:
+        raise ApiError(f"at most {cells} appointments fit {doctors} doctors over {days} days")
+    if appointments and not patients:
+        raise ApiError("appointments need patients")
+    return {"patients": patients, "doctors": doctors, "appointments": appointments, "start": first.strftime("%Y-%m-%d"),
+            "days": days, "specialties": {k: float(w) for k, w in mix.items()}, "seed": seed}
+
+def _pick(rng, values, n):
+    return np.asarray(values)[rng.integers(len(values), size=n)]
+
+def _digits(rng, n, width):
+    return np.char.zfill(rng.integers(0, 10 ** width, size=n).astype(str), width)
+
+def _join(*parts):
+    out = parts[0]
+    for part in parts[1:]:
+        out = np.char.add(out, part)
+    return out
+
+def _patient_columns(rng, n):
+    return {
+        "name": _join(_pick(rng, FIRST_NAMES, n), " ", _pick(rng, LAST_NAMES, n)).tolist(),
+        "age": np.clip(rng.normal(40, 22, n), 0, 99).astype(np.int64).tolist(),
+        "contact": _join("03", _digits(rng, n, 2), "-", _digits(rng, n, 7)).tolist(),
+        "address": _join("House ", rng.integers(1, 500, size=n).astype(str), ", ", _pick(rng, CITIES, n)).tolist(),
+    }
+
+def _doctor_columns(rng, n, specialties):
+    names = list(specialties)
+    weights = np.array([specialties[k] for k in names], dtype=float)
+    return {
+        "name": _join("Dr. ", _pick(rng, FIRST_NAMES, n), " ", _pick(rng, LAST_NAMES, n)).tolist(),
+        "specialty": np.asarray(names)[rng.choice(len(names), size=n, p=weights / weights.sum())].tolist(),
+        "contact": _join("042-", _digits(rng, n, 7)).tolist(),
+    }
+
+def _seed_batch_sqlite(kind, columns):
+    table, _, _ = IMPORT_KINDS[kind]
+    names = list(columns)
+    n = len(columns[names[0]])
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        now = datetime.utcnow().isoformat()
+        with deferred_search_index(cur, table):
+            cur.executemany(f"INSERT INTO {table}({', '.join(names)}, created_at) VALUES({', '.join('?' * (len(names) + 1))})",
+                            zip(*columns.values(), [now] * n))
+        # We hold the write lock, so the newest n ids are this batch's.
+        ids = [r[0] for r in cur.execute(f"SELECT id FROM {table} ORDER BY id DESC LIMIT ?", (n,)).fetchall()][::-1]
+        hours = Counter(zip(columns["doctor_id"], (dt[:13] for dt in columns["datetime"]))).items() if kind == "appointments" else ()
+        bump_counters(cur, hours=hours, **{kind: n})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return np.array(ids, dtype=np.int64)
+
+def _seed_batch_mongo(kind, columns):
+    now = datetime.utcnow().isoformat()
+    docs = [dict(zip(columns, values), created_at=now) for values in zip(*columns.values())]
+    if kind in SEARCH_FIELDS:
+        docs = [with_search_fields(kind, d) for d in docs]
+    ids = getattr(db, kind).insert_many(docs).inserted_ids
+    hours = hour_deltas(docs) if kind == "appointments" else ()
+    bump_mongo_counters(hours=hours, **{kind: len(docs)})
+    return np.array([str(i) for i in ids], dtype=object)
+
+def generate_data(patients=0, doctors=0, appointments=0, start=None, days=30, specialties=None, seed=None):
+    """Insert a synthetic hospital (see seed_params), yielding a progress step per batch."""
+    rng = np.random.default_rng(seed)
+    write = _seed_batch_mongo if use_mongo else _seed_batch_sqlite
+    done = {"patients": 0, "doctors": 0, "appointments": 0}
+    total = patients + doctors + appointments
+    step = lambda: dict(done, processed=sum(done.values()), total=total, seed=seed)
+    ids = {}
+    with bulk_changes(*(k for k, n in (("patients", patients), ("doctors", doctors), ("appointments", appointments)) if n)):
+        for kind, n, make in (("patients", patients, _patient_columns),
+                              ("doctors", doctors, lambda rng, k: _doctor_columns(rng, k, specialties or {s: 1 for s in SPECIALTIES}))):
+            chunks = []
+            for lo in range(0, n, SEED_BATCH_SIZE):
+                chunks.append(write(kind, make(rng, min(SEED_BATCH_SIZE, n - lo))))
+                done[kind] += len(chunks[-1])
+                yield step()
+            ids[kind] = np.concatenate(chunks) if chunks else np.array([], dtype=np.int64)
+        pids, dids = ids["patients"], ids["doctors"]
+        times = np.array(slot_times(_minutes(WORK_START, "WORK_START"), _minutes(WORK_END, "WORK_END"), SLOT_MINUTES))
+        cells = len(dids) * len(times)
+        first = datetime.strptime(start, "%Y-%m-%d") if start else datetime.now()
+        per_day, extra = divmod(appointments, days) if cells else (0, 0)
+        batch = []
+        for d in range(days):
+            quota = min(per_day + (d < extra), cells)
+            if quota:
+                # Cell c is slot c // doctors for doctor c % doctors; sorting groups each slot's bookings together.
+                cell = np.sort(rng.choice(cells, size=quota, replace=False))
+                slot, doctor = cell // len(dids), cell % len(dids)
+                rank = np.arange(quota) - np.searchsorted(slot, slot)
+                keep = rank < len(pids)
+                slot, doctor, rank = slot[keep], doctor[keep], rank[keep]
+                patient = (rng.integers(len(pids), size=len(times))[slot] + rank) % len(pids)
+                day = (first + timedelta(days=d)).strftime("%Y-%m-%d")
+                batch.append((pids[patient], dids[doctor], np.char.add(day + " ", times[slot])))
+            pending = sum(len(b[0]) for b in batch)
+            if batch and (pending >= SEED_BATCH_SIZE or d == days - 1):
+                columns = {"patient_id": np.concatenate([b[0] for b in batch]).tolist(),
+                           "doctor_id": np.concatenate([b[1] for b in batch]).tolist(),
+                           "datetime": np.concatenate([b[2] for b in batch]).tolist()}
+                write("appointments", columns)
+                done["appointments"] += pending
+                batch = []
+                yield step()
+    yield step()
+
+# ---------- Bulk import ----------
+# CSV/NDJSON rows are parsed lazily, validated and written IMPORT_BATCH_SIZE at a
+# time with executemany (insert_many on Mongo), one transaction per batch, so a
+# multi-GB upload never has more than one batch in memory.
+def _import_patient(row):
+    if not row.get('name'):
+        raise ValueError("name required")
+    try:
+        age = int(row.get('age') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("invalid age")
+    return {"name": str(row['name']), "age": age, "contact": str(row.get('contact') or ''), "address": str(row.get('address') or '')}
+
+def _import_doctor(row):
+    if not row.get('name'):
+        raise ValueError("name required")
+    return {"name": str(row['name']), "specialty": str(row.get('specialty') or ''), "contact": str(row.get('contact') or '')}
+
+def _import_appointment(row):
+    try:
+        pid, did, dt_str = parse_booking(row)
+    except ApiError as e:
+        raise ValueError(str(e))
+    return {"patient_id": pid, "doctor_id": did, "datetime": dt_str}
+
+IMPORT_KINDS = {
+    "patients": ("patient", _import_patient, ("name", "age", "contact", "address")),
+    "doctors": ("doctor", _import_doctor, ("name", "specialty", "contact")),
+    "appointments": ("appointment", _import_appointment, ("patient_id", "doctor_id", "datetime")),
+}
+
+def read_records(stream, fmt):
+    """Yield (row_number, dict-or-error) from a binary stream without reading it all."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    if fmt == 'csv':
+        for n, row in enumerate(csv.DictReader(text), start=1):
+            yield n, {k.strip(): v for k, v in row.items() if k}
+        return
+    for n, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield n, ValueError("invalid JSON")
+            continue
+        yield n, row if isinstance(row, dict) else ValueError("expected a JSON object")
+
+def _resolve_appointments_sqlite(cur, batch, errors):
+    pids = {r["patient_id"] for _, r in batch}
+    dids = {r["doctor_id"] for _, r in batch}
+    found_p = {r[0] for r in cur.execute(f"SELECT id FROM patient WHERE id IN ({','.join('?' * len(pids))})", list(pids))}
+    found_d = {r[0] for r in cur.execute(f"SELECT id FROM doctor WHERE id IN ({','.join('?' * len(dids))})", list(dids))}
+    dts = list({r["datetime"] for _, r in batch})
+    marks = ','.join('?' * len(dts))
+    taken_d = {(r[0], r[1]) for r in cur.execute(f"SELECT doctor_id, datetime FROM appointment WHERE datetime IN ({marks}) AND doctor_id IN ({','.join('?' * len(dids))})", dts + list(dids))}
+    taken_p = {(r[0], r[1]) for r in cur.execute(f"SELECT patient_id, datetime FROM appointment WHERE datetime IN ({marks}) AND patient_id IN ({','.join('?' * len(pids))})", dts + list(pids))}
+    ok = []
+    for n, r in batch:
+        if r["patient_id"] not in found_p:
+            errors.append((n, "Patient not found"))
+        elif r["doctor_id"] not in found_d:
+            errors.append((n, "Doctor not found"))
+        elif (r["doctor_id"], r["datetime"]) in taken_d:
+            errors.append((n, DOCTOR_CONFLICT[0]))
+        elif (r["patient_id"], r["datetime"]) in taken_p:
+            errors.append((n, PATIENT_CONFLICT[0]))
+        else:
+            taken_d.add((r["doctor_id"], r["datetime"]))
+            taken_p.add((r["patient_id"], r["datetime"]))
+            ok.append((n, r))
+    return ok
+
+def _write_batch_sqlite(kind, batch, errors):
+    table, _, cols = IMPORT_KINDS[kind]
+    with held_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if kind == "appointments":
+                batch = _resolve_appointments_sqlite(cur, batch, errors)
+            now = datetime.utcnow().isoformat()
+            with deferred_search_index(cur, table):
+                cur.executemany(
+                    f"INSERT INTO {table}({', '.join(cols)}, created_at) VALUES({', '.join('?' * (len(cols) + 1))})",
+                    [tuple(r[c] for c in cols) + (now,) for _, r in batch])
+            hours = hour_deltas(r for _, r in batch) if kind == "appointments" else ()
+            bump_counters(cur, hours=hours, **{kind: len(batch)})
             conn.commit()
-    conn.close()
-    return jsonify({"seeded": True})
+        except Exception:
+            conn.rollback()
+            raise
+    return len(batch)
+
+def _write_batch_mongo(kind, batch, errors):
+    if kind == "appointments":
+        found_p = {str(d["_id"]) for d in db.patients.find({"_id": {"$in": [ObjectId(r["patient_id"]) for _, r in batch]}}, {"_id": 1})}
+        found_d = {str(d["_id"]) for d in db.doctors.find({"_id": {"$in": [ObjectId(r["doctor_id"]) for _, r in batch]}}, {"_id": 1})}
+        ok = []
+        for n, r in batch:
+            if r["patient_id"] not in found_p:
+                errors.append((n, "Patient not found"))
+            elif r["doctor_id"] not in found_d:
+                errors.append((n, "Doctor not found"))
+            else:
+                ok.append((n, r))
+        batch = ok
+    if not batch:
+        return 0
+    now = datetime.utcnow().isoformat()
+    docs = [dict(r, created_at=now) for _, r in batch]
+    if kind in SEARCH_FIELDS:
+        docs = [with_search_fields(kind, d) for d in docs]
+    failed = set()
+    try:
+        getattr(db, kind).insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get('writeErrors', []):
+            failed.add(err['index'])
+            doc = docs[err['index']]
+            errors.append((batch[err['index']][0], mongo_conflict(err, doc.get("doctor_id"), doc.get("datetime"))[0]))
+    inserted = [d for j, d in enumerate(docs) if j not in failed]
+    hours = hour_deltas(inserted) if kind == "appointments" else ()
+    bump_mongo_counters(hours=hours, **{kind: len(inserted)})
+    return len(inserted)
+
+def import_records(kind, records, batch_size=IMPORT_BATCH_SIZE):
+    """Validate and insert records batch by batch, yielding a progress dict after each batch."""
+    _, validate, _ = IMPORT_KINDS[kind]
+    write = _write_batch_mongo if use_mongo else _write_batch_sqlite
+    totals = {"kind": kind, "processed": 0, "inserted": 0, "failed": 0, "errors": []}
+    batch, errors = [], []
+    def flush():
+        errors_before = len(errors)
+        inserted = write(kind, batch, errors) if batch else 0
+        totals["processed"] += len(batch) + errors_before
+        totals["inserted"] += inserted
+        totals["failed"] += len(errors)
+        room = IMPORT_MAX_ERRORS - len(totals["errors"])
+        batch_errors = [{"row": n, "error": e} for n, e in errors]
+        totals["errors"].extend(batch_errors[:max(room, 0)])
+        batch.clear()
+        errors.clear()
+        return {"processed": totals["processed"], "inserted": totals["inserted"], "failed": totals["failed"], "errors": batch_errors}
+    with bulk_changes(kind):
+        for n, row in records:
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                batch.append((n, validate(row)))
+            except ValueError as e:
+                errors.append((n, str(e)))
+            if len(batch) + len(errors) >= batch_size:
+                yield flush()
+        if batch or errors:
+            yield flush()
+    totals["done"] = True
+    yield totals
+
+def import_format(content_type, name=''):
+    fmt = request.args.get('format')
+    if fmt:
+        return fmt
+    if 'csv' in (content_type or '') or name.endswith('.csv'):
+        return 'csv'
+    return 'ndjson'
+
+@app.route('/api/import/<kind>', methods=['POST'])
+@require_auth(admin=True)
+def import_data(kind):
+    """Import a CSV or NDJSON upload (raw body or multipart 'file') of patients, doctors or appointments.
+
+    With ?stream=1 (or Accept: application/x-ndjson) a progress line is streamed per batch;
+    with ?background=1 the upload is saved and imported by a job instead.
+    """
+    if kind not in IMPORT_KINDS:
+        return jsonify({"error": "unknown import kind"}), 404
+    upload = request.files.get('file')
+    if upload:
+        fmt, source = import_format(upload.mimetype, upload.filename or ''), upload.stream
+    else:
+        fmt, source = import_format(request.mimetype), request.stream
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+    if request.args.get('background') == '1':
+        # The upload is spooled to disk so the job can outlive this request.
+        fd, path = tempfile.mkstemp(prefix="hms-import-", suffix=f".{fmt}", dir=JOB_SPOOL_DIR)
+        with os.fdopen(fd, 'wb') as spool:
+            shutil.copyfileobj(source, spool)
+        return job_response(job_runner.submit("import", {"kind": kind, "path": path, "fmt": fmt}, created_by=g.user["id"]))
+    progress = import_records(kind, read_records(source, fmt))
+    if stream_format():
+        return Response(stream_with_context(app.json.dumps(p) + "\n" for p in progress), mimetype='application/x-ndjson')
+    for last in progress:
+        pass
+    return jsonify(last), 200
+
+def import_file(kind, path, fmt=None):
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    with open(path, 'rb') as f:
+        for p in import_records(kind, read_records(f, fmt)):
+            if p.get("done"):
+                return p
+            for e in p["errors"]:
+                print(f"row {e['row']}: {e['error']}", file=sys.stderr)
+            print(f"{kind}: {p['processed']} processed, {p['inserted']} inserted, {p['failed']} failed", file=sys.stderr)
+
+# ---------- Background jobs ----------
+# Heavy admin operations run on a small thread pool instead of the request thread.
+# Each one is a generator that works in JOB_BATCH_SIZE chunks, committing after
+# every chunk so the SQLite write lock is released in between, and yields a
+# progress step per chunk. Job state lives in the job table (the jobs collection on
+# Mongo), so any worker can report on a job or flag it for cancellation; the runner
+# checks that flag between chunks.
+JOB_KINDS = {}
+
+def job_kind(name):
+    def decorator(fn):
+        JOB_KINDS[name] = fn
+        return fn
+    return decorator
+
+class JobCancelled(Exception):
+    pass
+
+class JobRunner:
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+        self._stopping = False
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            return self._executor
+
+    def submit(self, kind, params=None, created_by=None):
+        if not use_mongo and get_conn().held:
+            raise ApiError("background jobs can't run inside an atomic batch", 409)
+        params = params or {}
+        jobs = repos().jobs
+        job_id = jobs.create(kind, params, created_by)
+        with self._lock:
+            self._pending.add(job_id)
+        self._pool().submit(self._run, job_id, kind, params)
+        return jobs.get(job_id)
+
+    def _run(self, job_id, kind, params):
+        with app.app_context():
+            jobs = repos().jobs
+            status, last, error = "cancelled", None, None
+            try:
+                if jobs.start(job_id):
+                    steps = JOB_KINDS[kind](**params)
+                    try:
+                        for last in steps:
+                            if jobs.progress(job_id, last) or self._stopping:
+                                raise JobCancelled()
+                            time.sleep(JOB_BATCH_PAUSE)
+                    finally:
+                        steps.close()
+                    status = "succeeded"
+                    jobs.finish(job_id, status, last)
+            except JobCancelled:
+                if self._stopping:
+                    status, error = "failed", "interrupted by shutdown"
+                jobs.finish(job_id, status, last, error)
+            except Exception as e:
+                app.logger.exception("job %s (%s) failed", job_id, kind)
+                status = "failed"
+                jobs.finish(job_id, status, last, str(e))
+            finally:
+                with self._lock:
+                    self._pending.discard(job_id)
+            metrics.inc("hms_jobs_total", (("kind", kind), ("status", status)))
+
+    def shutdown(self):
+        """Stop running jobs at their next chunk boundary and fail the ones still queued."""
+        self._stopping = True
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            orphans, self._pending = self._pending, set()
+        if orphans:
+            with app.app_context():
+                repos().jobs.abandon("interrupted by shutdown", orphans)
+
+job_runner = JobRunner()
+
+def job_response(job):
+    return jsonify(job), 202, {"Location": f"/api/jobs/{job['id']}"}
+
+@job_kind("clear")
+def clear_domain_job():
+    r = repos()
+    counts = r.counts()
+    total = sum(counts.get(k, 0) for k in ("appointments", "patients", "doctors"))
+    processed = 0
+    with bulk_changes("appointments", "patients", "doctors"):
+        for repo in (r.appointments, r.patients, r.doctors):
+            while True:
+                n = repo.delete_batch(JOB_BATCH_SIZE)
+                if not n:
+                    break
+                processed += n
+                yield {"processed": processed, "total": total}
+    yield {"processed": processed, "total": total}
+
+def _cascade_delete_job(repo, field, entity_id):
+    # Appointments go in chunks; the last transaction removes any stragglers
+    # booked meanwhile together with the patient/doctor row itself.
+    appointments = repos().appointments
+    total = appointments.count(**{field: entity_id})
+    processed = 0
+    with bulk_changes("appointments"):
+        while True:
+            n = appointments.delete_batch(JOB_BATCH_SIZE, **{field: entity_id})
+            processed += n
+            if n < JOB_BATCH_SIZE:
+                break
+            yield {"processed": processed, "total": total}
+    yield {"processed": processed, "total": total, "deleted": entity_id if repo.delete(entity_id) else None}
+
+@job_kind("delete_patient")
+def delete_patient_job(patient_id):
+    return _cascade_delete_job(repos().patients, "patient_id", patient_id)
+
+@job_kind("delete_doctor")
+def delete_doctor_job(doctor_id):
+    return _cascade_delete_job(repos().doctors, "doctor_id", doctor_id)
+
+@job_kind("seed")
+def seed_job():
+    with bulk_changes("patients", "doctors", "appointments"):
+        seeded = seed_sample_data()
+    yield dict(seeded, processed=sum(seeded.values()), total=sum(seeded.values()))
+
+@job_kind("generate")
+def generate_job(**params):
+    return generate_data(**params)
+
+@job_kind("import")
+def import_job(kind, path, fmt):
+    try:
+        with open(path, 'rb') as f:
+            for p in import_records(kind, read_records(f, fmt)):
+                yield p if p.get("done") else {k: v for k, v in p.items() if k != "errors"}
+    finally:
+        os.unlink(path)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_auth()
+def get_job(job_id):
+    """Job status and progress, for any signed-in user."""
+    job = repos().jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@require_auth()
+def cancel_job(job_id):
+    """Cancel a queued job, or ask a running one to stop after its current chunk. Only its creator or an admin may."""
+    jobs = repos().jobs
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if not g.user.get("is_admin") and job["created_by"] != str(g.user["id"]):
+        return jsonify({"error": "only the job's creator or an admin can cancel it"}), 403
+    job = jobs.cancel(job_id)
+    if job["status"] in ("succeeded", "failed"):
+        return jsonify({"error": f"job already {job['status']}"}), 409
+    return jsonify(job), 202 if job["status"] == "running" else 200
+
+# ---------- Analytics ----------
+# Each worker keeps the doctor_hour rollup in memory as dense uint8 arrays of
+# [doctor, hour, day] bookings, one block per BLOCK_DAYS days, and brings it up
+# to date from the rows stamped after the last appointments version it saw. A
+# range query is then a slice and a few NumPy reductions, with no SQL and no
+# datetime parsing. uint8 is enough: the (doctor_id, datetime) unique index
+# allows at most 60 bookings per doctor-hour.
+class UtilizationCube:
+    BLOCK_DAYS = 32
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.lock = threading.Lock()
+        self.version = -1
+        self.rows = {}
+        self.capacity = 0
+        self.blocks = {}
+        self.doctors = (None, [])
+
+    def _index(self, ids):
+        """Cube row of each doctor id, adding rows (and growing every block) for new ones."""
+        ids = np.asarray(ids, dtype=object if use_mongo else np.int64)
+        uniq, inverse = np.unique(ids, return_inverse=True)
+        for did in uniq.tolist():
+            if did not in self.rows:
+                self.rows[did] = len(self.rows)
+        if len(self.rows) > self.capacity:
+            self.capacity = max(64, 2 * self.capacity, len(self.rows))
+            for b, block in self.blocks.items():
+                grown = np.zeros((self.capacity, 24, self.BLOCK_DAYS), dtype=np.uint8)
+                grown[:len(block)] = block
+                self.blocks[b] = grown
+        return np.array([self.rows[d] for d in uniq.tolist()], dtype=np.int64)[inverse]
+
+    def _apply(self, chunk):
+        dids, days, hours, totals = chunk
+        rows = self._index(dids)
+        block, offset = np.divmod(np.array(days, dtype=np.int64), self.BLOCK_DAYS)
+        hours = np.array(hours, dtype=np.int64)
+        totals = np.clip(np.array(totals, dtype=np.int64), 0, 255).astype(np.uint8)
+        for b in np.unique(block).tolist():
+            if b not in self.blocks:
+                self.blocks[b] = np.zeros((self.capacity, 24, self.BLOCK_DAYS), dtype=np.uint8)
+            m = block == b
+            self.blocks[b][rows[m], hours[m], offset[m]] = totals[m]
+
+    def refresh(self):
+        """Catch up with the rollup and the doctor list; returns the current doctors."""
+        versions = table_versions(["appointments", "doctors"])
+        with self.lock:
+            version = versions["appointments"][0]
+            if version != self.version:
+                since = max(self.version - self.repo.lag, -1) if self.version >= 0 else -1
+                for chunk in self.repo.rollup_since(since):
+                    self._apply(chunk)
+                self.version = version
+            if self.doctors[0] != versions["doctors"][0]:
+                self.doctors = (versions["doctors"][0], repos().doctors.find())
+            return self.doctors[1]
+
+    def counts(self, ids, first, days):
+        """Bookings as a [len(ids), 24, days] array for the days from ordinal first."""
+        with self.lock:
+            rows = self._index(ids) if len(ids) else np.zeros(0, dtype=np.int64)
+            out = np.zeros((len(rows), 24, days), dtype=np.uint8)
+            day = first
+            while day < first + days:
+                b, offset = divmod(day, self.BLOCK_DAYS)
+                n = min(self.BLOCK_DAYS - offset, first + days - day)
+                if b in self.blocks:
+                    out[:, :, day - first:day - first + n] = self.blocks[b][rows, :, offset:offset + n]
+                day += n
+            return out
+
+utilization_cubes = {}
+
+def utilization_cube():
+    r = repos()
+    cube = utilization_cubes.get(r)
+    if cube is None:
+        cube = utilization_cubes.setdefault(r, UtilizationCube(r.analytics))
+    return cube
+
+def hour_capacity():
+    """Bookable slots starting in each hour of the day under WORK_START/WORK_END/SLOT_MINUTES."""
+    cap = np.zeros(24, dtype=np.uint8)
+    for t in slot_times(_minutes(WORK_START, "WORK_START"), _minutes(WORK_END, "WORK_END"), SLOT_MINUTES):
+        cap[int(t[:2])] += 1
+    return cap
+
+def utilization_summary(booked, full, per_hour, slots):
+    """Roll per-doctor booked slots, no-slot days and hourly bookings up into one summary."""
+    by_hour = per_hour.sum(axis=0)
+    capacity = slots * len(booked)
+    return {
+        "appointments": int(by_hour.sum()),
+        "occupancy": round(int(booked.sum()) / capacity, 4) if capacity else 0.0,
+        "no_slot_days": int(full.sum()),
+        "peak_hour": int(by_hour.argmax()) if by_hour.any() else None,
+        "by_hour": by_hour.tolist(),
+    }
+
+ANALYTICS_ORDERS = ("occupancy", "appointments", "no_slot_days", "name")
+
+@app.route('/api/analytics/utilization', methods=['GET'])
+@require_auth(admin=True)
+def utilization():
+    """Occupancy, peak hours and fully booked days per doctor and specialty over ?from=&to= (to exclusive)."""
+    if not HAVE_NUMPY:
+        raise ApiError("analytics needs numpy (pip install numpy)", 501)
+    try:
+        last = datetime.strptime(request.args['to'], "%Y-%m-%d").date() if request.args.get('to') else date.today() + timedelta(days=1)
+        first = datetime.strptime(request.args['from'], "%Y-%m-%d").date() if request.args.get('from') else last - timedelta(days=30)
+    except ValueError:
+        raise ApiError("invalid from/to date")
+    days = (last - first).days
+    if days < 1 or days > MAX_ANALYTICS_DAYS:
+        raise ApiError(f"date range must be 1-{MAX_ANALYTICS_DAYS} days")
+    order = request.args.get('order', 'occupancy')
+    if order not in ANALYTICS_ORDERS:
+        raise ApiError(f"order must be one of {', '.join(ANALYTICS_ORDERS)}")
+    limit = max(0, min(int_arg(request.args.get('limit', ANALYTICS_LIMIT), "limit"), MAX_PAGE_SIZE))
+    specialty = request.args.get('specialty')
+    ids = {repos().doctors.parse_id(x, "doctor_id") for x in (request.args.get('doctor_id') or '').split(',') if x}
+
+    cube = utilization_cube()
+    doctors = [d for d in cube.refresh() if (not specialty or d["specialty"] == specialty) and (not ids or d["id"] in ids)]
+    counts = cube.counts([d["id"] for d in doctors], first.toordinal(), days)
+    cap = hour_capacity()
+    slots = int(cap.sum()) * days
+    # Per doctor: bookings per hour of day, slots taken (off-grid extras don't count
+    # twice) and days on which every working hour was full. Days are the last,
+    # contiguous axis, so every reduction runs over rows of a doctor-hour.
+    work = cap > 0
+    per_hour = counts.sum(axis=2, dtype=np.uint32)
+    hours = counts[:, work]
+    booked = np.minimum(hours, cap[work, None]).sum(axis=(1, 2), dtype=np.uint32)
+    full = (hours >= cap[work, None]).all(axis=1).sum(axis=1) if work.any() else np.zeros(len(doctors), dtype=np.int64)
+
+    rows = [{"id": d["id"], "name": d["name"], "specialty": d["specialty"],
+             "appointments": int(per_hour[i].sum()),
+             "occupancy": round(int(booked[i]) / slots, 4) if slots else 0.0,
+             "no_slot_days": int(full[i]),
+             "peak_hour": int(per_hour[i].argmax()) if per_hour[i].any() else None}
+            for i, d in enumerate(doctors)]
+    if order == "name":
+        rows.sort(key=lambda r: (r["name"] or '', str(r["id"])))
+    else:
+        rows.sort(key=lambda r: (-r[order], str(r["id"])))
+    groups = {}
+    for i, d in enumerate(doctors):
+        groups.setdefault(d["specialty"] or '', []).append(i)
+    by_specialty = [dict(specialty=name, doctors=len(idx), **utilization_summary(booked[idx], full[idx], per_hour[idx], slots))
+                    for name, idx in sorted(groups.items())]
+    return jsonify({"from": first.isoformat(), "to": last.isoformat(), "days": days, "slots_per_day": int(cap.sum()),
+                    "totals": dict(doctors=len(doctors), **utilization_summary(booked, full, per_hour, slots)),
+                    "by_specialty": by_specialty, "doctors": rows[:limit]})
+
+# ---------- Change feed ----------
+# /api/changes?since=<version> returns the change-log events after a version for
+# delta sync; /api/changes/stream sends them as server-sent events. Streams don't
+# poll the database themselves: one thread per process watches the latest version
+# while any stream is open and wakes them all when it moves.
+PUBLIC_CHANGE_KINDS = ("patients", "doctors", "appointments")
+
+class ChangeFeed:
+    def __init__(self, interval=CHANGE_POLL_SECONDS, max_streams=CHANGE_MAX_STREAMS):
+        self.interval = interval
+        self.max_streams = max_streams
+        self.version = None
+        self.closed = False
+        self._cond = threading.Condition()
+        self._streams = 0
+        self._watcher = None
+
+    def open(self):
+        """Reserve a stream slot; False when this worker already serves max_streams."""
+        with self._cond:
+            if self.closed or self._streams >= self.max_streams:
+                return False
+            self._streams += 1
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="change-feed", daemon=True)
+                self._watcher.start()
+        metrics.set("hms_change_streams", (), self._streams)
+        return True
+
+    def release(self):
+        with self._cond:
+            self._streams -= 1
+        metrics.set("hms_change_streams", (), self._streams)
+
+    def wait(self, version, timeout):
+        """Block until the log moves past version, timeout seconds pass or the feed closes; returns the latest version."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or (self.version or 0) > version, timeout)
+            return self.version or 0
+
+    def _watch(self):
+        while True:
+            try:
+                with app.app_context():
+                    latest = repos().changes.latest()
+            except Exception:
+                app.logger.exception("change feed poll failed")
+                latest = None
+            with self._cond:
+                if latest is not None and latest != self.version:
+                    self.version = latest
+                    self._cond.notify_all()
+                if self.closed or not self._streams:
+                    self._watcher = None
+                    return
+                self._cond.wait(self.interval)
+
+    def close(self):
+        """End every open stream at its next wake-up; clients reconnect to another worker."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+change_feed = ChangeFeed()
+
+def change_args(since):
+    """Validate ?kinds= (users are admin only) and the since version."""
+    user = current_user()
+    admin = bool(user and user.get("is_admin"))
+    kinds = [k for k in (request.args.get('kinds') or '').split(',') if k] or list(PUBLIC_CHANGE_KINDS) + (["users"] if admin else [])
+    unknown = [k for k in kinds if k not in COUNTED_TABLES]
+    if unknown:
+        raise ApiError(f"unknown kind {unknown[0]}")
+    if "users" in kinds and not admin:
+        raise ApiError("admin only", 403)
+    if since in (None, ''):
+        return kinds, None
+    since = int_arg(since, "since")
+    if since < 0:
+        raise ApiError("invalid since")
+    return kinds, since
+
+def change_events(version, kinds):
+    """Server-sent events after version: `change` per event, `reset` when the client must refetch, pings when idle."""
+    dumps = app.json.dumps
+    yield "retry: 2000\n\n"
+    deadline = time.monotonic() + CHANGE_STREAM_SECONDS
+    seen = version
+    while True:
+        with app.app_context():
+            page = repos().changes.since(version, kinds, MAX_PAGE_SIZE)
+        if page["reset"]:
+            yield f"id: {page['version']}\nevent: reset\ndata: {dumps({'version': page['version']})}\n\n"
+        for c in page["changes"]:
+            yield f"id: {c['version']}\nevent: change\ndata: {dumps(c)}\n\n"
+        version = page["version"]
+        if page["more"]:
+            continue
+        left = deadline - time.monotonic()
+        if left <= 0 or change_feed.closed:
+            return
+        # Events of other kinds move the log too; only wake again once it moves past what we've seen.
+        seen = max(seen, version)
+        latest = change_feed.wait(seen, min(CHANGE_HEARTBEAT_SECONDS, left))
+        if latest <= seen:
+            yield ": ping\n\n"
+        seen = max(seen, latest)
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """Change-log events after ?since=<version>, oldest first, in pages of ?limit=; without since, just the current version."""
+    kinds, since = change_args(request.args.get('since'))
+    changes = repos().changes
+    if since is None:
+        return jsonify({"version": changes.latest(), "changes": [], "more": False, "reset": False})
+    limit = page_args()[0] or MAX_PAGE_SIZE
+    return jsonify(changes.since(since, kinds, limit))
+
+@app.route('/api/changes/stream', methods=['GET'])
+def stream_changes():
+    """The change feed as server-sent events; EventSource resumes from Last-Event-ID after a reconnect."""
+    kinds, since = change_args(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    if since is None:
+        since = repos().changes.latest()
+    if not change_feed.open():
+        return jsonify({"error": "too many change streams open, poll /api/changes instead"}), 503, {"Retry-After": "30"}
+    resp = Response(change_events(since, kinds), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # call_on_close runs even when the client goes away before the first event.
+    resp.call_on_close(change_feed.release)
+    return resp
+
+# ---------- Batch ----------
+# /api/batch runs several API requests in one round trip. Each one goes through
+# the normal routing, hooks and error handlers, in order, with the caller's
+# Authorization header, and they all share the batch's pooled connection.
+BATCH_HEADERS = ('X-Next-Cursor', 'Link', 'Location', 'ETag')
+
+def batch_subrequest(item, conn):
+    """Run one {"method", "path", "body", "headers"} sub-request on conn and return its result."""
+    path = item.get("path") if isinstance(item, dict) else None
+    if not isinstance(path, str) or not path.startswith("/api/") or path.split("?")[0].rstrip("/") == "/api/batch":
+        return {"status": 400, "headers": {}, "body": {"error": "path must be an /api/ route other than /api/batch"}}
+    headers = {"Authorization": request.headers["Authorization"]} if "Authorization" in request.headers else {}
+    if isinstance(item.get("headers"), dict):
+        headers.update({str(k): str(v) for k, v in item["headers"].items()})
+    body = {"json": item["body"]} if item.get("body") is not None else {}
+    environ = EnvironBuilder(path, base_url=request.host_url, method=str(item.get("method") or "GET").upper(), headers=headers, **body).get_environ()
+    # A fresh app context keeps the sub-request's g apart from ours; the shared
+    # connection is taken back out before its teardown would return it to the pool.
+    with app.app_context():
+        if conn is not None:
+            g.db_conn = conn
+        try:
+            with app.request_context(environ):
+                try:
+                    resp = app.full_dispatch_request()
+                except Exception as e:
+                    resp = app.make_response(app.handle_exception(e))
+        finally:
+            g.pop('db_conn', None)
+    try:
+        if resp.is_streamed and resp.content_length is None:
+            return {"status": 400, "headers": {}, "body": {"error": "streamed responses can't be batched"}}
+        return {"status": resp.status_code, "headers": {h: resp.headers[h] for h in BATCH_HEADERS if h in resp.headers},
+                "body": resp.get_json(silent=True) if resp.is_json else resp.get_data(as_text=True)}
+    finally:
+        resp.close()
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Run up to MAX_BATCH_SIZE requests in order and return every result.
+
+    Accepts a list of {"method", "path", "body"}, or {"requests": [...], "atomic": true}
+    to apply all the writes or none of them in one transaction (SQLite only).
+    """
+    data = request.get_json(silent=True)
+    items = data if isinstance(data, list) else (data or {}).get('requests')
+    atomic = isinstance(data, dict) and bool(data.get('atomic'))
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "requests list required"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"at most {MAX_BATCH_SIZE} requests per batch"}), 400
+    if atomic and use_mongo:
+        raise ApiError("atomic batches need the SQLite backend", 501)
+    if atomic and any(not isinstance(i, dict) or str(i.get("method") or "GET").upper() in ("GET", "HEAD") for i in items):
+        raise ApiError("atomic batches can only contain writes")
+    conn = None if use_mongo else get_conn()
+    results, failed = [], None
+    if atomic:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.held, conn.aborted = True, False
+    try:
+        for i, item in enumerate(items):
+            results.append(dict(index=i, **batch_subrequest(item, conn)))
+            if atomic and (results[-1]["status"] >= 400 or conn.aborted):
+                failed = i
+                break
+    finally:
+        if atomic:
+            conn.held = False
+            if failed is None and len(results) == len(items):
+                conn.commit()
+            else:
+                conn.rollback()
+    if failed is not None:
+        for r in results[:failed]:
+            r.update(status=424, headers={}, body={"error": f"rolled back: request {failed} failed"})
+        results += [{"index": i, "status": 424, "headers": {}, "body": {"error": f"not run: request {failed} failed"}}
+                    for i in range(failed + 1, len(items))]
+    ok = sum(r["status"] < 400 for r in results)
+    return jsonify({"succeeded": ok, "failed": len(results) - ok, "results": results})
 
 # Health endpoint
 @app.route('/api/health', methods=['GET'])
 def health():
     return jsonify({"status":"ok"})
 
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """Counts, plus the appointments booked for today and for the days after it, all from the counters and the per-day rollup."""
+    # Bookings, seeds and imports store UTC datetimes, so "today" is the UTC day.
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    if use_mongo:
+        counts = db.counters.find_one({"_id": "stats"}) or {}
+        day = db.appointment_days.find_one({"_id": today}) or {}
+        later = list(db.appointment_days.aggregate([{"$match": {"_id": {"$gt": today}}}, {"$group": {"_id": None, "n": {"$sum": "$total"}}}]))
+        return jsonify({
+            "patients": counts.get("patients", 0), "doctors": counts.get("doctors", 0),
+            "appointments": counts.get("appointments", 0), "users": counts.get("users", 0),
+            "today": day.get("total", 0), "upcoming": later[0]["n"] if later else 0,
+        })
+    cur = get_conn().cursor()
+    counts = {r["name"]: r["value"] for r in cur.execute("SELECT name, value FROM counter").fetchall()}
+    today_row = cur.execute("SELECT total FROM appointment_day WHERE day = ?", (today,)).fetchone()
+    later = cur.execute("SELECT COALESCE(SUM(total), 0) FROM appointment_day WHERE day > ?", (today,)).fetchone()[0]
+    return jsonify({
+        "patients": counts.get("patients", 0), "doctors": counts.get("doctors", 0),
+        "appointments": counts.get("appointments", 0), "users": counts.get("users", 0),
+        "today": today_row["total"] if today_row else 0, "upcoming": later,
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition, for admins or `Authorization: Bearer <METRICS_TOKEN>`; METRICS_PUBLIC=1 opens it to anyone."""
+    if not METRICS_PUBLIC and not (METRICS_TOKEN and secrets.compare_digest(session_token() or '', METRICS_TOKEN)):
+        user = current_user()
+        if not user:
+            return jsonify({"error": "authentication required"}), 401
+        if not user.get("is_admin"):
+            return jsonify({"error": "admin only"}), 403
+    if not use_mongo:
+        stats = pool.stats()
+        for state in ("open", "in_use", "idle"):
+            metrics.set("hms_db_pool_connections", (("state", state),), stats[state])
+    for key, value in response_cache.stats().items():
+        metrics.set("hms_response_cache", (("stat", key),), value)
+    for (r, kind), index in list(name_indexes.items()):
+        if r is repos():
+            for key, value in index.stats().items():
+                metrics.set("hms_name_index", (("kind", kind), ("stat", key)), value)
+    metrics.set("hms_sessions_cached", (), sessions.stats()["sessions"])
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/admin/pool', methods=['GET'])
+@require_auth(admin=True)
+def admin_pool():
+    if use_mongo:
+        return jsonify({"backend": "mongo", "max_pool_size": DB_POOL_SIZE, "wait_timeout": DB_POOL_TIMEOUT})
+    return jsonify(dict(pool.stats(), backend="sqlite"))
+
+@app.route('/api/admin/sessions', methods=['GET'])
+@require_auth(admin=True)
+def admin_sessions():
+    return jsonify(sessions.stats())
+
+@app.route('/api/admin/cache', methods=['GET'])
+@require_auth(admin=True)
+def admin_cache():
+    return jsonify(response_cache.stats())
+
 @app.route('/api/admin/users', methods=['GET'])
+@require_auth(admin=True)
+@versioned("users")
 def admin_users():
-    if use_mongo:
-        rows = list(db.users.find({}, {"name":1,"email":1,"is_admin":1,"created_at":1}).sort("_id", 1))
-        return jsonify([{ "id": str(r.get("_id")), "name": r.get("name",""), "email": r.get("email",""), "is_admin": r.get("is_admin",0), "created_at": r.get("created_at","") } for r in rows])
-    conn = get_conn()
-    rows = conn.execute("SELECT id, name, email, is_admin, created_at FROM user ORDER BY id").fetchall()
-    conn.close()
-    return jsonify([{ "id": r["id"], "name": r["name"], "email": r["email"], "is_admin": r["is_admin"], "created_at": r["created_at"] } for r in rows])
+    limit, after = page_args()
+    stream = stream_format()
+    is_admin = request.args.get('is_admin')
+    items = repos().users.find(after=after, is_admin=None if is_admin is None else int_arg(is_admin, "is_admin"), limit=fetch_limit(limit, stream), stream=bool(stream))
+    if stream:
+        return stream_response(items, stream)
+    return paged_response(items, limit, lambda u: str(u["id"]))
+
+@app.route('/api/admin/users/search', methods=['GET'])
+@require_auth(admin=True)
+@versioned("users")
+def admin_search_users():
+    """Ranked prefix search on name and email."""
+    q, tokens, limit, after = search_args()
+    users = repos().users
+    return paged_response(users.search(q, tokens, after=after, limit=limit + 1), limit, users.search_cursor)
 
 @app.route('/api/admin/users/<uid>/make_admin', methods=['POST'])
+@require_auth(admin=True)
 def admin_make(uid):
-    if use_mongo:
-        try:
-            oid = ObjectId(uid)
-        except Exception:
-            return jsonify({"error":"invalid id"}), 400
-        existing = db.users.find_one({"is_admin": 1})
-        if existing and existing.get('_id') != oid:
-            return jsonify({"error":"admin already exists"}), 409
-        db.users.update_one({"_id": oid}, {"$set": {"is_admin": 1}})
-        return jsonify({"id": uid, "is_admin": 1})
-    try:
-        uid_int = int(uid)
-    except Exception:
-        return jsonify({"error":"invalid id"}), 400
-    conn = get_conn()
-    cur = conn.cursor()
-    row = cur.execute("SELECT id FROM user WHERE is_admin = 1 LIMIT 1").fetchone()
-    if row and row[0] != uid_int:
-        conn.close()
+    users = repos().users
+    uid = users.parse_id(uid)
+    admin = users.admin_id()
+    if admin is not None and admin != uid:
         return jsonify({"error":"admin already exists"}), 409
-    cur.execute("UPDATE user SET is_admin = 1 WHERE id = ?", (uid_int,))
-    conn.commit()
-    conn.close()
-    return jsonify({"id": uid_int, "is_admin": 1})
+    users.set_admin(uid, 1)
+    sessions.forget_user(uid)
+    return jsonify({"id": uid, "is_admin": 1})
 
 @app.route('/api/admin/users/<uid>/remove_admin', methods=['POST'])
+@require_auth(admin=True)
 def admin_remove(uid):
-    if use_mongo:
-        try:
-            oid = ObjectId(uid)
-        except Exception:
-            return jsonify({"error":"invalid id"}), 400
-        db.users.update_one({"_id": oid}, {"$set": {"is_admin": 0}})
-        return jsonify({"id": uid, "is_admin": 0})
-    try:
-        uid_int = int(uid)
-    except Exception:
-        return jsonify({"error":"invalid id"}), 400
-    conn = get_conn()
-    conn.execute("UPDATE user SET is_admin = 0 WHERE id = ?", (uid_int,))
-    conn.commit()
-    conn.close()
-    return jsonify({"id": uid_int, "is_admin": 0})
+    users = repos().users
+    uid = users.parse_id(uid)
+    users.set_admin(uid, 0)
+    sessions.forget_user(uid)
+    return jsonify({"id": uid, "is_admin": 0})
 
 @app.route('/api/admin/clear', methods=['POST'])
+@require_auth(admin=True)
 def admin_clear():
-    if use_mongo:
-        db.appointments.delete_many({})
-        db.patients.delete_many({})
-        db.doctors.delete_many({})
-        return jsonify({"cleared": True})
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM appointment")
-    cur.execute("DELETE FROM patient")
-    cur.execute("DELETE FROM doctor")
-    conn.commit()
-    conn.close()
-    return jsonify({"cleared": True})
+    """Delete every appointment, patient and doctor in a background job; poll /api/jobs/<id>."""
+    return job_response(job_runner.submit("clear", created_by=g.user["id"]))
+
+# ---------- Static assets ----------
+# The pages, assets.js and assets.css are read once into memory along with gzip
+# (and, with the brotli package, br) copies, so serving one is a dict lookup. The
+# pages link assets as /assets.js?v=<hash>; a request carrying the current hash
+# may be cached for a year, anything else revalidates against the content ETag.
+# Only files with these extensions in the project directory are served; other
+# extensionless paths get index.html. In debug mode the directory is re-checked
+# at most once a second and the table rebuilt when a file changes.
+ASSET_EXTENSIONS = {".html": "text/html; charset=utf-8", ".js": "text/javascript; charset=utf-8",
+                    ".css": "text/css; charset=utf-8", ".svg": "image/svg+xml", ".ico": "image/x-icon", ".png": "image/png"}
+COMPRESSIBLE = (".html", ".js", ".css", ".svg")
+_ASSET_LINK = re.compile(r'((?:src|href)=")/([\w.-]+)(")')
+
+class AssetTable:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._assets = {}
+        self._stamp = None
+        self._checked = 0.0
+
+    def _scan(self):
+        with os.scandir(self.root) as entries:
+            return tuple(sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in entries
+                                if e.is_file() and os.path.splitext(e.name)[1] in ASSET_EXTENSIONS))
+
+    @staticmethod
+    def _entry(name, data):
+        digest = hashlib.blake2b(data, digest_size=12).hexdigest()
+        variants = {"identity": data}
+        if name.endswith(COMPRESSIBLE):
+            variants["gzip"] = gzip.compress(data, 9, mtime=0)
+            if HAVE_BROTLI:
+                variants["br"] = brotli.compress(data, quality=11)
+        return {"type": ASSET_EXTENSIONS[os.path.splitext(name)[1]], "hash": digest,
+                "variants": {k: v for k, v in variants.items() if k == "identity" or len(v) < len(data)}}
+
+    def load(self):
+        stamp = self._scan()
+        files = {}
+        for name, _, _ in stamp:
+            with open(os.path.join(self.root, name), 'rb') as f:
+                files[name] = f.read()
+        assets = {n: self._entry(n, d) for n, d in files.items() if not n.endswith(".html")}
+        def versioned(m):
+            asset = assets.get(m.group(2))
+            return m.group(0) if asset is None else f'{m.group(1)}/{m.group(2)}?v={asset["hash"]}{m.group(3)}'
+        for name, data in files.items():
+            if name.endswith(".html"):
+                assets[name] = self._entry(name, _ASSET_LINK.sub(versioned, data.decode("utf-8")).encode("utf-8"))
+        with self._lock:
+            self._assets, self._stamp = assets, stamp
+        return assets
+
+    def get(self, name):
+        if app.debug and time.monotonic() - self._checked >= 1:
+            self._checked = time.monotonic()
+            if self._scan() != self._stamp:
+                self.load()
+        return self._assets.get(name)
 
-# Serve the frontend index.html and other static files from project dir
-@app.route('/', defaults={'path': ''})
+asset_table = AssetTable(BASE_DIR)
+asset_table.load()
+
+@app.route('/', defaults={'path': 'index.html'})
 @app.route('/<path:path>')
 def serve_frontend(path):
-    full_path = os.path.join(BASE_DIR, path)
-    if path != "" and os.path.exists(full_path) and not os.path.isdir(full_path):
-        return send_from_directory(BASE_DIR, path)
-    return send_from_directory(BASE_DIR, 'index.html')
+    asset = asset_table.get(path)
+    if asset is None and not path.startswith('api/') and '.' not in path.rsplit('/', 1)[-1]:
+        asset = asset_table.get('index.html')
+    if asset is None:
+        abort(404)
+    accepted = request.accept_encodings
+    encoding = next((e for e in ("br", "gzip") if e in asset["variants"] and accepted[e]), "identity")
+    etag = asset["hash"] if encoding == "identity" else f'{asset["hash"]}-{encoding}'
+    headers = {"Vary": "Accept-Encoding",
+               "Cache-Control": f"public, max-age={ASSET_MAX_AGE}, immutable" if request.args.get('v') == asset["hash"] else "no-cache"}
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304, headers=headers)
+    else:
+        resp = Response(asset["variants"][encoding], content_type=asset["type"], headers=headers)
+        if encoding != "identity":
+            resp.headers["Content-Encoding"] = encoding
+    resp.set_etag(etag)
+    return resp
+
+# ---------- Serving ----------
+# wsgi.py calls create_app() once in the pre-fork master (preload), so the schema
+# is migrated a single time; gunicorn.conf.py then calls after_fork() in each
+# worker and shutdown() as workers and the master exit.
+_initialized = False
+
+def create_app():
+    global _initialized
+    if not _initialized:
+        with app.app_context():
+            init_db()
+            repos().jobs.abandon("interrupted by restart")
+        # SQLite handles must not cross a fork; each worker opens its own on first use.
+        pool.close_all()
+        _initialized = True
+    return app
+
+def after_fork():
+    # MongoClient isn't fork-safe, so every worker gets a fresh client.
+    if use_mongo:
+        connect_mongo(create_indexes=False)
+
+def shutdown():
+    """Drain the pools: end change streams, stop background jobs and the hashing processes, then close idle database connections."""
+    change_feed.close()
+    job_runner.shutdown()
+    hasher.shutdown()
+    pool.close_all()
+    if mongo_client is not None:
+        mongo_client.close()
+
+def specialty_weights(value):
+    """argparse type for `seed --specialties`: NAME=WEIGHT[,NAME=WEIGHT...]."""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        try:
+            mix[name.strip()] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"expected NAME=WEIGHT, got {part!r}")
+        if not name.strip():
+            raise argparse.ArgumentTypeError(f"expected NAME=WEIGHT, got {part!r}")
+    return mix
 
 if __name__ == '__main__':
-    init_db()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    parser = argparse.ArgumentParser(description="Hospital Management System")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help="run the development server (default)")
+    commands.add_parser('migrate', help="apply schema migrations")
+    commands.add_parser('explain', help="print query plans for the hot queries")
+    importer = commands.add_parser('import', help="bulk import a CSV or NDJSON file")
+    importer.add_argument('kind', choices=sorted(IMPORT_KINDS))
+    importer.add_argument('path')
+    importer.add_argument('--format', choices=['csv', 'ndjson'])
+    seeder = commands.add_parser('seed', help="generate a synthetic hospital (needs numpy)")
+    seeder.add_argument('--patients', type=int, default=0)
+    seeder.add_argument('--doctors', type=int, default=0)
+    seeder.add_argument('--appointments', type=int, help="exact count (default: --density of every doctor slot)")
+    seeder.add_argument('--density', type=float, default=0.25)
+    seeder.add_argument('--from', dest='start', help="first appointment day, YYYY-MM-DD (default today)")
+    seeder.add_argument('--days', type=int, default=30)
+    seeder.add_argument('--specialties', type=specialty_weights, help="weights, e.g. Cardiology=3,Neurology=1")
+    seeder.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    args.command = args.command or 'run'
+    with app.app_context():
+        init_db()
+        if args.command == 'migrate':
+            print(f"schema version {get_conn().execute('PRAGMA user_version').fetchone()[0]}")
+        elif args.command == 'explain':
+            sys.exit(0 if explain_hot_queries(get_conn()) else 1)
+        elif args.command == 'import':
+            result = import_file(args.kind, args.path, args.format)
+            print(json.dumps({k: v for k, v in result.items() if k != "errors"}))
+            sys.exit(0 if not result["failed"] else 1)
+        elif args.command == 'seed':
+            try:
+                params = seed_params({"patients": args.patients, "doctors": args.doctors, "appointments": args.appointments, "density": args.density,
+                                      "from": args.start, "days": args.days, "specialties": args.specialties, "seed": args.seed})
+            except ApiError as e:
+                seeder.error(str(e))
+            start = time.perf_counter()
+            for step in generate_data(**params):
+                print(f"{step['processed']}/{step['total']} rows", file=sys.stderr)
+            print(json.dumps(dict(step, seconds=round(time.perf_counter() - start, 3))))
+        else:
+            repos().jobs.abandon("interrupted by restart")
+    if args.command == 'run':
+        app.run(host='0.0.0.0', port=5000, debug=True)
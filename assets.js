@@ -17,9 +17,15 @@ function showToast(msg, type){
 function getUser(){
   try{return JSON.parse(localStorage.getItem('hms_user')||'null')}catch(e){return null}
 }
+function authHeaders(){
+  const u = getUser();
+  return u && u.token ? {'Authorization': 'Bearer ' + u.token} : {};
+}
 function logout(){
+  const headers = authHeaders();
   localStorage.removeItem('hms_user');
-  location.href = '/login.html';
+  const base = (typeof API !== 'undefined') ? API : '/api';
+  fetch(base + '/auth/logout', {method:'POST', headers}).catch(()=>{}).finally(()=>{ location.href = '/login.html'; });
 }
 function renderNavUser(){
   const el = document.getElementById('navUser');
@@ -33,3 +39,103 @@ function renderNavUser(){
   }
 }
 document.addEventListener('DOMContentLoaded', renderNavUser)
+async function fetchPage(url, opts){
+  const res = await fetch(url, opts);
+  if(!res.ok){
+    const ct = res.headers.get('content-type') || '';
+    let msg;
+    if(ct.includes('application/json')){
+      const j = await res.json(); msg = j.error || j.message || res.statusText;
+    } else {
+      msg = (await res.text()) || res.statusText;
+    }
+    throw new Error(msg);
+  }
+  return {items: await res.json(), next: res.headers.get('X-Next-Cursor')};
+}
+// Keeps the cursor stack for a Prev/Next pager over a keyset-paginated list.
+function makePager(prevBtn, nextBtn, load){
+  const pager = {cursors: [null], next: null};
+  pager.update = (next)=>{
+    pager.next = next;
+    prevBtn.disabled = pager.cursors.length <= 1;
+    nextBtn.disabled = !next;
+  };
+  pager.reset = ()=>{ pager.cursors = [null]; return load(null); };
+  pager.reload = ()=> load(pager.cursors[pager.cursors.length-1]);
+  prevBtn.addEventListener('click', ()=>{ if(pager.cursors.length > 1){ pager.cursors.pop(); pager.reload(); } });
+  nextBtn.addEventListener('click', ()=>{ if(pager.next){ pager.cursors.push(pager.next); pager.reload(); } });
+  return pager;
+}
+function pageQuery(cursor, pageSize){
+  return `limit=${pageSize}` + (cursor ? `&after=${encodeURIComponent(cursor)}` : '');
+}
+function debounce(fn, ms){
+  let timer = null;
+  return (...args)=>{ clearTimeout(timer); timer = setTimeout(()=>fn(...args), ms); };
+}
+// Polls a background job (as returned with 202 by /api/seed, /api/admin/clear, ...) until it finishes.
+// Job status needs a signed-in user; without one the job runs on unwatched.
+async function waitForJob(base, job, onProgress){
+  while(job.status === 'queued' || job.status === 'running'){
+    if(onProgress) onProgress(job);
+    await new Promise(r=>setTimeout(r, 500));
+    const res = await fetch(`${base}/jobs/${job.id}`, {headers: authHeaders()});
+    if(res.status === 401) return job;
+    if(!res.ok) throw new Error(res.statusText);
+    job = await res.json();
+  }
+  if(job.status === 'failed') throw new Error(job.error || 'Job failed');
+  return job;
+}
+// Follows /changes from a version: live over server-sent events, or by polling
+// when EventSource is missing or the server is out of stream slots. apply() gets
+// each event once, in order; {op:'reset'} means the page should reload its lists.
+function followChanges(base, kinds, version, apply){
+  const feed = {version};
+  const handle = (c)=>{ if(c.version <= feed.version) return; feed.version = c.version; apply(c); };
+  const reset = (v)=>{ feed.version = v; apply({op:'reset', version:v}); };
+  feed.sync = async ()=>{
+    let page;
+    do{
+      const res = await fetch(`${base}/changes?since=${feed.version}&kinds=${kinds}`, {headers: authHeaders()});
+      if(!res.ok) return;
+      page = await res.json();
+      if(page.reset) return reset(page.version);
+      page.changes.forEach(handle);
+      feed.version = Math.max(feed.version, page.version);
+    }while(page.more);
+  };
+  const poll = ()=>{ if(!feed.timer) feed.timer = setInterval(feed.sync, 5000); };
+  if(!window.EventSource) poll();
+  else{
+    const es = new EventSource(`${base}/changes/stream?since=${version}&kinds=${kinds}`);
+    es.addEventListener('change', e=>handle(JSON.parse(e.data)));
+    es.addEventListener('reset', e=>reset(JSON.parse(e.data).version));
+    es.onerror = ()=>{ if(es.readyState === EventSource.CLOSED) poll(); };
+  }
+  return feed;
+}
+// Runs several API requests in one POST /batch round trip. Each request is a path
+// under base (a GET) or {method, path, body}; results come back in the same order
+// as {status, headers, body}. batchPage() turns a list result into fetchPage()'s shape.
+async function batch(base, requests, atomic){
+  const prefix = new URL(base, location.href).pathname;
+  const res = await fetch(`${base}/batch`, {
+    method: 'POST',
+    headers: Object.assign({'Content-Type': 'application/json'}, authHeaders()),
+    body: JSON.stringify({atomic: !!atomic, requests: requests.map(r=>typeof r === 'string' ? {method:'GET', path: prefix + r} : Object.assign({}, r, {path: prefix + r.path}))}),
+  });
+  if(!res.ok){
+    const j = await res.json().catch(()=>({}));
+    throw new Error(j.error || res.statusText);
+  }
+  return (await res.json()).results;
+}
+function batchBody(result){
+  if(result.status >= 400) throw new Error((result.body && result.body.error) || `request failed (${result.status})`);
+  return result.body;
+}
+function batchPage(result){
+  return {items: batchBody(result), next: result.headers['X-Next-Cursor'] || null};
+}
@@ -0,0 +1,364 @@
+"""Load-test the HTTP API against a synthetic hospital.
+
+    python bench.py --backend sqlite --patients 100000 --doctors 500 --appointments 1000000
+    python bench.py --backend mongomock --requests 5000 --out bench-mongo.json
+    python bench.py --compare bench-before.json --out bench-after.json
+
+The dataset goes in through the bulk import path (app.import_records). A
+weighted mix of list, availability, book, cancel and login requests is then
+driven from --concurrency threads, in-process through the Flask test client
+and/or over localhost through a threaded HTTP server. The report gives
+throughput and p50/p95/p99 latency per route and is written as JSON.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+BASE_DAY = datetime(2030, 1, 1)
+DAY_SLOTS = 8  # 09:00-16:00 on the hour, the default SLOT_MINUTES grid
+SPECIALTIES = ["Cardiology", "Neurology", "Pediatrics", "Orthopedics", "Dermatology", "Oncology", "General"]
+DEFAULT_MIX = "list_patients=20,list_doctors=10,list_appointments=20,availability=15,book=20,cancel=10,login=5"
+BENCH_PASSWORD = "bench-password"
+BENCH_USERS = 4
+
+# ---------- Backend ----------
+def load_app(backend, db_path):
+    """Import app.py wired to a fresh SQLite file or an in-memory mongomock database."""
+    os.environ['DB_PATH'] = db_path
+    os.environ.pop('MONGODB_URI', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    if backend == 'mongomock':
+        import mongomock
+        app.MongoClient = mongomock.MongoClient
+        app.MONGODB_URI = 'mongodb://bench'
+        app.connect_mongo()
+        app.use_mongo = True
+    with app.app.app_context():
+        app.init_db()
+    return app
+
+# ---------- Dataset ----------
+def slot_datetime(slot):
+    day, hour = divmod(slot, DAY_SLOTS)
+    return (BASE_DAY + timedelta(days=day, hours=9 + hour)).strftime("%Y-%m-%d %H:%M")
+
+def import_kind(app, kind, rows):
+    started = time.perf_counter()
+    for progress in app.import_records(kind, enumerate(rows, start=1)):
+        if not progress.get("done"):
+            print(f"  {kind}: {progress['inserted']} inserted", end="\r", file=sys.stderr)
+    print(f"  {kind}: {progress['inserted']} inserted, {progress['failed']} failed", file=sys.stderr)
+    return {"inserted": progress["inserted"], "failed": progress["failed"], "seconds": round(time.perf_counter() - started, 3)}
+
+def all_ids(repo):
+    return [row["id"] for row in repo.find(stream=True)]
+
+def populate(app, patients, doctors, appointments, rng):
+    """Bulk-load the synthetic hospital and return (timings, patient ids, doctor ids, slots used)."""
+    timings = {}
+    timings["patients"] = import_kind(app, "patients", (
+        {"name": f"Patient {i}", "age": rng.randint(0, 99), "contact": f"555-{i:07d}", "address": f"{i} Bench Street"}
+        for i in range(patients)))
+    timings["doctors"] = import_kind(app, "doctors", (
+        {"name": f"Dr. Bench {i}", "specialty": SPECIALTIES[i % len(SPECIALTIES)], "contact": f"556-{i:07d}"}
+        for i in range(doctors)))
+    repos = app.repos()
+    pids, dids = all_ids(repos.patients), all_ids(repos.doctors)
+    # Appointment k takes doctor k % D in slot k // D; with D <= P every patient in
+    # a slot is distinct too, so the generated rows never hit a unique index.
+    width = min(len(dids), len(pids))
+    timings["appointments"] = import_kind(app, "appointments", (
+        {"patient_id": pids[k % len(pids)], "doctor_id": dids[k % width], "datetime": slot_datetime(k // width)}
+        for k in range(appointments))) if width else {"inserted": 0, "failed": 0, "seconds": 0}
+    used_slots = -(-appointments // width) if width else 0
+    return timings, pids, dids, used_slots
+
+def create_users(app):
+    client = app.app.test_client()
+    emails = []
+    for i in range(BENCH_USERS):
+        email = f"bench{i}@example.com"
+        client.post('/api/auth/signup', json={"name": f"Bench {i}", "email": email, "password": BENCH_PASSWORD})
+        emails.append(email)
+    return emails
+
+# ---------- Transports ----------
+class InProcess:
+    name = "inprocess"
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        client = self.app.app.test_client()
+        def call(method, path, body=None):
+            resp = client.open(path, method=method, json=body)
+            data = resp.get_data()
+            return resp.status_code, data
+        return call
+
+class QuietHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real client
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+class Localhost:
+    name = "http"
+
+    def __init__(self, app=None, url=None):
+        self.server = None
+        if url:
+            host, _, port = url.split("://", 1)[-1].rstrip("/").partition(":")
+            self.host, self.port = host, int(port or 80)
+            return
+        self.server = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=QuietHandler)
+        self.host, self.port = "127.0.0.1", self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def session(self):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        def call(method, path, body=None):
+            nonlocal conn
+            payload = json.dumps(body) if body is not None else None
+            headers = {"Content-Type": "application/json"} if payload else {}
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+            return resp.status, resp.read()
+        return call
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+
+# ---------- Workload ----------
+# Each operation returns (route label, method, path, body). Only the statuses
+# EXPECTED for its route count as successes: a 409 on a contended slot is the API
+# working, but a 401 or 404 anywhere means the workload itself is broken.
+EXPECTED = {
+    "POST /api/appointments": {201, 409},
+    "DELETE /api/appointments/<id>": {200},
+    "POST /api/auth/login": {200},
+}
+EXPECTED_GET = {200, 304}
+
+class Workload:
+    def __init__(self, pids, dids, emails, used_slots, rng_seed):
+        self.pids, self.dids, self.emails = pids, dids, emails
+        # New bookings land in the days right after the generated ones, so some of them collide.
+        self.first_slot = used_slots
+        self.seed = rng_seed
+
+    def operations(self, rng, booked):
+        pid, did = (rng.choice(self.pids) if self.pids else 1), (rng.choice(self.dids) if self.dids else 1)
+        day = (BASE_DAY + timedelta(days=self.first_slot // DAY_SLOTS + rng.randrange(7))).strftime("%Y-%m-%d")
+        return {
+            "list_patients": lambda: ("GET /api/patients", "GET", f"/api/patients?limit=50&after={rng.choice(self.pids) if self.pids else 0}", None),
+            "list_doctors": lambda: ("GET /api/doctors", "GET", f"/api/doctors?limit=50&specialty={rng.choice(SPECIALTIES)}", None),
+            "list_appointments": lambda: ("GET /api/appointments", "GET", f"/api/appointments?limit=50&doctor_id={did}", None),
+            "availability": lambda: ("GET /api/doctors/<id>/availability", "GET", f"/api/doctors/{did}/availability?from={day}", None),
+            "book": lambda: ("POST /api/appointments", "POST", "/api/appointments",
+                             {"patient_id": pid, "doctor_id": did, "datetime": slot_datetime(self.first_slot + rng.randrange(7 * DAY_SLOTS))}),
+            "cancel": lambda: ("DELETE /api/appointments/<id>", "DELETE", f"/api/appointments/{booked.pop()}", None) if booked else None,
+            "login": lambda: ("POST /api/auth/login", "POST", "/api/auth/login", {"email": rng.choice(self.emails), "password": BENCH_PASSWORD}),
+        }
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(DEFAULT_MIX_NAMES)
+    if unknown:
+        raise SystemExit(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+DEFAULT_MIX_NAMES = [p.split("=")[0] for p in DEFAULT_MIX.split(",")]
+
+def run_load(transport, workload, mix, requests, concurrency):
+    """Fire `requests` operations from `concurrency` threads; returns wall seconds and per-route samples."""
+    names, weights = list(mix), list(mix.values())
+    samples = {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    def worker(n):
+        rng = random.Random(workload.seed * 1000 + n)
+        call = transport.session()
+        booked = []
+        local = {}
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            ops = workload.operations(rng, booked)
+            op = ops[rng.choices(names, weights)[0]]() or ops["book"]()
+            label, method, path, body = op
+            started = time.perf_counter()
+            status, data = call(method, path, body)
+            elapsed = time.perf_counter() - started
+            if label == "POST /api/appointments" and status == 201:
+                booked.append(json.loads(data)["id"])
+            local.setdefault(label, []).append((elapsed, status))
+        with lock:
+            for label, rows in local.items():
+                samples.setdefault(label, []).extend(rows)
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, samples
+
+# ---------- Report ----------
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile.
+    return sorted_values[max(0, math.ceil(q / 100 * len(sorted_values)) - 1)]
+
+def summarize(wall, samples):
+    routes = {}
+    for label, rows in sorted(samples.items()):
+        latencies = sorted(e * 1000 for e, _ in rows)
+        statuses = {}
+        for _, s in rows:
+            statuses[str(s)] = statuses.get(str(s), 0) + 1
+        routes[label] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, s in rows if s not in EXPECTED.get(label, EXPECTED_GET)),
+            "statuses": statuses,
+            "throughput_rps": round(len(rows) / wall, 2) if wall else 0,
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "max_ms": round(latencies[-1], 3),
+        }
+    total = sum(r["requests"] for r in routes.values())
+    return {"seconds": round(wall, 3), "requests": total, "throughput_rps": round(total / wall, 2) if wall else 0, "routes": routes}
+
+def print_report(result):
+    for transport, run in result["runs"].items():
+        print(f"\n[{result['backend']} / {transport}] {run['requests']} requests in {run['seconds']}s = {run['throughput_rps']} req/s")
+        print(f"  {'route':38} {'n':>7} {'err':>5} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for label, r in run["routes"].items():
+            print(f"  {label:38} {r['requests']:>7} {r['errors']:>5} {r['throughput_rps']:>9} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9}")
+
+def compare(result, baseline_path):
+    """Print per-route p50/p95/p99 and throughput change against an earlier JSON report."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nchange vs {baseline_path} (negative latency / positive rps = better)")
+    for transport, run in result["runs"].items():
+        before = baseline.get("runs", {}).get(transport)
+        if not before:
+            continue
+        for label, r in run["routes"].items():
+            b = before["routes"].get(label)
+            if not b:
+                continue
+            deltas = []
+            for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+                pct = (r[key] - b[key]) / b[key] * 100 if b[key] else 0.0
+                deltas.append(f"{key.split('_')[0]} {pct:+.1f}%")
+            print(f"  {transport:9} {label:38} " + "  ".join(deltas))
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the Hospital Management System API")
+    parser.add_argument('--backend', choices=['sqlite', 'mongomock'], default='sqlite')
+    parser.add_argument('--db', help="SQLite file to use (default: a temporary file, deleted afterwards)")
+    parser.add_argument('--patients', type=int, default=10000)
+    parser.add_argument('--doctors', type=int, default=200)
+    parser.add_argument('--appointments', type=int, default=50000)
+    parser.add_argument('--transport', choices=['inprocess', 'http', 'both'], default='both')
+    parser.add_argument('--url', help="benchmark an already running server (e.g. gunicorn) instead of a local one; its data must already be loaded")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per transport")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"weighted operations (default {DEFAULT_MIX})")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--populate-only', action='store_true', help="load the dataset into --db and exit")
+    parser.add_argument('--out', default='bench-results.json')
+    parser.add_argument('--compare', help="earlier JSON report to diff against")
+    args = parser.parse_args(argv)
+    if args.populate_only and args.backend != 'sqlite':
+        parser.error("--populate-only needs the sqlite backend; mongomock data lives in this process")
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+
+    tmp_dir = None if args.db else tempfile.mkdtemp(prefix="hms-bench-")
+    db_path = args.db or os.path.join(tmp_dir, "bench.db")
+    app = load_app(args.backend, db_path)
+    print(f"populating {args.backend}: {args.patients} patients, {args.doctors} doctors, {args.appointments} appointments", file=sys.stderr)
+    timings, pids, dids, used_slots = populate(app, args.patients, args.doctors, args.appointments, rng)
+    emails = create_users(app)
+    if args.populate_only:
+        print(json.dumps(timings))
+        return 0
+    workload = Workload(pids, dids, emails, used_slots, args.seed)
+
+    transports = []
+    if args.url:
+        transports.append(Localhost(url=args.url))
+    else:
+        if args.transport in ('inprocess', 'both'):
+            transports.append(InProcess(app))
+        if args.transport in ('http', 'both'):
+            transports.append(Localhost(app))
+
+    result = {
+        "backend": args.backend,
+        "started_at": datetime.utcnow().isoformat(),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "dataset": {"patients": args.patients, "doctors": args.doctors, "appointments": args.appointments, "populate": timings},
+        "load": {"requests": args.requests, "concurrency": args.concurrency, "mix": mix, "seed": args.seed},
+        "runs": {},
+    }
+    for transport in transports:
+        print(f"running {args.requests} requests over {transport.name} with {args.concurrency} threads", file=sys.stderr)
+        wall, samples = run_load(transport, workload, mix, args.requests, args.concurrency)
+        result["runs"][transport.name] = summarize(wall, samples)
+        if hasattr(transport, "close"):
+            transport.close()
+    app.shutdown()
+    if tmp_dir:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print_report(result)
+    if args.compare:
+        compare(result, args.compare)
+    print(f"\nwrote {args.out}", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+# Pre-fork serving config for wsgi:app; every setting can be overridden from the environment.
+import multiprocessing
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_WORKERS', str(multiprocessing.cpu_count())))
+threads = int(os.environ.get('WEB_THREADS', '4'))
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.environ.get('WEB_TIMEOUT', '30'))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', '5'))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown()
+
+def on_exit(server):
+    import app
+    app.shutdown()
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# app.py opens its pool at import time; point it away from the checked-in hospital.db.
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'hospital.db'))
+os.environ.setdefault('METRICS_ENABLED', '1')
+sys.path.insert(0, ROOT)
+
+import app as hms  # noqa: E402
+
+
+@pytest.fixture(params=['sqlite', 'mongomock'])
+def backend(request, tmp_path, monkeypatch):
+    """A fresh, empty database on each backend; mongomock stands in for MongoDB."""
+    if request.param == 'sqlite':
+        pool = hms.ConnectionPool(str(tmp_path / 'hospital.db'))
+        monkeypatch.setattr(hms, 'pool', pool)
+        monkeypatch.setattr(hms, 'use_mongo', False)
+    else:
+        mongomock = pytest.importorskip('mongomock')
+        monkeypatch.setattr(hms, 'MongoClient', mongomock.MongoClient)
+        monkeypatch.setattr(hms, 'MONGODB_URI', 'mongodb://tests')
+        monkeypatch.setattr(hms, 'db', None, raising=False)
+        monkeypatch.setattr(hms, 'mongo_client', None)
+        hms.connect_mongo()
+        monkeypatch.setattr(hms, 'use_mongo', True)
+    # Per-process caches are keyed on table versions and ids, which restart with every database.
+    monkeypatch.setattr(hms, 'response_cache', hms.ResponseCache())
+    monkeypatch.setattr(hms, 'sessions', hms.SessionStore())
+    monkeypatch.setattr(hms, 'name_indexes', {})
+    monkeypatch.setattr(hms, 'utilization_cubes', {})
+    with hms.app.app_context():
+        hms.init_db()
+    yield request.param
+    if request.param == 'sqlite':
+        pool.close_all()
+
+
+@pytest.fixture
+def client(backend):
+    return hms.app.test_client()
+
+
+@pytest.fixture
+def missing_id(backend):
+    return '0' * 24 if backend == 'mongomock' else 999999
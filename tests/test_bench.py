@@ -0,0 +1,24 @@
+"""Smoke run of bench.py end to end on a tiny hospital, so the harness keeps working."""
+import json
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'mongomock'])
+def test_bench_smoke(backend, tmp_path):
+    if backend == 'mongomock':
+        pytest.importorskip('mongomock')
+    out = tmp_path / 'bench.json'
+    proc = subprocess.run(
+        [sys.executable, 'bench.py', '--backend', backend, '--patients', '40', '--doctors', '4', '--appointments', '60',
+         '--requests', '40', '--concurrency', '2', '--transport', 'inprocess', '--out', str(out)],
+        cwd=ROOT, capture_output=True, text=True, timeout=300)
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    result = json.loads(out.read_text())
+    assert result['dataset']['populate']['appointments']['inserted'] == 60
+    routes = result['runs']['inprocess']['routes']
+    assert routes and not {label: r['statuses'] for label, r in routes.items() if r['errors']}
@@ -0,0 +1,753 @@
+"""Conformance suite: SqliteRepos and MongoRepos (on mongomock) must behave the same."""
+import gzip
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import ROOT, hms
+
+
+def repos():
+    return hms.repos()
+
+
+def add_patient(client, name, **fields):
+    resp = client.post('/api/patients', json=dict(fields, name=name))
+    assert resp.status_code == 201
+    return resp.get_json()['id']
+
+
+def add_doctor(client, name, specialty='General'):
+    resp = client.post('/api/doctors', json={"name": name, "specialty": specialty})
+    assert resp.status_code == 201
+    return resp.get_json()['id']
+
+
+def book(client, pid, did, dt):
+    return client.post('/api/appointments', json={"patient_id": pid, "doctor_id": did, "datetime": dt})
+
+
+def sign_in(client, email, admin=False):
+    """Sign up and log in; returns the Authorization header."""
+    assert client.post('/api/auth/signup', json={"name": email, "email": email, "password": "pw"}).status_code == 201
+    if admin:
+        with hms.app.app_context():
+            users = repos().users
+            users.set_admin(users.by_email(email)["id"], 1)
+    token = client.post('/api/auth/login', json={"email": email, "password": "pw"}).get_json()["token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def wait_for_job(client, job, headers):
+    for _ in range(200):
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+        job = client.get(f'/api/jobs/{job["id"]}', headers=headers).get_json()
+    raise AssertionError(f"job {job['id']} still {job['status']}")
+
+
+def walk(client, url, limit):
+    """Follow X-Next-Cursor to the end; returns the pages."""
+    pages, after = [], None
+    while True:
+        sep = '&' if '?' in url else '?'
+        resp = client.get(f"{url}{sep}limit={limit}" + (f"&after={after}" if after else ""))
+        assert resp.status_code == 200
+        pages.append(resp.get_json())
+        after = resp.headers.get('X-Next-Cursor')
+        if not after:
+            return pages
+
+
+# ---------- Repositories ----------
+def test_patient_repo(backend):
+    with hms.app.app_context():
+        r = repos()
+        ids = [r.patients.create(f"P{i}", 30 + i, f"555-{i}", "Street") for i in range(5)]
+        assert len(set(ids)) == 5
+        found = r.patients.find()
+        assert [p["id"] for p in found] == ids
+        assert found[0] == {"id": ids[0], "name": "P0", "age": 30, "contact": "555-0", "address": "Street", "created_at": found[0]["created_at"]}
+        assert [p["id"] for p in r.patients.find(after=str(ids[1]), limit=2)] == ids[2:4]
+        assert [p["id"] for p in r.patients.find(stream=True)] == ids
+        assert r.patients.names(ids[:2]) == {ids[0]: "P0", ids[1]: "P1"}
+        assert r.patients.delete(ids[0]) == 1
+        assert r.patients.delete(ids[0]) == 0
+        assert [p["id"] for p in r.patients.find()] == ids[1:]
+        assert r.counts()["patients"] == 4
+
+
+def test_doctor_repo(backend):
+    with hms.app.app_context():
+        r = repos()
+        a = r.doctors.create("Dr A", "Cardiology", "1")
+        b = r.doctors.create("Dr B", "Neurology", "2")
+        c = r.doctors.create("Dr C", "Cardiology", "3")
+        assert [d["id"] for d in r.doctors.find(specialty="Cardiology")] == [a, c]
+        assert [d["id"] for d in r.doctors.find(ids=[b, c])] == [b, c]
+        assert r.doctors.exists(b)
+        assert r.doctors.delete(b) == 1
+        assert not r.doctors.exists(b)
+        # "c" also prefixes Dr A's specialty; names starting with the query rank first.
+        assert [d["name"] for d in r.doctors.search("dr c", ["dr", "c"], limit=5)] == ["Dr C", "Dr A"]
+
+
+def test_appointment_repo(backend):
+    with hms.app.app_context():
+        r = repos()
+        p1, p2 = r.patients.create("Ann", 1, "", ""), r.patients.create("Bob", 2, "", "")
+        d1, d2 = r.doctors.create("Dr One", "X", ""), r.doctors.create("Dr Two", "X", "")
+        a1 = r.appointments.book(p1, d1, "2030-01-01 10:00")
+        a2 = r.appointments.book(p2, d1, "2030-01-01 09:00")
+        a3 = r.appointments.book(p1, d2, "2030-01-02 09:00")
+        with pytest.raises(hms.ApiError) as e:
+            r.appointments.book(p2, d1, "2030-01-01 10:00")
+        assert e.value.status == 409
+        with pytest.raises(hms.ApiError) as e:
+            r.appointments.book(p1, d2, "2030-01-01 10:00")
+        assert e.value.status == 409
+        listed = r.appointments.find()
+        assert [a["id"] for a in listed] == [a2, a1, a3]
+        assert (listed[0]["patient_name"], listed[0]["doctor_name"]) == ("Bob", "Dr One")
+        assert [a["id"] for a in r.appointments.find(patient_id=str(p1))] == [a1, a3]
+        assert [a["id"] for a in r.appointments.find(doctor_id=str(d1), dt_from="2030-01-01 09:30")] == [a1]
+        assert [a["id"] for a in r.appointments.find(dt_to="2030-01-02 00:00")] == [a2, a1]
+        assert sorted(r.appointments.booked_slots([d1], "2030-01-01 00:00", "2030-01-02 00:00")) == [(d1, "2030-01-01 09:00"), (d1, "2030-01-01 10:00")]
+        assert r.appointments.count(patient_id=p1) == 2
+        assert r.appointments.delete(a1) == 1
+        assert r.appointments.delete(a1) == 0
+        assert r.counts()["appointments"] == 2
+
+
+def test_book_many(backend, missing_id):
+    with hms.app.app_context():
+        r = repos()
+        p = r.patients.create("Ann", 1, "", "")
+        d = r.doctors.create("Dr One", "X", "")
+        parsed = [(0, (p, d, "2030-01-01 09:00")), (1, (p, d, "2030-01-01 09:00")), (2, (r.patients.parse_id(str(missing_id)), d, "2030-01-01 11:00"))]
+        results = [None] * 3
+        created = r.appointments.book_many(parsed, results, atomic=False)
+        assert len(created) == 1
+        assert [x["status"] for x in results] == [201, 409, 404]
+        results = [None] * 1
+        assert r.appointments.book_many([(0, (p, d, "2030-01-01 09:00"))], results, atomic=True) == []
+        assert r.appointments.count() == 1
+
+
+def test_user_repo(backend):
+    with hms.app.app_context():
+        users = repos().users
+        uid = users.create("Ann", "ann@example.com", "hash", 0)
+        assert users.email_exists("ann@example.com")
+        assert not users.email_exists("bob@example.com")
+        assert users.by_email("ann@example.com")["id"] == uid
+        assert users.admin_id() is None
+        users.set_admin(uid, 1)
+        assert users.admin_id() == uid
+        assert [u["id"] for u in users.find(is_admin=1)] == [uid]
+
+
+# ---------- Routes ----------
+def test_booking_status_codes(client, missing_id):
+    pid, other = add_patient(client, "Ann"), add_patient(client, "Bob")
+    did, did2 = add_doctor(client, "Dr One"), add_doctor(client, "Dr Two")
+    assert book(client, pid, did, "2030-01-01 10:00").status_code == 201
+    assert book(client, other, did, "2030-01-01 10:00").get_json() == {"error": "Doctor already booked at this time"}
+    assert book(client, other, did, "2030-01-01 10:00").status_code == 409
+    assert book(client, pid, did2, "2030-01-01 10:00").status_code == 409
+    assert book(client, missing_id, did, "2030-01-01 11:00").status_code == 404
+    assert book(client, pid, missing_id, "2030-01-01 11:00").status_code == 404
+    assert book(client, pid, did, "tomorrow").status_code == 400
+    assert book(client, "nope", did, "2030-01-01 11:00").status_code == 400
+    assert client.post('/api/patients', json={}).status_code == 400
+    assert client.delete('/api/patients/nope').status_code == 400
+
+
+def test_cascade_delete(client):
+    pid, keep = add_patient(client, "Ann"), add_patient(client, "Bob")
+    did = add_doctor(client, "Dr One")
+    for hour in (9, 10, 11):
+        assert book(client, pid, did, f"2030-01-01 {hour:02}:00").status_code == 201
+    assert book(client, keep, did, "2030-01-01 12:00").status_code == 201
+    assert client.get('/api/stats').get_json()["appointments"] == 4
+    assert client.delete(f'/api/patients/{pid}').get_json() == {"deleted": pid}
+    remaining = client.get('/api/appointments').get_json()
+    assert [a["patient_id"] for a in remaining] == [keep]
+    stats = client.get('/api/stats').get_json()
+    assert (stats["patients"], stats["appointments"]) == (1, 1)
+    assert client.delete(f'/api/doctors/{did}').status_code == 200
+    assert client.get('/api/appointments').get_json() == []
+    assert client.get('/api/stats').get_json()["doctors"] == 0
+
+
+def test_cascade_delete_counts_racing_bookings(backend, client, monkeypatch):
+    """A booking racing a patient delete is either refused or subtracted, never left in the rollups."""
+    if backend != 'sqlite':
+        pytest.skip("MongoDB deletes take no write lock")
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    assert book(client, pid, did, "2030-01-01 09:00").status_code == 201
+    racer = threading.Thread(target=book, args=(hms.app.test_client(), pid, did, "2030-01-01 10:00"))
+    counted = hms.appointment_hours
+
+    def racing_count(cur, where, params):
+        hours = counted(cur, where, params)
+        racer.start()
+        racer.join(0.3)  # without the write lock the booking commits here, between the count and the DELETE
+        return hours
+
+    monkeypatch.setattr(hms, 'appointment_hours', racing_count)
+    assert client.delete(f'/api/patients/{pid}').status_code == 200
+    racer.join()
+    assert client.get('/api/appointments').get_json() == []
+    with hms.app.app_context():
+        conn = hms.get_conn()
+        rollups = [conn.execute(f"SELECT COALESCE(SUM(total), 0) FROM {t}").fetchone()[0] for t in ("appointment_day", "doctor_hour")]
+    assert rollups == [0, 0]
+
+
+def test_stats_today_and_upcoming(client):
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    today = datetime.utcnow()
+    for days in (-1, 0, 0, 1, 30):
+        day = (today + timedelta(days=days)).strftime("%Y-%m-%d")
+        assert book(client, pid, did, f"{day} {9 + len(client.get('/api/appointments').get_json()):02}:00").status_code == 201
+    stats = client.get('/api/stats').get_json()
+    assert (stats["appointments"], stats["today"], stats["upcoming"]) == (5, 2, 2)
+
+
+def test_pagination_cursors(client):
+    ids = [add_patient(client, f"P{i}") for i in range(7)]
+    pages = walk(client, '/api/patients', 3)
+    assert [len(p) for p in pages] == [3, 3, 1]
+    assert [p["id"] for page in pages for p in page] == ids
+    did = add_doctor(client, "Dr One")
+    booked = [book(client, ids[i], did, f"2030-01-0{1 + i % 3} {9 + i:02}:00").get_json()["id"] for i in range(7)]
+    pages = walk(client, f'/api/appointments?doctor_id={did}', 2)
+    listed = [a for page in pages for a in page]
+    assert sorted(a["id"] for a in listed) == sorted(booked)
+    assert [a["datetime"] for a in listed] == sorted(a["datetime"] for a in listed)
+    assert all(a["patient_name"].startswith("P") and a["doctor_name"] == "Dr One" for a in listed)
+    resp = client.get('/api/patients?limit=7')
+    assert 'X-Next-Cursor' not in resp.headers
+    assert client.get('/api/patients?after=garbage').status_code == 400
+
+
+def test_availability(client, missing_id):
+    pid = add_patient(client, "Ann")
+    one, two = add_doctor(client, "Dr One", "Cardiology"), add_doctor(client, "Dr Two", "Cardiology")
+    other = add_doctor(client, "Dr Three", "ENT")
+    for did, dt in ((one, "2030-01-01 09:00"), (one, "2030-01-02 09:30"), (two, "2030-01-01 10:00"), (one, "2030-01-03 09:00")):
+        assert book(client, pid, did, dt).status_code == 201
+    hours = '&start=09:00&end=11:00&slot=60'
+    resp = client.get(f'/api/doctors/{one}/availability?from=2030-01-01&to=2030-01-03' + hours).get_json()
+    assert resp["times"] == ["09:00", "10:00"]
+    # An off-grid booking takes the slot it starts in.
+    assert [(d["date"], d["booked"], d["free"]) for d in resp["days"]] == [
+        ("2030-01-01", ["09:00"], ["10:00"]), ("2030-01-02", ["09:00"], ["10:00"])]
+    resp = client.get('/api/availability?specialty=Cardiology&from=2030-01-01&to=2030-01-02' + hours).get_json()
+    assert sorted(d["id"] for d in resp["doctors"]) == sorted([one, two])
+    assert resp["days"] == [{"date": "2030-01-01", "free": {"09:00": [two], "10:00": [one]}}]
+    free = client.get(f'/api/availability?doctor_id={other},{two}&from=2030-01-01&to=2030-01-02' + hours).get_json()["days"][0]["free"]
+    assert (sorted(free["09:00"], key=str), free["10:00"]) == (sorted([two, other], key=str), [other])
+    assert client.get(f'/api/doctors/{missing_id}/availability').status_code == 404
+    assert client.get(f'/api/doctors/{one}/availability?from=2030-01-02&to=2030-01-01').status_code == 400
+    assert client.get(f'/api/doctors/{one}/availability?start=12:00&end=09:00').status_code == 400
+    assert client.get(f'/api/doctors/{one}/availability?slot=1').status_code == 400
+
+
+def test_bulk_booking(client, missing_id):
+    pid, bob = add_patient(client, "Ann"), add_patient(client, "Bob")
+    did = add_doctor(client, "Dr One")
+    item = lambda p, dt: {"patient_id": p, "doctor_id": did, "datetime": dt}
+    resp = client.post('/api/appointments/bulk', json=[
+        item(pid, "2030-01-01 09:00"), item(bob, "2030-01-01 09:00"), item(pid, "2030-01-01 10:00"),
+        item(missing_id, "2030-01-01 11:00"), item(pid, "whenever")])
+    body = resp.get_json()
+    assert resp.status_code == 200 and (body["created"], body["failed"]) == (2, 3)
+    assert [r["status"] for r in body["results"]] == [201, 409, 201, 404, 400]
+    assert client.get('/api/stats').get_json()["appointments"] == 2
+    resp = client.post('/api/appointments/bulk', json={"atomic": True, "appointments": [
+        item(bob, "2030-01-02 09:00"), item(pid, "2030-01-01 10:00")]})
+    assert [r["status"] for r in resp.get_json()["results"]] == [424, 409]
+    resp = client.post('/api/appointments/bulk', json={"atomic": True, "appointments": [
+        item(bob, "2030-01-02 09:00"), item(bob, "tomorrow")]})
+    assert [r["status"] for r in resp.get_json()["results"]] == [424, 400]
+    assert client.get('/api/stats').get_json()["appointments"] == 2
+    resp = client.post('/api/appointments/bulk', json={"atomic": True, "appointments": [item(bob, "2030-01-02 09:00")]})
+    assert resp.status_code == 201 and resp.get_json()["created"] == 1
+    assert client.post('/api/appointments/bulk', json=[]).status_code == 400
+
+
+def test_streamed_lists(client):
+    ids = [add_patient(client, f"P{i}") for i in range(5)]
+    did = add_doctor(client, "Dr One")
+    for i, pid in enumerate(ids[:3]):
+        assert book(client, pid, did, f"2030-01-01 {9 + i:02}:00").status_code == 201
+    resp = client.get('/api/patients?stream=1')
+    assert (resp.is_streamed, resp.mimetype) == (True, 'application/json')
+    assert [p["id"] for p in json.loads(resp.get_data())] == ids
+    resp = client.get(f'/api/appointments?stream=ndjson&doctor_id={did}')
+    assert resp.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert [(a["patient_name"], a["datetime"]) for a in rows] == [(f"P{i}", f"2030-01-01 {9 + i:02}:00") for i in range(3)]
+    resp = client.get('/api/doctors', headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line)["name"] for line in resp.get_data(as_text=True).splitlines()] == ["Dr One"]
+    resp = client.get(f'/api/patients?stream=1&after={ids[1]}')
+    assert [p["id"] for p in json.loads(resp.get_data())] == ids[2:]
+    assert client.get('/api/patients?stream=1&limit=2').get_json() == client.get('/api/patients?limit=2').get_json()
+
+
+def test_etags_and_response_cache(client):
+    pid = add_patient(client, "Ann")
+    resp = client.get('/api/patients')
+    etag = resp.headers['ETag']
+    assert resp.headers['Cache-Control'] == 'no-cache'
+    resp = client.get('/api/patients', headers={"If-None-Match": etag})
+    assert (resp.status_code, resp.get_data()) == (304, b"")
+    assert client.get('/api/patients', headers={"If-None-Match": '"stale"'}).status_code == 200
+    assert client.get('/api/patients?limit=1', headers={"If-None-Match": etag}).status_code == 200
+    hits = hms.response_cache.hits
+    assert [p["id"] for p in client.get('/api/patients').get_json()] == [pid]
+    assert hms.response_cache.hits == hits + 1
+    other = add_patient(client, "Bob")
+    resp = client.get('/api/patients', headers={"If-None-Match": etag})
+    assert resp.status_code == 200 and resp.headers['ETag'] != etag
+    assert [p["id"] for p in resp.get_json()] == [pid, other]
+    assert client.get('/api/appointments', headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = hms.ResponseCache(max_bytes=10, max_entries=2)
+    cache.put("a", b"aaaa", [])
+    cache.put("b", b"bbbb", [])
+    assert cache.get("a") == (b"aaaa", [])
+    cache.put("c", b"cccc", [])
+    assert (cache.get("b"), cache.evictions) == (None, 1)
+    cache.put("d", b"dddddd", [])
+    assert [k for k in "acd" if cache.get(k)] == ["c", "d"]
+    assert cache.evictions == 2
+    cache.put("big", b"x" * 11, [])
+    assert cache.get("big") is None and cache.get("d") is not None
+
+
+def test_batch(client):
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    resp = client.post('/api/batch', json=[
+        {"method": "POST", "path": "/api/appointments", "body": {"patient_id": pid, "doctor_id": did, "datetime": "2030-01-01 09:00"}},
+        {"method": "POST", "path": "/api/appointments", "body": {"patient_id": pid, "doctor_id": did, "datetime": "2030-01-01 09:00"}},
+        {"path": "/api/appointments?limit=5"},
+        {"path": "/api/batch"},
+    ]).get_json()
+    assert (resp["succeeded"], resp["failed"]) == (2, 2)
+    assert [r["status"] for r in resp["results"]] == [201, 409, 200, 400]
+    assert [a["patient_name"] for a in resp["results"][2]["body"]] == ["Ann"]
+    assert client.post('/api/batch', json=[]).status_code == 400
+
+
+def test_atomic_batch_rolls_back(backend, client):
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    ops = [
+        {"method": "POST", "path": "/api/patients", "body": {"name": "Bob"}},
+        {"method": "POST", "path": "/api/appointments", "body": {"patient_id": pid, "doctor_id": did, "datetime": "2030-01-01 09:00"}},
+        {"method": "POST", "path": "/api/appointments", "body": {"patient_id": pid, "doctor_id": did, "datetime": "2030-01-01 09:00"}},
+        {"method": "DELETE", "path": f"/api/doctors/{did}"},
+    ]
+    resp = client.post('/api/batch', json={"requests": ops, "atomic": True})
+    if backend != 'sqlite':
+        assert resp.status_code == 501
+        return
+    resp = resp.get_json()
+    assert [r["status"] for r in resp["results"]] == [424, 424, 409, 424]
+    assert (resp["succeeded"], resp["failed"]) == (0, 4)
+    # A request refused before it touches the database must still roll back the ones before it.
+    invalid = {"method": "POST", "path": "/api/appointments", "body": {"patient_id": pid, "doctor_id": did, "datetime": "soon"}}
+    resp = client.post('/api/batch', json={"requests": ops[:2] + [invalid], "atomic": True}).get_json()
+    assert [r["status"] for r in resp["results"]] == [424, 424, 400]
+    assert [p["name"] for p in client.get('/api/patients').get_json()] == ["Ann"]
+    assert client.get('/api/appointments').get_json() == []
+    assert [d["id"] for d in client.get('/api/doctors').get_json()] == [did]
+    stats = client.get('/api/stats').get_json()
+    assert (stats["patients"], stats["doctors"], stats["appointments"]) == (1, 1, 0)
+    resp = client.post('/api/batch', json={"requests": ops[:2], "atomic": True}).get_json()
+    assert [r["status"] for r in resp["results"]] == [201, 201]
+    assert client.get('/api/stats').get_json()["appointments"] == 1
+    assert client.post('/api/batch', json={"requests": [{"path": "/api/patients"}], "atomic": True}).status_code == 400
+
+
+def test_search_routes(client):
+    ann = add_patient(client, "Ann Ahmed", contact="555-0101", address="12 Elm Street")
+    zoe = add_patient(client, "Zoë Annan", address="Ahmed Road")
+    hana = add_patient(client, "Hana Aziz", contact="ann@example.com")
+    bob = add_patient(client, "Bob Brown", address="Oak Avenue")
+    found = client.get('/api/patients/search?q=ann').get_json()
+    assert found[0]["id"] == ann and {p["id"] for p in found} == {ann, zoe, hana}
+    assert [p["id"] for p in client.get('/api/patients/search?q=zoe').get_json()] == [zoe]
+    assert [p["id"] for p in client.get('/api/patients/search?q=AHM elm').get_json()] == [ann]
+    assert [p["id"] for p in client.get('/api/patients/search?q=555').get_json()] == [ann]
+    pages = walk(client, '/api/patients/search?q=a', 1)
+    assert sorted(p["id"] for page in pages for p in page) == sorted([ann, zoe, hana, bob])
+    assert client.get('/api/patients/search?q=%20').status_code == 400
+    client.delete(f'/api/patients/{ann}')
+    assert [p["id"] for p in client.get('/api/patients/search?q=ahmed').get_json()] == [zoe]
+    did = add_doctor(client, "Dr Okafor", "Cardiology")
+    add_doctor(client, "Dr Silva", "Dermatology")
+    assert [d["id"] for d in client.get('/api/doctors/search?q=cardio').get_json()] == [did]
+
+
+def test_change_feed(client, monkeypatch):
+    start = client.get('/api/changes').get_json()
+    assert (start["changes"], start["reset"]) == ([], False)
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    aid = book(client, pid, did, "2030-01-01 09:00").get_json()["id"]
+    client.delete(f'/api/patients/{pid}')
+    feed = client.get(f'/api/changes?since={start["version"]}').get_json()
+    # A patient's delete stands for the appointments it takes with it.
+    assert [(c["kind"], c["op"], str(c["id"])) for c in feed["changes"]] == [
+        ("patients", "create", str(pid)), ("doctors", "create", str(did)),
+        ("appointments", "create", str(aid)), ("patients", "delete", str(pid))]
+    assert feed["changes"][0]["data"]["name"] == "Ann"
+    versions = [c["version"] for c in feed["changes"]]
+    assert versions == sorted(versions) and feed["version"] == versions[-1] and not feed["more"]
+    page = client.get(f'/api/changes?since={start["version"]}&kinds=doctors').get_json()
+    assert [c["id"] for c in page["changes"]] == [did]
+    page = client.get(f'/api/changes?since={start["version"]}&limit=2').get_json()
+    assert (len(page["changes"]), page["more"], page["version"]) == (2, True, versions[1])
+    assert client.get(f'/api/changes?since={feed["version"] + 5}').get_json()["reset"] is True
+    assert client.get('/api/changes?since=0&kinds=users').status_code == 403
+    assert client.get('/api/changes?since=0&kinds=nope').status_code == 400
+
+    monkeypatch.setattr(hms, 'CHANGE_STREAM_SECONDS', 0)
+    monkeypatch.setattr(hms, 'change_feed', hms.ChangeFeed(max_streams=1))
+    resp = client.get('/api/changes/stream', headers={"Last-Event-ID": str(versions[2])})
+    assert resp.mimetype == 'text/event-stream'
+    busy = client.get('/api/changes/stream')
+    assert (busy.status_code, busy.headers['Retry-After']) == (503, '30')
+    events = [e for e in resp.get_data(as_text=True).split("\n\n") if e.startswith("id:")]
+    resp.close()
+    assert [e.splitlines()[:2] for e in events] == [[f"id: {v}", "event: change"] for v in versions[3:]]
+    assert json.loads(events[-1].splitlines()[2][len("data: "):])["op"] == "delete"
+    resp = client.get('/api/changes/stream')
+    assert resp.status_code == 200
+    resp.close()
+
+
+def test_utilization(client, monkeypatch):
+    monkeypatch.setattr(hms, 'WORK_END', '11:00')  # two one-hour slots a day, 09:00 and 10:00
+    ann, bob = add_patient(client, "Ann"), add_patient(client, "Bob")
+    one, two = add_doctor(client, "Dr One"), add_doctor(client, "Dr Two", "Cardiology")
+    for pid, did, dt in ((ann, one, "2030-01-01 09:00"), (bob, one, "2030-01-01 10:00"), (ann, one, "2030-01-02 09:00"),
+                         (bob, two, "2030-01-01 09:00"), (bob, two, "2030-01-05 09:00")):
+        assert book(client, pid, did, dt).status_code == 201
+    url = '/api/analytics/utilization?from=2030-01-01&to=2030-01-03'
+    admin = sign_in(client, "admin@example.com", admin=True)
+    assert client.get(url).status_code == 401
+    assert client.get(url, headers=sign_in(client, "bob@example.com")).status_code == 403
+    report = client.get(url, headers=admin).get_json()
+    assert (report["days"], report["slots_per_day"]) == (2, 2)
+    assert [(d["id"], d["appointments"], d["occupancy"], d["no_slot_days"], d["peak_hour"]) for d in report["doctors"]] == [
+        (one, 3, 0.75, 1, 9), (two, 1, 0.25, 0, 9)]
+    totals = report["totals"]
+    assert totals.pop("by_hour") == [0] * 9 + [3, 1] + [0] * 13
+    assert totals == {"doctors": 2, "appointments": 4, "occupancy": 0.5, "no_slot_days": 1, "peak_hour": 9}
+    assert [(s["specialty"], s["doctors"], s["appointments"]) for s in report["by_specialty"]] == [("Cardiology", 1, 1), ("General", 1, 3)]
+    report = client.get(url + '&specialty=Cardiology', headers=admin).get_json()
+    assert [d["id"] for d in report["doctors"]] == [two]
+    client.delete(f'/api/patients/{bob}')
+    report = client.get(url + '&order=name', headers=admin).get_json()
+    assert [(d["name"], d["appointments"], d["no_slot_days"]) for d in report["doctors"]] == [("Dr One", 2, 0), ("Dr Two", 0, 0)]
+    assert client.get(url + '&order=nope', headers=admin).status_code == 400
+    assert client.get('/api/analytics/utilization?from=2030-01-03&to=2030-01-01', headers=admin).status_code == 400
+
+
+def test_auth_status_codes(client):
+    assert client.post('/api/auth/signup', json={"name": "A", "email": "a@example.com", "password": "pw"}).status_code == 201
+    assert client.post('/api/auth/signup', json={"name": "A", "email": "a@example.com", "password": "pw"}).status_code == 409
+    assert client.post('/api/auth/login', json={"email": "a@example.com", "password": "bad"}).status_code == 401
+    token = client.post('/api/auth/login', json={"email": "a@example.com", "password": "pw"}).get_json()["token"]
+    assert client.get('/api/auth/me', headers={"Authorization": f"Bearer {token}"}).status_code == 200
+    assert client.get('/api/auth/me').status_code == 401
+    assert client.get('/api/admin/users', headers={"Authorization": f"Bearer {token}"}).status_code == 403
+
+
+def test_unpadded_datetimes_are_normalized(client):
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    assert book(client, pid, did, "2030-01-01 9:00").status_code == 201
+    assert book(client, pid, did, "2030-01-01 09:00").status_code == 409
+    assert [a["datetime"] for a in client.get('/api/appointments?from=2030-01-01 9:00').get_json()] == ["2030-01-01 09:00"]
+
+
+def test_metrics_access(client, monkeypatch):
+    assert client.get('/api/metrics').status_code == 401
+    assert client.get('/api/metrics', headers=sign_in(client, "bob@example.com")).status_code == 403
+    assert client.get('/api/metrics', headers=sign_in(client, "admin@example.com", admin=True)).status_code == 200
+    monkeypatch.setattr(hms, 'METRICS_TOKEN', 'scrape')
+    assert client.get('/api/metrics', headers={"Authorization": "Bearer scrape"}).status_code == 200
+    assert client.get('/api/metrics', headers={"Authorization": "Bearer wrong"}).status_code == 401
+    monkeypatch.setattr(hms, 'METRICS_PUBLIC', True)
+    assert client.get('/api/metrics').status_code == 200
+
+
+def test_name_index_metrics(client):
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    book(client, pid, did, "2030-01-01 09:00")
+    assert client.get('/api/appointments').get_json()[0]["patient_name"] == "Ann"
+    text = client.get('/api/metrics', headers=sign_in(client, "admin@example.com", admin=True)).get_data(as_text=True)
+    assert '# TYPE hms_name_index gauge' in text
+    assert 'hms_name_index{kind="patients",stat="entries"} 1' in text
+
+
+# ---------- Frontend assets ----------
+def test_assets_are_whitelisted(client):
+    for path in ('/app.py', '/assets/app.py', '/hospital.db', '/requirements.txt', '/tests/conftest.py', '/api/nope.js'):
+        assert client.get(path).status_code == 404, path
+    assert client.get('/patients').get_data() == client.get('/').get_data()
+
+
+def test_assets_are_precompressed(client):
+    page = client.get('/', headers={"Accept-Encoding": "identity"})
+    assert page.mimetype == 'text/html' and 'Content-Encoding' not in page.headers
+    script = hms.asset_table.get('assets.js')
+    assert f'/assets.js?v={script["hash"]}'.encode() in page.get_data()
+    resp = client.get(f'/assets.js?v={script["hash"]}', headers={"Accept-Encoding": "gzip"})
+    assert resp.headers['Content-Encoding'] == 'gzip' and resp.headers['Vary'] == 'Accept-Encoding'
+    assert 'immutable' in resp.headers['Cache-Control']
+    assert gzip.decompress(resp.get_data()) == script["variants"]["identity"]
+    assert client.get('/assets.js', headers={"Accept-Encoding": "gzip"}).headers['Cache-Control'] == 'no-cache'
+    resp = client.get('/assets.js', headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers['ETag']})
+    assert (resp.status_code, resp.get_data()) == (304, b"")
+    assert client.get('/assets.js', headers={"If-None-Match": resp.headers['ETag']}).status_code == 200
+    if hms.HAVE_BROTLI:
+        resp = client.get('/assets.js', headers={"Accept-Encoding": "gzip, br"})
+        assert resp.headers['Content-Encoding'] == 'br'
+        assert hms.brotli.decompress(resp.get_data()) == script["variants"]["identity"]
+
+
+# ---------- Background jobs ----------
+def test_job_routes_need_auth(client):
+    admin, other = sign_in(client, "admin@example.com", admin=True), sign_in(client, "bob@example.com")
+    resp = client.post('/api/import/patients?background=1', data="name,age\nAnn,30\nBob,40\n", content_type='text/csv', headers=admin)
+    assert resp.status_code == 202
+    job = resp.get_json()
+    assert client.get(f'/api/jobs/{job["id"]}').status_code == 401
+    assert client.post(f'/api/jobs/{job["id"]}/cancel').status_code == 401
+    assert client.post(f'/api/jobs/{job["id"]}/cancel', headers=other).status_code == 403
+    job = wait_for_job(client, job, other)
+    assert (job["status"], job["processed"]) == ("succeeded", 2)
+    assert [p["name"] for p in client.get('/api/patients').get_json()] == ["Ann", "Bob"]
+    assert client.post(f'/api/jobs/{job["id"]}/cancel', headers=admin).status_code == 409
+
+
+def test_imports(client, monkeypatch):
+    admin = sign_in(client, "admin@example.com", admin=True)
+    resp = client.post('/api/import/patients', data="name,age,contact\nAnn,30,555\nBob,old,\n,40,\nCy,,\n", content_type='text/csv', headers=admin)
+    result = resp.get_json()
+    assert (result["processed"], result["inserted"], result["failed"], result["done"]) == (4, 2, 2, True)
+    assert result["errors"] == [{"row": 2, "error": "invalid age"}, {"row": 3, "error": "name required"}]
+    ann, cy = [(p["id"], p["name"], p["age"], p["contact"]) for p in client.get('/api/patients').get_json()]
+    assert (ann[1:], cy[1:]) == (("Ann", 30, "555"), ("Cy", 0, ""))
+    assert [p["id"] for p in client.get('/api/patients/search?q=cy').get_json()] == [cy[0]]
+    upload = {"file": (io.BytesIO(b'{"name": "Dr One", "specialty": "Cardiology"}\n'), 'doctors.ndjson')}
+    assert client.post('/api/import/doctors', data=upload, headers=admin).get_json()["inserted"] == 1
+    did = client.get('/api/doctors').get_json()[0]["id"]
+    rows = [{"patient_id": ann[0], "doctor_id": did, "datetime": "2030-01-01 9:00"},
+            {"patient_id": cy[0], "doctor_id": did, "datetime": "2030-01-01 09:00"},
+            {"patient_id": cy[0], "doctor_id": did, "datetime": "2030-01-01 10:00"},
+            {"patient_id": ann[0], "doctor_id": did, "datetime": "someday"}]
+    body = "\n".join(json.dumps(r) for r in rows[:2]) + "\nnot json\n\n" + "\n".join(json.dumps(r) for r in rows[2:]) + "\n"
+    monkeypatch.setattr(hms.import_records, '__defaults__', (2,))
+    resp = client.post('/api/import/appointments?stream=1', data=body, content_type='application/x-ndjson', headers=admin)
+    progress = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert [(p["processed"], p["inserted"]) for p in progress[:-1]] == [(2, 1), (4, 2), (5, 2)]
+    assert progress[-1]["done"] and progress[-1]["failed"] == 3
+    assert sorted(e["row"] for e in progress[-1]["errors"]) == [2, 3, 6]
+    assert [a["datetime"] for a in client.get('/api/appointments').get_json()] == ["2030-01-01 09:00", "2030-01-01 10:00"]
+    stats = client.get('/api/stats').get_json()
+    assert (stats["patients"], stats["doctors"], stats["appointments"]) == (2, 1, 2)
+    assert client.post('/api/import/nurses', data="name\nAnn\n", content_type='text/csv', headers=admin).status_code == 404
+    assert client.post('/api/import/patients?format=xml', data="<a/>", headers=admin).status_code == 400
+    assert client.post('/api/import/patients', data="name\nAnn\n", content_type='text/csv', headers=sign_in(client, "bob@example.com")).status_code == 403
+
+
+def test_generated_hospital(client):
+    admin = sign_in(client, "admin@example.com", admin=True)
+    params = {"patients": 40, "doctors": 5, "appointments": 60, "from": "2030-01-01", "days": 3,
+              "specialties": {"Cardiology": 3, "ENT": 1}, "seed": 7}
+    assert client.post('/api/seed', json=params).status_code == 401
+    assert client.post('/api/seed', json=params, headers=sign_in(client, "bob@example.com")).status_code == 403
+    for bad in ({"density": 2}, {"doctors": 1, "days": 1, "patients": 5, "appointments": 9}, {"doctors": 1, "appointments": 1},
+                {"specialties": {"ENT": -1}}, {"seed": -1}, {"patients": True}):
+        assert client.post('/api/seed', json=bad, headers=admin).status_code == 400, bad
+    job = wait_for_job(client, client.post('/api/seed', json=params, headers=admin).get_json(), admin)
+    assert job["status"] == "succeeded"
+    stats = client.get('/api/stats').get_json()
+    assert (stats["patients"], stats["doctors"], stats["appointments"]) == (40, 5, 60)
+    assert {d["specialty"] for d in client.get('/api/doctors').get_json()} <= {"Cardiology", "ENT"}
+    booked = client.get('/api/appointments').get_json()
+    assert len(booked) == 60 and all("2030-01-01" <= a["datetime"] < "2030-01-04" for a in booked)
+    assert len({(a["doctor_id"], a["datetime"]) for a in booked}) == len({(a["patient_id"], a["datetime"]) for a in booked}) == 60
+    first = [p["name"] for p in client.get('/api/patients').get_json()]
+    job = wait_for_job(client, client.post('/api/seed', json=dict(params, appointments=0), headers=admin).get_json(), admin)
+    assert [p["name"] for p in client.get('/api/patients').get_json()][40:] == first
+
+
+def test_import_with_one_pooled_connection(backend, client, monkeypatch):
+    """Imports write through the job's or request's own connection instead of taking a second one."""
+    if backend != 'sqlite':
+        pytest.skip("only SQLite connections are pooled")
+    pool = hms.ConnectionPool(hms.pool.path, size=1, timeout=2)
+    monkeypatch.setattr(hms, 'pool', pool)
+    admin = sign_in(client, "admin@example.com", admin=True)
+    resp = client.post('/api/import/patients?background=1', data="name\nAnn\n", content_type='text/csv', headers=admin)
+    assert wait_for_job(client, resp.get_json(), admin)["status"] == "succeeded"
+    resp = client.post('/api/import/patients', data="name\nBob\n", content_type='text/csv', headers=admin)
+    assert resp.get_json()["inserted"] == 1
+    assert client.get('/api/stats').get_json()["patients"] == 2
+    pool.close_all()
+
+
+
+# ---------- Serving ----------
+def test_create_app_initializes_once(backend, monkeypatch):
+    monkeypatch.setattr(hms, '_initialized', False)
+    with hms.app.app_context():
+        stale = repos().jobs.create("import", {})
+    assert hms.create_app() is hms.app
+    if backend == 'sqlite':
+        assert hms.pool.stats()["open"] == 0
+    with hms.app.app_context():
+        job = repos().jobs.get(stale)
+    assert (job["status"], job["error"]) == ("failed", "interrupted by restart")
+    monkeypatch.setattr(hms, 'init_db', lambda: pytest.fail("migrated twice"))
+    assert hms.create_app() is hms.app
+
+
+def test_shutdown_drains(backend, client, monkeypatch):
+    def slow(**params):
+        while True:
+            yield {"processed": 0}
+    monkeypatch.setitem(hms.JOB_KINDS, "slow", slow)
+    for name, fresh in (('job_runner', hms.JobRunner(workers=1)), ('change_feed', hms.ChangeFeed()), ('hasher', hms.PasswordHasher())):
+        monkeypatch.setattr(hms, name, fresh)
+    with hms.app.app_context():
+        running, queued = hms.job_runner.submit("slow"), hms.job_runner.submit("slow")
+    admin = sign_in(client, "admin@example.com", admin=True)
+    for _ in range(100):
+        if client.get(f'/api/jobs/{running["id"]}', headers=admin).get_json()["status"] == "running":
+            break
+        time.sleep(0.05)
+    stream = client.get('/api/changes/stream')
+    hms.shutdown()
+    if backend == 'sqlite':
+        assert hms.pool.stats()["open"] == 0
+    # The open stream ends instead of waiting out its heartbeat.
+    assert hms.change_feed.closed and stream.get_data(as_text=True).startswith("retry:")
+    stream.close()
+    with hms.app.app_context():
+        jobs = [repos().jobs.get(j["id"]) for j in (running, queued)]
+    assert [(j["status"], j["error"]) for j in jobs] == [("failed", "interrupted by shutdown")] * 2
+
+# ---------- Command line ----------
+@pytest.mark.parametrize('mix', ['cardiology', 'cardiology=', '=2', 'Cardiology=x', 'Cardiology=inf'])
+def test_seed_cli_rejects_bad_specialties(tmp_path, mix):
+    proc = subprocess.run([sys.executable, 'app.py', 'seed', '--doctors', '2', '--specialties', mix], cwd=ROOT,
+                          env=dict(os.environ, DB_PATH=str(tmp_path / 'hospital.db')), capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 2
+    assert 'usage: app.py seed' in proc.stderr and 'Traceback' not in proc.stderr
+
+
+# ---------- Password hashing ----------
+def test_hash_slot_held_until_the_hash_finishes():
+    hasher = hms.PasswordHasher(workers=1, max_pending=1, timeout=0.3)
+    try:
+        with pytest.raises(hms.ApiError) as e:
+            hasher._run(time.sleep, 1.5)
+        assert e.value.status == 503
+        # The request gave up, but the hash still runs and still counts against max_pending.
+        assert not hasher._slots.acquire(blocking=False)
+        assert hasher._slots.acquire(timeout=5)
+        hasher._slots.release()
+        assert hasher._run(hms.generate_password_hash, "pw", "pbkdf2:sha256:1000").startswith("pbkdf2:sha256:1000$")
+    finally:
+        hasher.shutdown()
+
+
+# ---------- Migrations ----------
+def test_migrations_drop_double_bookings(tmp_path, caplog):
+    """A database from before atomic booking can hold double bookings; the unique indexes must still build."""
+    path = str(tmp_path / 'old.db')
+    old = sqlite3.connect(path)
+    hms._migrate_base_tables(old.cursor())
+    old.executescript("""
+        INSERT INTO patient(id, name) VALUES (1, 'Ann'), (2, 'Bob');
+        INSERT INTO doctor(id, name) VALUES (1, 'Dr One'), (2, 'Dr Two');
+        INSERT INTO appointment(id, patient_id, doctor_id, datetime) VALUES
+            (1, 1, 1, '2030-01-01 09:00'), (2, 2, 1, '2030-01-01 09:00'),
+            (3, 1, 2, '2030-01-01 10:00'), (4, 1, 1, '2030-01-01 10:00');
+        PRAGMA user_version = 2;
+    """)
+    old.close()
+    pool = hms.ConnectionPool(path)
+    with pool.connection() as conn:
+        assert hms.migrate(conn) == len(hms.MIGRATIONS)
+        assert [r[0] for r in conn.execute("SELECT id FROM appointment ORDER BY id")] == [1, 3]
+        assert conn.execute("SELECT value FROM counter WHERE name = 'appointments'").fetchone()[0] == 2
+        assert [tuple(r) for r in conn.execute("SELECT day, total FROM appointment_day")] == [("2030-01-01", 2)]
+    pool.close_all()
+    assert sum("dropping double booking" in r.getMessage() for r in caplog.records) == 2
+
+
+def test_mongo_slot_indexes_drop_double_bookings(backend, client, caplog):
+    if backend != 'mongomock':
+        pytest.skip("SQLite builds these indexes in its migrations")
+    pid, did = add_patient(client, "Ann"), add_doctor(client, "Dr One")
+    assert book(client, pid, did, "2030-01-01 09:00").status_code == 201
+    hms.db.appointments.drop_indexes()
+    twin = hms.db.appointments.find_one({}, {"_id": 0})
+    hms.db.appointments.insert_one(twin)
+    hms.bump_mongo_counters(hours=hms.hour_deltas([twin]), appointments=1)
+    with hms.app.app_context():
+        hms.init_db()
+    assert len(client.get('/api/appointments').get_json()) == 1
+    assert client.get('/api/stats').get_json()["appointments"] == 1
+    assert book(client, pid, did, "2030-01-01 09:00").status_code == 409
+    assert sum("dropping double booking" in r.getMessage() for r in caplog.records) == 1
+
+
+# ---------- Query plans ----------
+def test_hot_queries_use_indexes(backend, capsys):
+    if backend == 'sqlite':
+        with hms.app.app_context():
+            assert hms.explain_hot_queries(hms.get_conn()), capsys.readouterr().out
+    else:
+        indexes = {tuple(i["key"]) for i in hms.db.appointments.index_information().values()}
+        assert {(("doctor_id", 1), ("datetime", 1)), (("patient_id", 1), ("datetime", 1)), (("datetime", 1),)} <= indexes
+
+
+# ---------- Performance ----------
+def test_deep_pages_cost_like_the_first(backend, client):
+    """Keyset pages seek instead of skipping, so the last page is not slower than the first."""
+    rows = 20000 if backend == 'sqlite' else 2000  # mongomock scans every document anyway
+    with hms.app.app_context():
+        for _ in hms.import_records("patients", ((n, {"name": f"P{n}", "age": 1}) for n in range(rows))):
+            pass
+        ids = [p["id"] for p in repos().patients.find()]
+    def median_ms(url):
+        times = []
+        for n in range(15):
+            started = time.perf_counter()
+            assert client.get(f"{url}&n={n}").status_code == 200
+            times.append(time.perf_counter() - started)
+        return sorted(times)[len(times) // 2] * 1000
+    first = median_ms('/api/patients?limit=50')
+    deep = median_ms(f'/api/patients?limit=50&after={ids[-51]}')
+    assert deep < first * 3 + 5, (first, deep)
+
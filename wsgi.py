@@ -0,0 +1,10 @@
+"""WSGI entry point for production serving.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The config preloads this module in the master process, so the schema is
+migrated once before the workers fork.
+"""
+from app import create_app
+
+app = create_app()